@@ -1,5 +1,5 @@
 from pathlib import Path
-from decouple import config
+from decouple import Csv, config
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -32,6 +32,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.routers.ReadRoutingMiddleware',
 ]
 
 ROOT_URLCONF = 'FNTproject.urls'
@@ -54,43 +55,156 @@ TEMPLATES = [
 WSGI_APPLICATION = 'FNTproject.wsgi.application'
 
 
+# Django REST framework
+# SessionIdAuthentication resolves the FNT session (session_id param) once per request
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'api.authentication.SessionIdAuthentication',
+        'rest_framework.authentication.SessionAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ],
+}
+
+# /api/metrics/ is open to staff users, and to `Authorization: Bearer <METRICS_TOKEN>` when set
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
+
 # Database
 # API App  has a named database   
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    },
-    'api': {
+# DB_PROFILE=production keeps connections open between requests (defaults to production when DEBUG is off)
+DB_PROFILE = config('DB_PROFILE', default='development' if DEBUG else 'production')
+
+# SQLite connection setup, run on every new connection of both aliases
+# busy_timeout goes first so the WAL switch itself waits for a busy file instead of failing,
+# WAL lets readers run next to the single writer, IMMEDIATE takes the write lock at BEGIN so
+# two transactions never deadlock upgrading read locks ("database is locked")
+SQLITE_OPTIONS = {
+    'init_command': (
+        'PRAGMA busy_timeout=5000;'
+        'PRAGMA journal_mode=WAL;'
+        'PRAGMA synchronous=NORMAL;'
+        'PRAGMA mmap_size=134217728;'  # 128 MB
+        'PRAGMA cache_size=-20000;'  # ~20 MB page cache
+    ),
+    'transaction_mode': 'IMMEDIATE',
+}
+
+
+def sqlite_database(filename):
+    database = {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'fnt-api.sqlite3',
+        'NAME': BASE_DIR / filename,
+        'OPTIONS': SQLITE_OPTIONS,
+        # file based test databases so WAL and locking behave like production
+        'TEST': {'NAME': BASE_DIR / f'test-{filename}'},
     }
-}
+    if DB_PROFILE == 'production':
+        database['CONN_MAX_AGE'] = config('DB_CONN_MAX_AGE', default=600, cast=int)
+        database['CONN_HEALTH_CHECKS'] = True
+    return database
+
+
+# PostgreSQL for the api alias (API_DB_ENGINE=postgresql), needs psycopg[binary,pool]
+# connections come from psycopg's pool, so CONN_MAX_AGE stays 0
+def postgres_database(prefix, name='fnt_api'):
+    return {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': config(f'{prefix}_NAME', default=name),
+        'USER': config(f'{prefix}_USER', default='postgres'),
+        'PASSWORD': config(f'{prefix}_PASSWORD', default=''),
+        'HOST': config(f'{prefix}_HOST', default='localhost'),
+        'PORT': config(f'{prefix}_PORT', default='5432'),
+        'OPTIONS': {
+            'pool': {
+                'min_size': config(f'{prefix}_POOL_MIN', default=2, cast=int),
+                'max_size': config(f'{prefix}_POOL_MAX', default=10, cast=int),
+                'timeout': config(f'{prefix}_POOL_TIMEOUT', default=10, cast=int),
+            },
+        },
+    }
+
+
+API_DB_ENGINE = config('API_DB_ENGINE', default='sqlite')
+
+# Sessions and their songs are sharded over API_SHARDS databases by a hash of session_id
+# shard 0 is 'api', the others 'api_shard_<n>' (SQLite: fnt-api-shard-<n>.sqlite3,
+# PostgreSQL: API_SHARD_<n>_DB_* settings). After changing it run the rebalance_shards command.
+API_SHARDS = config('API_SHARDS', default=1, cast=int)
 
-# Database router for api app
-class ApiRouter:
-    def db_for_read(self, model, **hints):
-        if model._meta.app_label == 'api':
-            return 'api'
-        return None
+# alias and env prefix of each shard
+API_SHARD_PREFIXES = {'api': 'API_DB'}
+API_SHARD_PREFIXES.update({f'api_shard_{n}': f'API_SHARD_{n}_DB' for n in range(1, API_SHARDS)})
+API_DB_SHARDS = list(API_SHARD_PREFIXES)
 
-    def db_for_write(self, model, **hints):
-        if model._meta.app_label == 'api':
-            return 'api'
-        return None
+DATABASES = {
+    'default': sqlite_database('db.sqlite3'),
+}
+for number, (alias, prefix) in enumerate(API_SHARD_PREFIXES.items()):
+    if API_DB_ENGINE == 'postgresql':
+        DATABASES[alias] = postgres_database(prefix, name=f'fnt_api_{number}' if number else 'fnt_api')
+    else:
+        DATABASES[alias] = sqlite_database(f'fnt-api-shard-{number}.sqlite3' if number else 'fnt-api.sqlite3')
+
+# Read replicas (PostgreSQL only), one alias per host in <prefix>_REPLICA_HOSTS, keyed by the shard they follow
+# (require a shared CACHE_BACKEND, see CACHES below)
+# they share the shard's name and credentials, tests point them at the shard (MIRROR)
+API_DB_REPLICAS = {}
+if API_DB_ENGINE == 'postgresql':
+    for alias, prefix in API_SHARD_PREFIXES.items():
+        for number, host in enumerate(config(f'{prefix}_REPLICA_HOSTS', default='', cast=Csv()), start=1):
+            replica = f'{alias}_replica_{number}'
+            DATABASES[replica] = dict(DATABASES[alias], HOST=host, TEST={'MIRROR': alias})
+            API_DB_REPLICAS.setdefault(alias, []).append(replica)
+
+# Artist/Track catalog (api/catalog.py) is shared by all sessions and lives on one database,
+# migrate it first: python manage.py migrate --database=<API_CATALOG_DB>
+API_CATALOG_DB = config('API_CATALOG_DB', default='api')
+CATALOG_CACHE_TTL = config('CATALOG_CACHE_TTL', default=3600, cast=int)  # seconds a looked up track stays cached
+# seconds a track's stored Spotify match is trusted before it is searched again (0 = forever)
+SPOTIFY_RESOLVE_TTL = config('SPOTIFY_RESOLVE_TTL', default=30 * 24 * 3600, cast=int)
+SPOTIFY_MISS_TTL = config('SPOTIFY_MISS_TTL', default=24 * 3600, cast=int)  # same for "not on Spotify"
+# background pre-resolution (api/resolver.py) of the next SPOTIFY_RESOLVE_AHEAD playlist songs,
+# at most one search per SPOTIFY_SEARCH_INTERVAL seconds, Retry-After honoured up to SPOTIFY_MAX_RETRY_AFTER
+SPOTIFY_PRERESOLVE = config('SPOTIFY_PRERESOLVE', default=True, cast=bool)
+SPOTIFY_RESOLVE_AHEAD = config('SPOTIFY_RESOLVE_AHEAD', default=5, cast=int)
+SPOTIFY_SEARCH_INTERVAL = config('SPOTIFY_SEARCH_INTERVAL', default=0.2, cast=float)
+SPOTIFY_MAX_RETRY_AFTER = config('SPOTIFY_MAX_RETRY_AFTER', default=60, cast=int)
+
+# seconds a session keeps reading from the primary after a write, set above the worst replica lag
+API_REPLICA_LAG = config('API_REPLICA_LAG', default=2, cast=float)
+
+# Database router for api app (api/routers.py)
+DATABASE_ROUTERS = ['api.routers.ApiRouter']
+
+
+# Django cache. The session cache invalidations, sticky reads after a write and the auto-advance /
+# token refresh locks go through it, so with several worker processes it must be a backend they
+# share, e.g. CACHE_BACKEND=django.core.cache.backends.redis.RedisCache (needs redis-py) and
+# CACHE_LOCATION=redis://127.0.0.1:6379. The default local-memory cache is per process.
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default=''),
+    }
+}
 
-    def allow_relation(self, obj1, obj2, **hints):
-        if obj1._meta.app_label == 'api' or obj2._meta.app_label == 'api':
-            return True
-        return None
+# In-process Session cache (api/session_cache.py)
+# Invalidations are published as version stamps through the Django cache, so the session cache
+# stays off unless CACHES is shared (redis/memcached, see api/checks.py).
+SESSION_CACHE_TTL = config('SESSION_CACHE_TTL', default=30, cast=int)  # seconds
+SESSION_CACHE_SIZE = config('SESSION_CACHE_SIZE', default=1024, cast=int)  # sessions per process
 
-    def allow_migrate(self, db, app_label, model_name=None, **hints):
-        if app_label == 'api':
-            return db == 'api'
-        return db == 'default'
+# Session expiry (api/reaper.py), seconds, 0 disables
+SESSION_IDLE_TIMEOUT = config('SESSION_IDLE_TIMEOUT', default=6 * 3600, cast=int)  # since last request
+SESSION_MAX_AGE = config('SESSION_MAX_AGE', default=7 * 24 * 3600, cast=int)  # since creation
+SESSION_TOUCH_INTERVAL = config('SESSION_TOUCH_INTERVAL', default=60, cast=int)  # last_active write throttle
 
-DATABASE_ROUTERS = ['FNTproject.settings.ApiRouter']
+# Reaper: `python manage.py reap_sessions` from cron, or REAPER_THREAD=True for a thread in each server process
+REAPER_THREAD = config('REAPER_THREAD', default=False, cast=bool)
+REAPER_INTERVAL = config('REAPER_INTERVAL', default=300, cast=int)  # seconds between thread runs
+REAPER_BATCH_SIZE = config('REAPER_BATCH_SIZE', default=500, cast=int)  # rows per DELETE
+REAPER_BATCH_PAUSE = config('REAPER_BATCH_PAUSE', default=0.2, cast=float)  # seconds between batches
 
 
 # Password validation
@@ -140,4 +254,56 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Spotify Configs
 SPOTIFY_CLIENT_ID = config('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = config('SPOTIFY_CLIENT_SECRET')
-SPOTIFY_REDIRECT_URI = config('SPOTIFY_REDIRECT_URI', default='http://127.0.0.1:8000/spotify/callback/')
\ No newline at end of file
+SPOTIFY_REDIRECT_URI = config('SPOTIFY_REDIRECT_URI', default='http://127.0.0.1:8000/spotify/callback/')
+
+# Spotify HTTP client (spotify_api/client.py, async_client.py): keep-alive pool, timeouts in seconds,
+# retries (doubling from SPOTIFY_RETRY_BACKOFF) for idempotent calls on connection errors / 5xx
+SPOTIFY_POOL_SIZE = config('SPOTIFY_POOL_SIZE', default=10, cast=int)
+SPOTIFY_CONNECT_TIMEOUT = config('SPOTIFY_CONNECT_TIMEOUT', default=5, cast=float)
+SPOTIFY_READ_TIMEOUT = config('SPOTIFY_READ_TIMEOUT', default=15, cast=float)
+SPOTIFY_RETRIES = config('SPOTIFY_RETRIES', default=2, cast=int)
+SPOTIFY_RETRY_BACKOFF = config('SPOTIFY_RETRY_BACKOFF', default=0.25, cast=float)
+# seconds the player reads (currently playing, playback state, devices) are shared per token,
+# concurrent identical reads wait for the one already sent to Spotify
+SPOTIFY_PLAYER_CACHE_TTL = config('SPOTIFY_PLAYER_CACHE_TTL', default=0.5, cast=float)
+# seconds the profile and the device list are kept per access token (spotify_api/account_cache.py),
+# the profile also bounds how long a session's last device is remembered
+SPOTIFY_PROFILE_TTL = config('SPOTIFY_PROFILE_TTL', default=3600, cast=int)
+SPOTIFY_DEVICES_TTL = config('SPOTIFY_DEVICES_TTL', default=30, cast=int)
+# Spotify rate limiter (spotify_api/limiter.py): calls per second and burst for the app and for each
+# access token, the longest wait (s) for page calls and playback commands before answering 429, and
+# the slots background lookups leave free; a 429 from Spotify holds every call for its Retry-After
+SPOTIFY_APP_RATE = config('SPOTIFY_APP_RATE', default=10, cast=float)
+SPOTIFY_APP_BURST = config('SPOTIFY_APP_BURST', default=20, cast=int)
+SPOTIFY_TOKEN_RATE = config('SPOTIFY_TOKEN_RATE', default=3, cast=float)
+SPOTIFY_TOKEN_BURST = config('SPOTIFY_TOKEN_BURST', default=10, cast=int)
+SPOTIFY_RATE_MAX_WAIT = config('SPOTIFY_RATE_MAX_WAIT', default=2, cast=float)
+SPOTIFY_PLAYBACK_MAX_WAIT = config('SPOTIFY_PLAYBACK_MAX_WAIT', default=5, cast=float)
+SPOTIFY_RATE_RESERVE = config('SPOTIFY_RATE_RESERVE', default=2, cast=int)
+# seconds the ETag and body of profile / devices / recent tracks answers are kept per token for
+# If-None-Match revalidation (spotify_api/etags.py)
+SPOTIFY_ETAG_TTL = config('SPOTIFY_ETAG_TTL', default=3600, cast=int)
+# recently-played sync into the history (api/recent_sync.py): seconds between the syncs
+# /api/history/ runs per session, and how far (s) a Spotify play may be from one we recorded to be the same
+SPOTIFY_RECENT_SYNC_INTERVAL = config('SPOTIFY_RECENT_SYNC_INTERVAL', default=60, cast=int)
+SPOTIFY_RECENT_MATCH_SLACK = config('SPOTIFY_RECENT_MATCH_SLACK', default=60, cast=int)
+# Spotify access tokens are refreshed on the server this many seconds before they expire,
+# a request that finds another process refreshing an expired token waits up to SPOTIFY_TOKEN_WAIT
+SPOTIFY_TOKEN_REFRESH_MARGIN = config('SPOTIFY_TOKEN_REFRESH_MARGIN', default=300, cast=int)
+SPOTIFY_TOKEN_WAIT = config('SPOTIFY_TOKEN_WAIT', default=5, cast=float)
+# playback scheduler (api/playback.py): auto-advance fires this many ms before a track ends,
+# a track more than SCHEDULER_DRIFT_MS off its plan (seek, pause, skip in Spotify) is re-planned
+SCHEDULER_LEAD_MS = config('SCHEDULER_LEAD_MS', default=1000, cast=int)
+SCHEDULER_DRIFT_MS = config('SCHEDULER_DRIFT_MS', default=2000, cast=int)
+# queue-ahead (api/queue_ahead.py): keep this many upcoming playlist songs in Spotify's own player
+# queue so Spotify changes songs without a gap, 0 = off (every change is a play call from the server)
+SPOTIFY_QUEUE_AHEAD = config('SPOTIFY_QUEUE_AHEAD', default=0, cast=int)
+# session events (api/events.py, GET /api/events/): broker class, events kept per session for
+# Last-Event-ID resume and for how many seconds after its last subscriber left, events a slow
+# client may fall behind, heartbeat (s) and client retry (ms)
+EVENTS_BROKER = config('EVENTS_BROKER', default='api.events.LocalBroker')
+EVENTS_BACKLOG = config('EVENTS_BACKLOG', default=100, cast=int)
+EVENTS_BACKLOG_TTL = config('EVENTS_BACKLOG_TTL', default=60, cast=int)
+EVENTS_QUEUE_SIZE = config('EVENTS_QUEUE_SIZE', default=100, cast=int)
+EVENTS_HEARTBEAT = config('EVENTS_HEARTBEAT', default=15, cast=float)
+EVENTS_RETRY_MS = config('EVENTS_RETRY_MS', default=3000, cast=int)
@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from . import checks  # noqa: F401, registers the system checks
+        if settings.REAPER_THREAD:
+            # started by the first request, so migrate, other commands and the autoreloader's
+            # parent process never run it
+            from django.core.signals import request_started
+            from .reaper import REAPER_SIGNAL_UID, start_on_first_request
+            request_started.connect(start_on_first_request, dispatch_uid=REAPER_SIGNAL_UID)
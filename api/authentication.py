@@ -0,0 +1,63 @@
+from django.contrib.auth.models import AnonymousUser
+from rest_framework.authentication import BaseAuthentication
+
+from .models import Session
+from .routers import bind_session
+from .session_cache import get_session
+from .reaper import is_expired, touch_session
+from spotify_api.tokens import ensure_fresh_token
+
+# columns loaded for the request session, views can ask for more with a session_fields attribute
+# (the timestamps let expired sessions be refused before the reaper deletes them)
+SESSION_FIELDS = ("session_id", "is_active", "created_date", "last_active")
+SPOTIFY_SESSION_FIELDS = SESSION_FIELDS + ("spotify_access_token",)
+
+
+#Helper, session_id from the query string or the request body
+def get_session_id(request):
+    session_id = request.query_params.get("session_id")
+    if not session_id and hasattr(request.data, "get"):
+        session_id = request.data.get("session_id")
+    return session_id
+
+
+#Helper, Session resolved by SessionIdAuthentication (None if missing or unknown)
+def request_session(request):
+    session = request.auth
+    return session if isinstance(session, Session) else None
+
+
+#Helper, the Session of a request with `fields` loaded (None if unknown or expired), token refreshed when it is one of them
+def load_session(session_id, fields=SESSION_FIELDS):
+    bind_session(session_id)
+    session = get_session(session_id, fields)
+    if session is not None and is_expired(session):
+        return None  # past SESSION_IDLE_TIMEOUT / SESSION_MAX_AGE, the reaper deletes it
+    if session is not None and session.is_active:
+        touch_session(session.session_id)
+        # views that call Spotify get a token that is not about to expire
+        if "spotify_access_token" in fields:
+            ensure_fresh_token(session)
+    return session
+
+
+class SessionIdAuthentication(BaseAuthentication):
+    """
+    Resolve the FNT session once per request and attach it as request.auth.
+
+    Only the columns in the view's session_fields (default SESSION_FIELDS) are
+    fetched, and those are usually served from the session cache without a
+    query. Missing, unknown or expired session ids are not an authentication
+    failure, views report them through validate_session() (404). When the view loads the
+    Spotify token, it is refreshed here ahead of its expiry.
+    """
+
+    def authenticate(self, request):
+        session_id = get_session_id(request)
+        if not session_id:
+            return None
+        view = request.parser_context.get("view") if request.parser_context else None
+        session = load_session(session_id, getattr(view, "session_fields", SESSION_FIELDS))
+        if session is None:
+            return None
+        return (AnonymousUser(), session)
@@ -0,0 +1,119 @@
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import Artist, Track
+
+
+#Helper, normalized form used as catalog key ("  The  Beatles" and "the beatles" are one artist)
+def normalize(value):
+    return " ".join((value or "").casefold().split())
+
+
+def track_key(title, artist_name):
+    return f"{normalize(artist_name)}\x1f{normalize(title)}"
+
+
+def _cache_key(lookup_key):
+    return "fnt:track:" + hashlib.sha1(lookup_key.encode()).hexdigest()
+
+
+def _ttl():
+    return getattr(settings, "CATALOG_CACHE_TTL", 3600)
+
+
+def get_artist(name, mbid=""):
+    artist = None
+    if mbid:
+        artist = Artist.objects.filter(mbid=mbid).first()
+    if artist is None:
+        # get_or_create re-reads the row when a concurrent insert wins the unique key
+        artist, _ = Artist.objects.get_or_create(name_key=normalize(name), defaults={"name": name, "mbid": mbid})
+    if mbid and not artist.mbid:
+        Artist.objects.filter(pk=artist.pk).update(mbid=mbid)
+        artist.mbid = mbid
+    return artist
+
+
+def get_track(title, artist_name, song_mbid="", artist_mbid="", popularity=0):
+    """
+    Catalog Track for a song, created on first use.
+
+    Tracks are found by MBID when one is given, otherwise by normalized
+    (artist, title). Found tracks are cached for CATALOG_CACHE_TTL seconds, so
+    adding a popular song again costs no catalog query. A non-zero popularity
+    or a newly known MBID is written back to the catalog.
+    """
+    lookup_key = track_key(title, artist_name)
+    track = cached = cache.get(_cache_key(lookup_key))
+
+    if track is None and song_mbid:
+        track = Track.objects.select_related("artist").filter(mbid=song_mbid).first()
+    if track is None:
+        track = Track.objects.select_related("artist").filter(lookup_key=lookup_key).first()
+    if track is None:
+        artist = get_artist(artist_name, artist_mbid)
+        track, _ = Track.objects.get_or_create(
+            lookup_key=lookup_key,
+            defaults={"artist": artist, "title": title, "mbid": song_mbid, "popularity": popularity},
+        )
+        if track.artist_id == artist.pk:
+            track.artist = artist
+
+    changes = {}
+    if song_mbid and not track.mbid:
+        changes["mbid"] = song_mbid
+    if popularity and popularity != track.popularity:
+        changes["popularity"] = popularity
+    if changes:
+        Track.objects.filter(pk=track.pk).update(**changes)
+        for field, value in changes.items():
+            setattr(track, field, value)
+
+    if cached is None or changes:
+        cache.set(_cache_key(lookup_key), track, _ttl())
+    return track
+
+
+#Helper, stored Spotify match of a track ({"id", "uri", "duration_ms"}), None when missing or past SPOTIFY_RESOLVE_TTL
+def spotify_match(track, now=None):
+    if not track.spotify_id or track.spotify_resolved_at is None:
+        return None
+    ttl = getattr(settings, "SPOTIFY_RESOLVE_TTL", 30 * 24 * 3600)
+    if ttl and (now or timezone.now()) - track.spotify_resolved_at > timedelta(seconds=ttl):
+        return None
+    return {"id": track.spotify_id, "uri": track.spotify_uri, "duration_ms": track.duration_ms}
+
+
+#Helper, store a Spotify search result on the catalog track, every session playing it reuses the match
+def save_spotify_match(track, match):
+    values = {
+        "spotify_id": match["id"],
+        "spotify_uri": match.get("uri") or f"spotify:track:{match['id']}",
+        "duration_ms": match.get("duration_ms"),
+        "spotify_resolved_at": timezone.now(),
+    }
+    Track.objects.filter(pk=track.pk).update(**values)
+    for field, value in values.items():
+        setattr(track, field, value)
+    cache.set(_cache_key(track.lookup_key), track, _ttl())
+    return spotify_match(track)
+
+
+#Helper, True while a search found nothing for the track (searched again after SPOTIFY_MISS_TTL)
+def spotify_unresolvable(track, now=None):
+    if track.spotify_id or track.spotify_resolved_at is None:
+        return False
+    ttl = getattr(settings, "SPOTIFY_MISS_TTL", 24 * 3600)
+    return not ttl or (now or timezone.now()) - track.spotify_resolved_at <= timedelta(seconds=ttl)
+
+
+def mark_spotify_unresolvable(track):
+    values = {"spotify_id": "", "spotify_uri": "", "duration_ms": None, "spotify_resolved_at": timezone.now()}
+    Track.objects.filter(pk=track.pk).update(**values)
+    for field, value in values.items():
+        setattr(track, field, value)
+    cache.set(_cache_key(track.lookup_key), track, _ttl())
@@ -0,0 +1,77 @@
+"""
+System checks for the settings the api app relies on (`python manage.py check`).
+
+Several features keep their cross-process state in the Django cache. The
+default local-memory cache belongs to one process, so with several worker
+processes they need a shared CACHE_BACKEND (redis, memcached, database).
+The same goes for the events broker of the live updates (EVENTS_BROKER).
+"""
+from django.conf import settings
+from django.core.checks import Error, Warning, register
+
+# cache backends whose entries only the process that wrote them sees
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+# events brokers whose subscribers only get what their own process published
+PROCESS_LOCAL_BROKERS = (
+    'api.events.LocalBroker',
+)
+
+
+#Helper, do all worker processes see the same Django cache
+def cache_is_shared():
+    return settings.CACHES['default']['BACKEND'] not in PROCESS_LOCAL_CACHES
+
+
+@register(deploy=True)
+def check_session_cache(app_configs, **kwargs):
+    if getattr(settings, 'SESSION_CACHE_TTL', 30) > 0 and not cache_is_shared():
+        return [Warning(
+            'The session cache is off: its invalidations would not reach other worker processes '
+            'through a process-local cache.',
+            hint='Set CACHE_BACKEND to a shared backend (redis, memcached), or SESSION_CACHE_TTL=0 '
+                 'to silence this.',
+            id='api.W001',
+        )]
+    return []
+
+
+@register()
+def check_replica_cache(app_configs, **kwargs):
+    # a session's reads stay on the primary after a write through a cache key, every worker must see it
+    if getattr(settings, 'API_DB_REPLICAS', {}) and not cache_is_shared():
+        return [Error(
+            'Read replicas need a shared cache: with a process-local one, a session that wrote on one '
+            'worker process reads a lagging replica on the others.',
+            hint='Set CACHE_BACKEND to a shared backend (redis, memcached), or drop API_DB_REPLICA_HOSTS.',
+            id='api.E001',
+        )]
+    return []
+
+
+@register(deploy=True)
+def check_lock_cache(app_configs, **kwargs):
+    if not cache_is_shared():
+        return [Warning(
+            'The auto-advance and Spotify token refresh locks only hold within one process with a '
+            'process-local cache, several worker processes may advance or refresh the same session twice.',
+            hint='Run one server process, or set CACHE_BACKEND to a shared backend (redis, memcached).',
+            id='api.W002',
+        )]
+    return []
+
+
+@register(deploy=True)
+def check_events_broker(app_configs, **kwargs):
+    if getattr(settings, 'EVENTS_BROKER', 'api.events.LocalBroker') in PROCESS_LOCAL_BROKERS:
+        return [Warning(
+            'The live updates broker keeps its subscribers in process memory: with several worker '
+            'processes, pages miss the edits made through the other workers, and the last_event_id '
+            'of /api/snapshot/ only means something on the worker that answered it.',
+            hint='Run one server process, or set EVENTS_BROKER to a broker shared by all workers.',
+            id='api.W003',
+        )]
+    return []
@@ -0,0 +1,181 @@
+import asyncio
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .models import Song
+from .routers import for_session
+
+# list name -> sequence field, the order events carry [[song id, position], ...] per list
+LIST_FIELDS = {"playlist": "playlist_sequence", "vibe": "vibe_sequence"}
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class LocalBroker:
+    """
+    In-process event broker, enough for a single server process.
+
+    Subscribers are asyncio queues on the server's event loop, publish() may be
+    called from any thread (views, the playback scheduler). The last
+    EVENTS_BACKLOG events of every session are kept, so a client that
+    reconnects with Last-Event-ID gets what it missed. A subscriber that falls
+    EVENTS_QUEUE_SIZE events behind is dropped and resumes the same way.
+
+    Only sessions someone watches want events: while they have subscribers,
+    and for EVENTS_BACKLOG_TTL seconds after the last one left or a page read
+    the session's snapshot (a reconnect, a page about to subscribe). Then
+    their backlog is dropped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._last_id = 0
+        self._subscribers = defaultdict(set)  # session_id -> {(loop, queue)}
+        self._backlog = defaultdict(lambda: deque(maxlen=_setting("EVENTS_BACKLOG", 100)))
+        self._idle = OrderedDict()  # session_id -> monotonic time it was last watched, oldest first
+
+    # sessions without subscribers unwatched for EVENTS_BACKLOG_TTL seconds lose their backlog (holds _lock)
+    def _expire(self):
+        deadline = time.monotonic() - _setting("EVENTS_BACKLOG_TTL", 60)
+        while self._idle and next(iter(self._idle.values())) < deadline:
+            session_id, _ = self._idle.popitem(last=False)
+            self._backlog.pop(session_id, None)
+
+    # holds _lock
+    def _watched(self, session_id):
+        self._idle[session_id] = time.monotonic()
+        self._idle.move_to_end(session_id)
+
+    def wanted(self, session_id):
+        """Is anyone watching the session (skip building events nobody reads)"""
+        with self._lock:
+            self._expire()
+            return session_id in self._subscribers or session_id in self._idle
+
+    def publish(self, session_id, event_type, data):
+        with self._lock:
+            self._expire()
+            event = {"id": next(self._ids), "type": event_type, "data": data}
+            self._last_id = event["id"]
+            self._backlog[session_id].append(event)
+            subscribers = list(self._subscribers.get(session_id, ()))
+            if not subscribers and session_id not in self._idle:
+                self._watched(session_id)  # its backlog expires like an unwatched session's
+        for subscription in subscribers:
+            try:
+                subscription[0].call_soon_threadsafe(self._deliver, session_id, subscription, event)
+            except RuntimeError:  # loop already closed
+                self.unsubscribe(session_id, subscription)
+        metrics.increment("events.published")
+        return event
+
+    def _deliver(self, session_id, subscription, event):
+        queue = subscription[1]
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # too far behind: end the stream (None), the client reconnects with Last-Event-ID
+            metrics.increment("events.dropped_subscribers")
+            self.unsubscribe(session_id, subscription)
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+    def subscribe(self, session_id, last_event_id=None):
+        """Register the calling event loop, returns (subscription, queue, missed events)"""
+        queue = asyncio.Queue(maxsize=_setting("EVENTS_QUEUE_SIZE", 100))
+        subscription = (asyncio.get_running_loop(), queue)
+        with self._lock:
+            self._subscribers[session_id].add(subscription)
+            self._idle.pop(session_id, None)
+            missed = [event for event in self._backlog.get(session_id, ())
+                      if last_event_id is not None and event["id"] > last_event_id]
+        metrics.increment("events.subscribed")
+        return subscription, queue, missed
+
+    def unsubscribe(self, session_id, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(session_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[session_id]
+                    self._watched(session_id)  # keep its backlog for a reconnect
+
+    def last_event_id(self, session_id=None):
+        """
+        Id of the newest event, a page that loaded its state now resumes the
+        stream from here. The session is watched until that page subscribes.
+        """
+        with self._lock:
+            if session_id is not None and session_id not in self._subscribers:
+                self._watched(session_id)
+            return self._last_id
+
+    def forget(self, session_id):
+        with self._lock:
+            self._backlog.pop(session_id, None)
+            self._idle.pop(session_id, None)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+#Helper, the process broker (EVENTS_BROKER, default api.events.LocalBroker)
+def broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(_setting("EVENTS_BROKER", "api.events.LocalBroker"))()
+    return _broker
+
+
+def list_order(session_id, list_type):
+    field = LIST_FIELDS[list_type]
+    with for_session(session_id):
+        return [list(row) for row in Song.objects.filter(session_id=session_id, **{f"{field}__gt": 0})
+                .order_by(field).values_list("id", field)]
+
+
+#Helper, tell the session's subscribers what changed, with the new order of the touched lists
+# (nothing is built or sent when no one watches the session, e.g. always under WSGI)
+def notify(session_id, event_type, lists=(), **data):
+    if not broker().wanted(str(session_id)):
+        return None
+    if lists:
+        data["order"] = {list_type: list_order(session_id, list_type) for list_type in lists}
+    return broker().publish(str(session_id), event_type, data)
+
+
+# last song started per session, for /api/snapshot/ (kept for the length of the song and a minute)
+def _now_playing_key(session_id):
+    return f"fnt:now-playing:{session_id}"
+
+
+#Helper, a song started (NextSong, Spotify's queue): keep it and tell the open pages
+def song_started(session_id, song):
+    seconds = (song.get("duration_ms") or 0) / 1000 + 60
+    cache.set(_now_playing_key(session_id), {**song, "started_at": timezone.now().isoformat()}, seconds)
+    return notify(session_id, "now_playing", lists=("playlist",), song=song)
+
+
+def now_playing(session_id):
+    return cache.get(_now_playing_key(session_id))
+
+
+def format_event(event):
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from api.reaper import reap
+
+
+class Command(BaseCommand):
+    help = "Delete expired sessions and their songs in small batches (SESSION_IDLE_TIMEOUT / SESSION_MAX_AGE)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="Rows per DELETE (default REAPER_BATCH_SIZE)")
+        parser.add_argument("--pause", type=float, help="Seconds between batches (default REAPER_BATCH_PAUSE)")
+
+    def handle(self, *args, batch_size=None, pause=None, **options):
+        reclaimed = reap(batch_size=batch_size, pause=pause)
+        self.stdout.write(self.style.SUCCESS(
+            f"deleted {reclaimed['sessions']} session(s), {reclaimed['songs']} song(s) "
+            f"and {reclaimed['history']} history row(s)"
+        ))
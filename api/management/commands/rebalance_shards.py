@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.models import PlayedSong, Session, Song
+from api.routers import shard_for, shards
+from api.session_cache import invalidate_session
+
+
+class Command(BaseCommand):
+    help = (
+        "Move every session, its songs and play history to the shard its session_id hashes to. "
+        "Run it right after changing API_SHARDS, before traffic reaches the new layout."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only list the sessions that would move")
+
+    def handle(self, *args, dry_run=False, **options):
+        moved = 0
+        for source in shards():
+            # ids are collected first, the loop below deletes from the queryset's table
+            session_ids = list(Session.objects.using(source).values_list("session_id", flat=True))
+            for session_id in session_ids:
+                target = shard_for(session_id)
+                if target == source:
+                    continue
+                self.stdout.write(f"{session_id}: {source} -> {target}")
+                if not dry_run:
+                    self.move_session(session_id, source, target)
+                moved += 1
+
+        verb = "would move" if dry_run else "moved"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {moved} session(s) across {len(shards())} shard(s)"))
+
+    def move_session(self, session_id, source, target):
+        # target is the inner transaction so it commits first, if the source commit fails the
+        # session still exists on the source and the next run copies it again
+        with transaction.atomic(using=source), transaction.atomic(using=target):
+            session = Session.objects.using(source).select_for_update().get(pk=session_id)
+            children = {
+                model: list(model.objects.using(source).filter(session_id=session_id).order_by("id"))
+                for model in (Song, PlayedSong)
+            }
+
+            # leftovers of an interrupted run
+            for model in children:
+                model.objects.using(target).filter(session_id=session_id).delete()
+            Session.objects.using(target).filter(pk=session_id).delete()
+
+            # auto_now_add stamps the insert time, keep the original
+            created_date = session.created_date
+            session.save(using=target, force_insert=True)
+            Session.objects.using(target).filter(pk=session_id).update(created_date=created_date)
+            # row ids are per database, the target hands out new ones
+            for model, rows in children.items():
+                for row in rows:
+                    row.pk = None
+                model.objects.using(target).bulk_create(rows)
+                model.objects.using(source).filter(session_id=session_id).delete()
+
+            Session.objects.using(source).filter(pk=session_id).delete()
+        invalidate_session(session_id)
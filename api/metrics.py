@@ -0,0 +1,33 @@
+import threading
+from collections import Counter
+
+# Process-wide counters (db routing, caches, Spotify calls), read through /api/metrics/
+_counters = Counter()
+_lock = threading.Lock()
+
+
+#Helper, add to a named counter
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+#Helper, record a duration: <name>.count, <name>.total_ms (average = total / count) and <name>.max_ms
+def timing(name, milliseconds):
+    milliseconds = round(milliseconds)
+    with _lock:
+        _counters[f"{name}.count"] += 1
+        _counters[f"{name}.total_ms"] += milliseconds
+        if milliseconds > _counters[f"{name}.max_ms"]:
+            _counters[f"{name}.max_ms"] = milliseconds
+
+
+#Helper, copy of all counters
+def snapshot():
+    with _lock:
+        return dict(sorted(_counters.items()))
+
+
+def reset():
+    with _lock:
+        _counters.clear()
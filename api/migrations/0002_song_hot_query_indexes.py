@@ -0,0 +1,35 @@
+# Generated by Django 5.2.6 on 2026-10-19 10:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='song',
+            name='session',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='api.session'),
+        ),
+        migrations.AddIndex(
+            model_name='song',
+            index=models.Index(fields=['session', 'playlist_sequence'], name='song_session_playlist_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='song',
+            index=models.Index(fields=['session', 'vibe_sequence'], name='song_session_vibe_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='song',
+            index=models.Index(fields=['session', 'playlist_hist_sequence'], name='song_session_hist_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='song',
+            index=models.Index(fields=['session', 'song_title', 'artist_name'], name='song_session_title_artist_idx'),
+        ),
+    ]
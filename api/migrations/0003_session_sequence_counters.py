@@ -0,0 +1,47 @@
+# Generated by Django 5.2.6 on 2026-10-19 10:37
+
+from django.db import migrations, models
+
+
+def backfill_counters(apps, schema_editor):
+    Session = apps.get_model('api', 'Session')
+    Song = apps.get_model('api', 'Song')
+    db_alias = schema_editor.connection.alias
+
+    for session in Session.objects.using(db_alias).all():
+        songs = Song.objects.using(db_alias).filter(session=session)
+        maxes = songs.aggregate(
+            playlist=models.Max('playlist_sequence'),
+            vibe=models.Max('vibe_sequence'),
+            hist=models.Max('playlist_hist_sequence'),
+        )
+        session.next_playlist_sequence = (maxes['playlist'] or 0) + 1
+        session.next_vibe_sequence = (maxes['vibe'] or 0) + 1
+        session.next_hist_sequence = (maxes['hist'] or 0) + 1
+        session.save(update_fields=['next_playlist_sequence', 'next_vibe_sequence', 'next_hist_sequence'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_song_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='next_hist_sequence',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='next_playlist_sequence',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='next_vibe_sequence',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.6 on 2026-10-19 10:52
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+# existing sessions count as idle since they were created, so the reaper can clear the backlog
+def backfill_last_active(apps, schema_editor):
+    Session = apps.get_model('api', 'Session')
+    db_alias = schema_editor.connection.alias
+    Session.objects.using(db_alias).update(last_active=models.F('created_date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_session_sequence_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='last_active',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='session',
+            name='created_date',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.RunPython(backfill_last_active, migrations.RunPython.noop),
+    ]
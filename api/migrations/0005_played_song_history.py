@@ -0,0 +1,71 @@
+# Generated by Django 5.2.6 on 2026-10-19 10:54
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+# move played songs out of Song: history rows are renumbered 1..n per session in play order,
+# songs that are still in the vibe list stay in Song (out of the playlist)
+def archive_played_songs(apps, schema_editor):
+    Session = apps.get_model('api', 'Session')
+    Song = apps.get_model('api', 'Song')
+    PlayedSong = apps.get_model('api', 'PlayedSong')
+    db_alias = schema_editor.connection.alias
+
+    for session in Session.objects.using(db_alias).all():
+        played = list(
+            Song.objects.using(db_alias)
+            .filter(session=session, playlist_hist_sequence__gt=0)
+            .order_by('playlist_hist_sequence', 'id')
+        )
+        if not played:
+            continue
+        PlayedSong.objects.using(db_alias).bulk_create([
+            PlayedSong(
+                session=session,
+                sequence=position,
+                artist_id=song.artist_id,
+                artist_name=song.artist_name,
+                song_id=song.song_id,
+                song_title=song.song_title,
+                played_at=session.last_active,
+            )
+            for position, song in enumerate(played, start=1)
+        ])
+        ids = [song.id for song in played]
+        Song.objects.using(db_alias).filter(id__in=ids, vibe_sequence__gt=0).update(
+            playlist_sequence=0, playlist_hist_sequence=0
+        )
+        Song.objects.using(db_alias).filter(id__in=ids).exclude(vibe_sequence__gt=0).delete()
+        session.next_hist_sequence = len(played) + 1
+        session.save(update_fields=['next_hist_sequence'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_session_expiry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlayedSong',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('sequence', models.IntegerField()),
+                ('artist_id', models.CharField(max_length=128)),
+                ('artist_name', models.CharField(max_length=255)),
+                ('song_id', models.CharField(max_length=128)),
+                ('song_title', models.CharField(max_length=255)),
+                ('spotify_track_id', models.CharField(blank=True, default='', max_length=64)),
+                ('played_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('session', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='api.session')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['session', 'song_title', 'artist_name'], name='played_title_artist_idx')],
+                'constraints': [models.UniqueConstraint(fields=('session', 'sequence'), name='played_session_sequence_uniq')],
+            },
+        ),
+        migrations.RunPython(archive_played_songs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,143 @@
+# Generated by Django 5.2.6 on 2026-10-19 11:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def normalize(value):
+    return " ".join((value or "").casefold().split())
+
+
+# point every song and history row of this database at a catalog Track,
+# the catalog database (API_CATALOG_DB) has to be migrated before the other shards
+def link_catalog(apps, schema_editor):
+    Artist = apps.get_model('api', 'Artist')
+    Track = apps.get_model('api', 'Track')
+    Song = apps.get_model('api', 'Song')
+    PlayedSong = apps.get_model('api', 'PlayedSong')
+    db_alias = schema_editor.connection.alias
+    catalog_alias = getattr(settings, 'API_CATALOG_DB', 'api')
+
+    tracks = {}
+    for model in (Song, PlayedSong):
+        for row in list(model.objects.using(db_alias).filter(track__isnull=True)):
+            lookup_key = f"{normalize(row.artist_name)}\x1f{normalize(row.song_title)}"
+            if lookup_key not in tracks:
+                artist, _ = Artist.objects.using(catalog_alias).get_or_create(
+                    name_key=normalize(row.artist_name),
+                    defaults={'name': row.artist_name, 'mbid': row.artist_id},
+                )
+                tracks[lookup_key], _ = Track.objects.using(catalog_alias).get_or_create(
+                    lookup_key=lookup_key,
+                    defaults={
+                        'artist_id': artist.pk,
+                        'title': row.song_title,
+                        'mbid': row.song_id,
+                        'popularity': getattr(row, 'song_popularity', 0),
+                    },
+                )
+            model.objects.using(db_alias).filter(pk=row.pk).update(track_id=tracks[lookup_key].pk)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_played_song_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Artist',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('mbid', models.CharField(blank=True, db_index=True, default='', max_length=128)),
+                ('name', models.CharField(max_length=255)),
+                ('name_key', models.CharField(max_length=255, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Track',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('mbid', models.CharField(blank=True, db_index=True, default='', max_length=128)),
+                ('title', models.CharField(max_length=255)),
+                ('popularity', models.IntegerField(default=0)),
+                ('lookup_key', models.CharField(max_length=512, unique=True)),
+                ('artist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tracks', to='api.artist')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='song',
+            name='track',
+            field=models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.track'),
+        ),
+        migrations.AddField(
+            model_name='playedsong',
+            name='track',
+            field=models.ForeignKey(db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.track'),
+        ),
+        migrations.RunPython(link_catalog, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='song',
+            name='song_session_title_artist_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='playedsong',
+            name='played_title_artist_idx',
+        ),
+        migrations.RemoveField(
+            model_name='song',
+            name='artist_id',
+        ),
+        migrations.RemoveField(
+            model_name='song',
+            name='artist_name',
+        ),
+        migrations.RemoveField(
+            model_name='song',
+            name='song_id',
+        ),
+        migrations.RemoveField(
+            model_name='song',
+            name='song_popularity',
+        ),
+        migrations.RemoveField(
+            model_name='song',
+            name='song_title',
+        ),
+        migrations.RemoveField(
+            model_name='playedsong',
+            name='artist_id',
+        ),
+        migrations.RemoveField(
+            model_name='playedsong',
+            name='artist_name',
+        ),
+        migrations.RemoveField(
+            model_name='playedsong',
+            name='song_id',
+        ),
+        migrations.RemoveField(
+            model_name='playedsong',
+            name='song_title',
+        ),
+        migrations.AlterField(
+            model_name='song',
+            name='track',
+            field=models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.track'),
+        ),
+        migrations.AlterField(
+            model_name='playedsong',
+            name='track',
+            field=models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='api.track'),
+        ),
+        migrations.AddIndex(
+            model_name='song',
+            index=models.Index(fields=['session', 'track'], name='song_session_track_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='playedsong',
+            index=models.Index(fields=['session', 'track'], name='played_session_track_idx'),
+        ),
+    ]
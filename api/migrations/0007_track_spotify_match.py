@@ -0,0 +1,33 @@
+# Generated by Django 5.2.6 on 2026-10-19 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_track_catalog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='track',
+            name='duration_ms',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='track',
+            name='spotify_id',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='track',
+            name='spotify_resolved_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='track',
+            name='spotify_uri',
+            field=models.CharField(blank=True, default='', max_length=128),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-19 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_track_spotify_match'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='spotify_played_cursor',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='track',
+            name='spotify_id',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+    ]
@@ -1,32 +1,118 @@
 from django.db import models
+from django.utils import timezone
+
+from .routers import for_session
+
+
+# create() routes the new row to its session's shard, other queries use the bound session (api/routers.py)
+class ShardedManager(models.Manager):
+    def create(self, **kwargs):
+        session = kwargs.get('session')
+        session_id = kwargs.get('session_id') or kwargs.get('pk') or getattr(session, 'pk', None)
+        if not session_id:
+            return super().create(**kwargs)
+        with for_session(session_id):
+            return super().create(**kwargs)
+
 
 class Session(models.Model):
     session_id = models.CharField(max_length=128, primary_key=True)
-    created_date = models.DateTimeField(auto_now_add=True)
+    created_date = models.DateTimeField(auto_now_add=True, db_index=True)
     is_active = models.BooleanField(default=True)
+    last_active = models.DateTimeField(default=timezone.now, db_index=True)  # bumped at most every SESSION_TOUCH_INTERVAL (see reaper)
     
     # Spotify token fields
     spotify_access_token = models.TextField(null=True, blank=True)
     spotify_refresh_token = models.TextField(null=True, blank=True)
     spotify_token_expires = models.DateTimeField(null=True, blank=True)
     spotify_user_id = models.CharField(max_length=255, null=True, blank=True)
+
+    # next free list positions (see sequence_helpers), avoids MAX() over the session's songs
+    next_playlist_sequence = models.IntegerField(default=1)
+    next_vibe_sequence = models.IntegerField(default=1)
+    next_hist_sequence = models.IntegerField(default=1)
+
+    # Spotify recently-played cursor (ms), plays up to here are folded into the history (see recent_sync)
+    spotify_played_cursor = models.BigIntegerField(null=True, blank=True)
+
+    objects = ShardedManager()
     
     def __str__(self):
         return self.session_id
     
+# Global catalog, shared by all sessions and kept on one database (API_CATALOG_DB, see catalog.py)
+class Artist(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    mbid = models.CharField(max_length=128, blank=True, default='', db_index=True)  # MusicBrainz id, when Last.fm has one
+    name = models.CharField(max_length=255)
+    name_key = models.CharField(max_length=255, unique=True)  # normalized name
+
+    def __str__(self):
+        return self.name
+
+
+class Track(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    artist = models.ForeignKey(Artist, on_delete=models.CASCADE, related_name='tracks')
+    mbid = models.CharField(max_length=128, blank=True, default='', db_index=True)
+    title = models.CharField(max_length=255)
+    popularity = models.IntegerField(default=0)
+    lookup_key = models.CharField(max_length=512, unique=True)  # normalized (artist, title)
+    # Spotify match, found by the first play of the track in any session (see catalog.spotify_match)
+    spotify_id = models.CharField(max_length=64, blank=True, default='', db_index=True)  # recently-played lookups
+    spotify_uri = models.CharField(max_length=128, blank=True, default='')
+    duration_ms = models.IntegerField(null=True, blank=True)
+    spotify_resolved_at = models.DateTimeField(null=True, blank=True)  # searched again after SPOTIFY_RESOLVE_TTL
+
+    def __str__(self):
+        return self.title
+
+
 class Song(models.Model):
     id = models.BigAutoField(primary_key=True)  # active sessions only
-    session = models.ForeignKey(Session, on_delete=models.CASCADE)  # which session song belongs to
-    artist_id = models.CharField(max_length=128)  # artist_id
-    artist_name = models.CharField(max_length=255)
-    song_id = models.CharField(max_length=128)
-    song_title = models.CharField(max_length=255)
-    song_popularity = models.IntegerField(default=0)
+    session = models.ForeignKey(Session, on_delete=models.CASCADE, db_index=False)  # which session song belongs to (indexed via Meta.indexes)
+    # catalog entry (artist, title, MBIDs, popularity), may live on another database, so no FK constraint
+    track = models.ForeignKey(Track, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False, related_name='+')
     vibe_sequence = models.IntegerField(null=True, blank=True)  # priority in which this influences song selection
     playlist_sequence = models.IntegerField(null=True, blank=True)  # sequence in which song are played
     playlist_hist_sequence = models.IntegerField(null=True, blank=True)  # song history sequence
     is_playing = models.BooleanField(default=False)  # song playing
     is_played = models.BooleanField(default=False)  # song played
-    
+
+    objects = ShardedManager()
+
+    class Meta:
+        # every hot query filters by session first, so session leads each index
+        # (this also covers the plain FK lookup, hence db_index=False above)
+        indexes = [
+            models.Index(fields=['session', 'playlist_sequence'], name='song_session_playlist_idx'),
+            models.Index(fields=['session', 'vibe_sequence'], name='song_session_vibe_idx'),
+            models.Index(fields=['session', 'playlist_hist_sequence'], name='song_session_hist_idx'),
+            models.Index(fields=['session', 'track'], name='song_session_track_idx'),
+        ]
+
+    def __str__(self):
+        return f"Song {self.id} (track {self.track_id})"
+
+
+# Append-only play history, one row per track NextSongView played (keeps history out of Song)
+class PlayedSong(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    session = models.ForeignKey(Session, on_delete=models.CASCADE, db_index=False)  # indexed via Meta
+    sequence = models.IntegerField()  # position in the session's history (next_hist_sequence)
+    track = models.ForeignKey(Track, on_delete=models.DO_NOTHING, db_constraint=False, db_index=False, related_name='+')
+    spotify_track_id = models.CharField(max_length=64, blank=True, default='')
+    played_at = models.DateTimeField(default=timezone.now)
+
+    objects = ShardedManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'sequence'], name='played_session_sequence_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['session', 'track'], name='played_session_track_idx'),
+        ]
+
     def __str__(self):
-        return self.song_title
\ No newline at end of file
+        return f"Played {self.sequence} (track {self.track_id})"
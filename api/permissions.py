@@ -0,0 +1,19 @@
+import hmac
+
+from django.conf import settings
+from rest_framework.permissions import BasePermission
+
+
+class MetricsAccess(BasePermission):
+    """
+    /api/metrics/ is for operators: staff users (Django admin login, basic
+    auth), or a scraper sending `Authorization: Bearer <METRICS_TOKEN>` when
+    that setting is set.
+    """
+
+    def has_permission(self, request, view):
+        if request.user and request.user.is_staff:
+            return True
+        token = getattr(settings, "METRICS_TOKEN", "")
+        sent = request.headers.get("Authorization", "")
+        return bool(token) and hmac.compare_digest(sent.encode(), f"Bearer {token}".encode())
@@ -0,0 +1,192 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from spotify_api import client as spotify, limiter
+from spotify_api.tokens import ensure_fresh_token
+
+from . import metrics, queue_ahead
+from .routers import for_session
+from .session_cache import get_session
+
+logger = logging.getLogger(__name__)
+
+# one plan per session: {"track_id", "fire_at" (time.monotonic()), "generation"}
+_plans = {}
+_heap = []  # (fire_at, generation, session_id), entries of replaced plans are skipped
+_counter = itertools.count()
+_cond = threading.Condition()
+_thread = None
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# sessions with auto-advance on, in the shared cache so every worker process schedules them
+def _enabled_key(session_id):
+    return f"fnt:auto-advance:{session_id}"
+
+
+def auto_advance_enabled(session_id):
+    return bool(cache.get(_enabled_key(session_id)))
+
+
+def set_auto_advance(session_id, enabled):
+    if enabled:
+        cache.set(_enabled_key(session_id), True, None)
+    else:
+        cache.delete(_enabled_key(session_id))
+        cancel(session_id)
+
+
+def plan_for(session_id):
+    with _cond:
+        plan = _plans.get(session_id)
+        return dict(plan) if plan else None
+
+
+def _schedule(session_id, track_id, remaining_ms):
+    # fire SCHEDULER_LEAD_MS before the end, the next song then starts right as this one ends,
+    # with songs in Spotify's queue (queue_ahead) Spotify moves on itself: look SCHEDULER_LEAD_MS after it
+    lead = _setting("SCHEDULER_LEAD_MS", 1000)
+    if queue_ahead.queued(session_id):
+        lead = -lead
+    delay = max(remaining_ms - lead, 0) / 1000
+    with _cond:
+        generation = next(_counter)
+        _plans[session_id] = {"track_id": track_id, "fire_at": time.monotonic() + delay, "generation": generation}
+        heapq.heappush(_heap, (_plans[session_id]["fire_at"], generation, session_id))
+        _cond.notify()
+    _start_worker()
+    metrics.increment("playback.scheduled")
+    return delay
+
+
+def cancel(session_id):
+    with _cond:
+        _plans.pop(session_id, None)
+
+
+#Helper, NextSongView started a track: plan its end from the catalog duration, no Spotify read
+def track_started(session_id, track_id, duration_ms):
+    if duration_ms and auto_advance_enabled(session_id):
+        _schedule(session_id, track_id, duration_ms)
+
+
+#Helper, one read of the player: {"is_playing", "track_id", "progress_ms", "duration_ms"}, None if idle
+def read_playback(access_token):
+    try:
+        r = spotify.get("/me/player/currently-playing", headers={"Authorization": f"Bearer {access_token}"},
+                        priority=limiter.PLAYBACK)
+    except requests.RequestException:
+        return None
+    if r.status_code != 200:
+        return None
+    data = r.json()
+    item = data.get("item") or {}
+    if not item:
+        return None
+    return {
+        "is_playing": bool(data.get("is_playing")),
+        # relinked tracks report the catalog id in linked_from
+        "track_id": (item.get("linked_from") or {}).get("id") or item.get("id"),
+        "progress_ms": data.get("progress_ms") or 0,
+        "duration_ms": item.get("duration_ms") or 0,
+    }
+
+
+def _plan_from(session_id, state):
+    if state is None or not state["is_playing"] or not auto_advance_enabled(session_id):
+        cancel(session_id)
+        return None
+    return _schedule(session_id, state["track_id"], state["duration_ms"] - state["progress_ms"])
+
+
+def sync(session):
+    """
+    Re-read the player after a user action and plan the next advance from it.
+
+    Returns the playback state with "advance_in_ms", the time until the
+    scheduler moves to the next song (None when nothing is planned).
+    """
+    state = read_playback(ensure_fresh_token(session))
+    metrics.increment("playback.synced")
+    if state is not None and state["is_playing"] and not queue_ahead.observe(session, state):
+        queue_ahead.fill(session)
+    delay = _plan_from(session.session_id, state)
+    state = dict(state or {"is_playing": False})
+    state["auto_advance"] = auto_advance_enabled(session.session_id)
+    state["advance_in_ms"] = None if delay is None else round(delay * 1000)
+    return state
+
+
+def _advance(session_id, track_id):
+    session = get_session(session_id)
+    if session is None or not session.is_active:
+        cancel(session_id)
+        return
+    # one read per track, only to catch pauses, seeks and skips made in the Spotify app
+    state = read_playback(ensure_fresh_token(session))
+    if state is None or not state["is_playing"]:
+        cancel(session_id)
+        return
+    if queue_ahead.observe(session, state):
+        # Spotify moved on to the song we queued, the playlist has caught up
+        _plan_from(session_id, state)
+        return
+    remaining = state["duration_ms"] - state["progress_ms"]
+    expected = _setting("SCHEDULER_LEAD_MS", 1000) + _setting("SCHEDULER_DRIFT_MS", 2000)
+    if state["track_id"] != track_id or remaining > expected or queue_ahead.queued(session_id):
+        # drifted, or Spotify has not reached the end and will play its queue by itself
+        metrics.increment("playback.drift")
+        _plan_from(session_id, state)
+        return
+
+    # another worker process may hold a plan for the same track
+    if not cache.add(f"fnt:advanced:{session_id}:{track_id}", True, 60):
+        cancel(session_id)
+        return
+    from .views import NextSongView  # views import this module
+    with for_session(session_id):
+        response = NextSongView().play_next(session)
+    if response.status_code == 200:
+        metrics.increment("playback.advanced")
+    else:
+        # empty playlist or Spotify refused, the next sync starts over
+        metrics.increment("playback.advance_failed")
+        cancel(session_id)
+
+
+def _run_forever():
+    while True:
+        with _cond:
+            while not _heap or _heap[0][0] > time.monotonic():
+                _cond.wait(_heap[0][0] - time.monotonic() if _heap else None)
+            _, generation, session_id = heapq.heappop(_heap)
+            plan = _plans.get(session_id)
+            if plan is None or plan["generation"] != generation:
+                continue
+            del _plans[session_id]
+        try:
+            _advance(session_id, plan["track_id"])
+        except Exception:
+            metrics.increment("playback.errors")
+            logger.exception("auto-advance of session %s failed", session_id)
+        finally:
+            connections.close_all()
+
+
+def _start_worker():
+    global _thread
+    with _cond:
+        if _thread is None:
+            _thread = threading.Thread(target=_run_forever, name="fnt-playback-scheduler", daemon=True)
+            _thread.start()
@@ -0,0 +1,146 @@
+"""
+Queue-ahead mode (SPOTIFY_QUEUE_AHEAD > 0).
+
+The next SPOTIFY_QUEUE_AHEAD playlist songs are added to Spotify's own
+player queue, so Spotify moves from one song to the next without waiting
+for a play call from us. The server no longer drives each change, it
+reconciles its playlist when it sees the player on a queued song (playback
+sync, scheduler). Only songs with a stored Spotify match are queued, in
+playlist order.
+
+Spotify's queue cannot be edited through the Web API: a queued song plays
+even if it is reordered or removed afterwards here, so changes to the first
+SPOTIFY_QUEUE_AHEAD songs take effect once those have played.
+"""
+from urllib.parse import quote
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from spotify_api import client as spotify
+
+from . import metrics
+from .catalog import spotify_match
+from .events import song_started
+from .models import Song, Track
+from .routers import for_session
+from .sequence_helpers import mark_played
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# songs we put in the session's Spotify queue, oldest first: [{"song_id", "track_id", "spotify_id"}]
+def _key(session_id):
+    return f"fnt:spotify-queue:{session_id}"
+
+
+def queued(session_id):
+    return cache.get(_key(session_id)) or []
+
+
+def _save(session_id, entries):
+    if entries:
+        cache.set(_key(session_id), entries, 24 * 3600)
+    else:
+        cache.delete(_key(session_id))
+
+
+#Helper, the session's lists were cleared, stop reconciling the songs still in Spotify's queue
+def forget(session_id):
+    cache.delete(_key(session_id))
+
+
+#Helper, is this playlist song the next one Spotify plays from its queue
+def is_next(session_id, song_id):
+    entries = queued(session_id)
+    return bool(entries) and entries[0]["song_id"] == song_id
+
+
+#Helper, the queued head was started by a skip, drop it from the queued list
+def started(session_id, song_id):
+    entries = queued(session_id)
+    if entries and entries[0]["song_id"] == song_id:
+        _save(session_id, entries[1:])
+
+
+def fill(session):
+    """
+    Top the session's Spotify queue up to SPOTIFY_QUEUE_AHEAD songs.
+
+    Stops at the first song without a stored match (the resolver finds it
+    in the background, the next fill queues it) or the first refused call,
+    so the queue always follows the playlist order. Returns the songs added.
+    """
+    limit = _setting("SPOTIFY_QUEUE_AHEAD", 0)
+    session_id = session.session_id
+    entries = queued(session_id)
+    if limit <= 0 or not session.spotify_access_token or len(entries) >= limit:
+        return 0
+
+    in_queue = {entry["song_id"] for entry in entries}
+    with for_session(session_id):
+        songs = list(Song.objects.filter(session_id=session_id, playlist_sequence__gt=0)
+                     .order_by("playlist_sequence").values_list("id", "track_id")[:limit + len(entries)])
+    tracks = Track.objects.in_bulk([track_id for _, track_id in songs])
+
+    added = 0
+    headers = {"Authorization": f"Bearer {session.spotify_access_token}"}
+    for song_id, track_id in songs:
+        if len(entries) >= limit:
+            break
+        if song_id in in_queue:
+            continue
+        match = spotify_match(tracks[track_id]) if track_id in tracks else None
+        if not match:
+            break
+        try:
+            r = spotify.post(f"/me/player/queue?uri={quote(match['uri'])}", headers=headers)
+        except requests.RequestException:
+            break
+        if r.status_code not in (200, 204):
+            metrics.increment("playback.queue.refused")  # no active device, rate limited, ...
+            break
+        entries.append({"song_id": song_id, "track_id": track_id, "spotify_id": match["id"]})
+        added += 1
+    _save(session_id, entries)
+    metrics.increment("playback.queue.added", added)
+    return added
+
+
+def observe(session, state):
+    """
+    Reconcile the playlist with a player read: if Spotify has moved on to a
+    queued song, that song is played (and any queued song before it was
+    skipped in the Spotify app). Returns True when the playlist changed.
+    """
+    session_id = session.session_id
+    entries = queued(session_id)
+    spotify_ids = [entry["spotify_id"] for entry in entries]
+    if state is None or state.get("track_id") not in spotify_ids:
+        return False
+
+    position = spotify_ids.index(state["track_id"])
+    # the scheduler and a sync may see the same change, one of them reconciles
+    if not cache.add(f"fnt:queue-observed:{session_id}:{entries[position]['song_id']}", True, 60):
+        return True
+    for entry in entries[:position]:
+        mark_played(session_id, entry["song_id"], entry["track_id"], entry["spotify_id"], skipped=True)
+    playing = entries[position]
+    history_entry, _ = mark_played(session_id, playing["song_id"], playing["track_id"], playing["spotify_id"])
+    _save(session_id, entries[position + 1:])
+    metrics.increment("playback.queue.observed")
+
+    track = Track.objects.select_related("artist").get(pk=playing["track_id"])
+    song_started(session_id, {
+        "id": playing["song_id"],
+        "title": track.title,
+        "artist": track.artist.name,
+        "song_id": track.mbid,
+        "spotify_track_id": playing["spotify_id"],
+        "duration_ms": state.get("duration_ms") or track.duration_ms,
+        "history_sequence": history_entry.sequence,
+    })
+    fill(session)
+    return True
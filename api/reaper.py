@@ -0,0 +1,155 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+
+from . import events, metrics
+from .models import PlayedSong, Session, Song
+from .routers import shard_for, shards
+from .session_cache import invalidate_session
+
+logger = logging.getLogger(__name__)
+
+_thread = None
+_thread_lock = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+#Helper, record activity on a session (one UPDATE per SESSION_TOUCH_INTERVAL, not per request)
+def touch_session(session_id):
+    interval = _setting("SESSION_TOUCH_INTERVAL", 60)
+    if not cache.add(f"fnt:session-touch:{session_id}", True, interval):
+        return
+    # straight to the shard primary, a touch must not pin the session's reads to it
+    Session.objects.using(shard_for(session_id)).filter(session_id=session_id).update(last_active=timezone.now())
+
+
+#Helper, filter for sessions past their idle timeout or their maximum age (0 disables either)
+def expired_filter(now=None):
+    now = now or timezone.now()
+    condition = Q(pk__in=[])
+    idle = _setting("SESSION_IDLE_TIMEOUT", 6 * 3600)
+    max_age = _setting("SESSION_MAX_AGE", 7 * 24 * 3600)
+    if idle:
+        condition |= Q(last_active__lt=now - timedelta(seconds=idle))
+    if max_age:
+        condition |= Q(created_date__lt=now - timedelta(seconds=max_age))
+    return condition
+
+
+#Helper, is a loaded session past its idle timeout or maximum age (requests refuse it, reap() deletes it)
+def is_expired(session, now=None):
+    now = now or timezone.now()
+    idle = _setting("SESSION_IDLE_TIMEOUT", 6 * 3600)
+    max_age = _setting("SESSION_MAX_AGE", 7 * 24 * 3600)
+    if idle and session.last_active and session.last_active < now - timedelta(seconds=idle):
+        return True
+    return bool(max_age and session.created_date and session.created_date < now - timedelta(seconds=max_age))
+
+
+def reap(batch_size=None, pause=None, now=None):
+    """
+    Delete expired sessions with their songs and play history, shard by shard.
+
+    Child rows go in batches of batch_size rows with a pause between batches, so
+    every DELETE is a short transaction of its own and never holds the write
+    lock for long. A session is deactivated before its songs are removed, so
+    it cannot be used again half deleted. Returns the deleted row counts.
+    """
+    batch_size = batch_size or _setting("REAPER_BATCH_SIZE", 500)
+    pause = _setting("REAPER_BATCH_PAUSE", 0.2) if pause is None else pause
+    expired = expired_filter(now)
+    reclaimed = {"sessions": 0, "songs": 0, "history": 0}
+
+    def rest():
+        if pause:
+            time.sleep(pause)
+
+    for shard in shards():
+        while True:
+            session_ids = list(
+                Session.objects.using(shard).filter(expired).order_by("last_active")
+                .values_list("session_id", flat=True)[:batch_size]
+            )
+            if not session_ids:
+                break
+
+            for session_id in session_ids:
+                # re-check expiry, the session may have been used since it was selected
+                if not Session.objects.using(shard).filter(expired, pk=session_id).update(is_active=False):
+                    continue
+                invalidate_session(session_id)
+
+                for model, key in ((Song, "songs"), (PlayedSong, "history")):
+                    while True:
+                        row_ids = list(
+                            model.objects.using(shard).filter(session_id=session_id)
+                            .values_list("id", flat=True)[:batch_size]
+                        )
+                        if not row_ids:
+                            break
+                        deleted, _ = model.objects.using(shard).filter(id__in=row_ids).delete()
+                        reclaimed[key] += deleted
+                        metrics.increment(f"reaper.{key}_deleted", deleted)
+                        rest()
+
+                _, per_model = Session.objects.using(shard).filter(pk=session_id).delete()
+                deleted = per_model.get(Session._meta.label, 0)
+                reclaimed["sessions"] += deleted
+                metrics.increment("reaper.sessions_deleted", deleted)
+                invalidate_session(session_id)
+                events.broker().forget(session_id)
+            rest()
+
+    metrics.increment("reaper.runs")
+    return reclaimed
+
+
+def _run_forever(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            reclaimed = reap()
+            if reclaimed["sessions"]:
+                logger.info("reaped %(sessions)s sessions, %(songs)s songs, %(history)s history rows", reclaimed)
+        except Exception:
+            metrics.increment("reaper.errors")
+            logger.exception("session reaper failed")
+        finally:
+            connections.close_all()
+
+
+#Helper, start the reaper thread once per process (REAPER_THREAD=True, see start_on_first_request)
+def start_background_reaper():
+    global _thread
+    with _thread_lock:
+        if _thread is not None:
+            return _thread
+        _thread = threading.Thread(
+            target=_run_forever, args=(_setting("REAPER_INTERVAL", 300),),
+            name="fnt-session-reaper", daemon=True,
+        )
+        _thread.start()
+        return _thread
+
+
+REAPER_SIGNAL_UID = "fnt-session-reaper"
+
+
+#Helper, request_started receiver (ApiConfig.ready): a process serving requests starts the reaper
+def start_on_first_request(sender, **kwargs):
+    from django.test.client import AsyncClientHandler, ClientHandler
+    if issubclass(sender, (ClientHandler, AsyncClientHandler)):
+        return  # test clients (manage.py test) serve no one
+    request_started.disconnect(dispatch_uid=REAPER_SIGNAL_UID)
+    start_background_reaper()
@@ -0,0 +1,147 @@
+"""
+Incremental sync of Spotify's recently-played list into the session history.
+
+Each session remembers the recently-played cursor (Session.spotify_played_cursor,
+milliseconds), so a sync only asks Spotify for plays after it. New plays
+that NextSongView, the queue or a concurrent sync already recorded are
+skipped, the rest are appended to the history and their Song rows marked
+played, in one transaction (under the session's lock) together with the
+new cursor. A session's first sync starts at its creation, plays from
+before the session are not its history.
+"""
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.dateparse import parse_datetime
+from spotify_api import client as spotify
+
+from . import metrics
+from .catalog import get_track, save_spotify_match
+from .models import PlayedSong, Session, Song, Track
+from .routers import for_session
+from .sequence_helpers import HISTORY, allocate_sequence, song_transaction
+
+PAGE_SIZE = 50  # Spotify's maximum
+
+
+class RecentSyncError(Exception):
+    pass
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _millis(moment):
+    return int(moment.timestamp() * 1000)
+
+
+#Helper, new plays of a recently-played page, oldest first: [{"spotify_id", "played_at", "item"}]
+def _plays(payload):
+    plays = {}
+    for entry in payload.get("items") or []:
+        track = entry.get("track") or {}
+        played_at = parse_datetime(entry.get("played_at") or "")
+        if track.get("id") and played_at:
+            plays[(track["id"], played_at)] = {"spotify_id": track["id"], "played_at": played_at, "item": track}
+    return sorted(plays.values(), key=lambda play: play["played_at"])
+
+
+# plays we recorded ourselves, matched by track and time (ours: when we started it, Spotify's: the play)
+def _already_recorded(session_id, plays):
+    slack = timedelta(seconds=_setting("SPOTIFY_RECENT_MATCH_SLACK", 60))
+    with for_session(session_id):
+        recorded = list(PlayedSong.objects.filter(
+            session_id=session_id,
+            spotify_track_id__in={play["spotify_id"] for play in plays},
+            played_at__gte=plays[0]["played_at"] - timedelta(hours=1),
+        ).values_list("spotify_track_id", "played_at"))
+    new = []
+    for play in plays:
+        length = timedelta(milliseconds=play["item"].get("duration_ms") or 0)
+        match = next((entry for entry in recorded if entry[0] == play["spotify_id"] and
+                      play["played_at"] - length - slack <= entry[1] <= play["played_at"] + slack), None)
+        if match is None:
+            new.append(play)
+        else:
+            recorded.remove(match)  # one of our rows stands for one play
+    return new
+
+
+# catalog track of each Spotify id, new tracks are added with their Spotify match
+def _tracks(plays):
+    tracks = {track.spotify_id: track for track in Track.objects.filter(
+        spotify_id__in={play["spotify_id"] for play in plays})}
+    for play in plays:
+        spotify_id = play["spotify_id"]
+        if spotify_id not in tracks:
+            item = play["item"]
+            artists = item.get("artists") or [{}]
+            track = get_track(item.get("name") or spotify_id, artists[0].get("name") or "Unknown artist")
+            save_spotify_match(track, {"id": spotify_id, "uri": item.get("uri"), "duration_ms": item.get("duration_ms")})
+            tracks[spotify_id] = track
+    return tracks
+
+
+def sync_recently_played(session):
+    """
+    Fold the plays Spotify reports since the session's cursor into its history.
+
+    Returns the number of history entries added, raises RecentSyncError when
+    Spotify could not be read. One page (PAGE_SIZE plays) per sync.
+    """
+    session_id = session.session_id
+    with for_session(session_id):
+        cursor, created = Session.objects.filter(session_id=session_id).values_list(
+            "spotify_played_cursor", "created_date").get()
+    after = cursor or _millis(created)
+
+    try:
+        r = spotify.get(f"/me/player/recently-played?limit={PAGE_SIZE}&after={after}",
+                        headers={"Authorization": f"Bearer {session.spotify_access_token}"})
+    except requests.RequestException as e:
+        raise RecentSyncError(f"Network error: {e}") from e
+    if r.status_code != 200:
+        raise RecentSyncError(f"HTTP {r.status_code}")
+    payload = r.json()
+    metrics.increment("spotify.recent_sync.runs")
+
+    plays = _plays(payload)
+    new_cursor = int((payload.get("cursors") or {}).get("after") or 0) or (
+        _millis(plays[-1]["played_at"]) if plays else after)
+    tracks = _tracks(plays) if plays else {}
+
+    with song_transaction(session_id):
+        # a concurrent sync may have recorded the same plays while this one asked
+        # Spotify: look for them, and at the cursor, under the session's lock
+        cursor = Session.objects.filter(session_id=session_id).values_list(
+            "spotify_played_cursor", flat=True).get()
+        plays = _already_recorded(session_id, plays) if plays else []
+        if plays:
+            first = allocate_sequence(session_id, HISTORY, len(plays))
+            PlayedSong.objects.bulk_create([
+                PlayedSong(session_id=session_id, sequence=first + offset, track_id=tracks[play["spotify_id"]].pk,
+                           spotify_track_id=play["spotify_id"], played_at=play["played_at"])
+                for offset, play in enumerate(plays)
+            ])
+            Song.objects.filter(session_id=session_id, track_id__in={track.pk for track in tracks.values()}).update(
+                is_played=True)
+        if max(new_cursor, after) > (cursor or 0):
+            Session.objects.filter(session_id=session_id).update(spotify_played_cursor=max(new_cursor, after))
+    metrics.increment("spotify.recent_sync.added", len(plays))
+    return len(plays)
+
+
+#Helper, sync at most every SPOTIFY_RECENT_SYNC_INTERVAL seconds per session (HistoryView calls this)
+def maybe_sync(session):
+    if not session.spotify_access_token:
+        return None
+    if not cache.add(f"fnt:recent-sync:{session.session_id}", True, _setting("SPOTIFY_RECENT_SYNC_INTERVAL", 60)):
+        return None
+    try:
+        return sync_recently_played(session)
+    except RecentSyncError:
+        metrics.increment("spotify.recent_sync.errors")
+        return None
@@ -0,0 +1,196 @@
+import heapq
+import logging
+import queue
+import threading
+import time
+from urllib.parse import quote
+
+import requests
+from django.conf import settings
+from django.db import connections
+from spotify_api import client as spotify, limiter
+from spotify_api.tokens import ensure_fresh_token
+
+from . import metrics
+from .catalog import mark_spotify_unresolvable, save_spotify_match, spotify_match, spotify_unresolvable
+from .models import Song, Track
+from .routers import for_session
+from .session_cache import get_session
+
+logger = logging.getLogger(__name__)
+
+_queue = queue.Queue()  # session ids due for resolution
+_delayed = []  # heap of (monotonic due time, session_id), sessions Spotify asked to wait
+_pending = set()  # sessions waiting in the queue or the heap, a burst of adds queues a session once
+_pending_lock = threading.Lock()
+_thread = None
+_thread_lock = threading.Lock()
+_last_search = 0.0
+
+
+class SpotifySearchError(Exception):
+    pass
+
+
+class SpotifyRateLimited(SpotifySearchError):
+    def __init__(self, retry_after):
+        super().__init__(f"rate limited for {retry_after}s")
+        self.retry_after = retry_after
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+#Helper, search Spotify for a track: {"id", "uri", "duration_ms"}, None if Spotify has no match
+# (raises SpotifySearchError when the search itself failed, so a failure is never taken for "not found")
+def search_spotify_track(access_token, song_title, artist_name):
+    query = f"track:{song_title} artist:{artist_name}"
+    query = query.replace('"', '').replace("'", "").strip()
+    url = f"/search?q={quote(query)}&type=track&limit=1"
+
+    try:
+        response = spotify.get(url, headers={"Authorization": f"Bearer {access_token}"},
+                               priority=limiter.BACKGROUND)  # never delays the page's calls
+    except requests.RequestException as e:
+        raise SpotifySearchError(f"Network error: {e}") from e
+
+    if response.status_code == 429:
+        raise SpotifyRateLimited(int(response.headers.get("Retry-After") or 1))
+    if response.status_code != 200:
+        raise SpotifySearchError(f"HTTP {response.status_code}")
+
+    tracks = response.json().get("tracks", {}).get("items", [])
+    if not tracks:
+        return None
+    return {
+        "id": tracks[0]["id"],
+        "uri": tracks[0].get("uri") or f"spotify:track:{tracks[0]['id']}",
+        "duration_ms": tracks[0].get("duration_ms"),
+    }
+
+
+# keep at most one search per SPOTIFY_SEARCH_INTERVAL seconds per process
+def _throttle():
+    global _last_search
+    wait = _last_search + _setting("SPOTIFY_SEARCH_INTERVAL", 0.2) - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+    _last_search = time.monotonic()
+
+
+def resolve_upcoming(session_id, access_token, limit=None):
+    """
+    Resolve the Spotify tracks of the next `limit` playlist songs of a session.
+
+    Tracks with a stored match, or already known to be missing on Spotify,
+    are skipped. A search that finds nothing marks the track unresolvable, so
+    the song can be flagged before it reaches the head of the queue. Returns
+    the number of searches made.
+    """
+    limit = limit or _setting("SPOTIFY_RESOLVE_AHEAD", 5)
+    with for_session(session_id):
+        track_ids = list(
+            Song.objects.filter(session_id=session_id, playlist_sequence__gt=0)
+            .order_by("playlist_sequence").values_list("track_id", flat=True)[:limit]
+        )
+    tracks = Track.objects.select_related("artist").in_bulk(track_ids)
+
+    searched = 0
+    for track_id in track_ids:
+        track = tracks.get(track_id)
+        if track is None or spotify_match(track) or spotify_unresolvable(track):
+            continue
+        _throttle()
+        searched += 1
+        match = search_spotify_track(access_token, track.title, track.artist.name)
+        if match:
+            save_spotify_match(track, match)
+            metrics.increment("spotify.preresolve.resolved")
+        else:
+            mark_spotify_unresolvable(track)
+            metrics.increment("spotify.preresolve.unresolvable")
+    return searched
+
+
+#Helper, queue a rate-limited session again once Retry-After has passed, the worker moves on meanwhile
+def _retry_later(session_id, retry_after):
+    delay = min(retry_after, _setting("SPOTIFY_MAX_RETRY_AFTER", 60))
+    with _pending_lock:
+        if session_id in _pending:
+            return  # changed again meanwhile and already queued
+        _pending.add(session_id)
+        heapq.heappush(_delayed, (time.monotonic() + delay, session_id))
+    _queue.put(None)  # wake the worker so it waits for the new due time
+
+
+# next session to resolve: from the queue, or a delayed one once it is due
+def _next_job():
+    while True:
+        with _pending_lock:
+            now = time.monotonic()
+            while _delayed and _delayed[0][0] <= now:
+                _queue.put(heapq.heappop(_delayed)[1])
+            timeout = _delayed[0][0] - now if _delayed else None
+        try:
+            session_id = _queue.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        if session_id is not None:
+            return session_id
+
+
+def run_job(session_id):
+    """
+    Resolve one queued session, with its current access token (refreshed if
+    it is about to expire): the token is read when the job runs, not when the
+    session was queued.
+    """
+    with _pending_lock:
+        _pending.discard(session_id)
+    session = get_session(session_id)
+    if session is None or not session.is_active or not session.spotify_access_token:
+        return
+    try:
+        resolve_upcoming(session_id, ensure_fresh_token(session))
+    except SpotifyRateLimited as e:
+        # try the session again once Spotify allows it
+        metrics.increment("spotify.preresolve.rate_limited")
+        _retry_later(session_id, e.retry_after)
+    except SpotifySearchError as e:
+        # revoked token and the like, the session is queued again by its next change
+        metrics.increment("spotify.preresolve.errors")
+        logger.info("pre-resolving session %s stopped: %s", session_id, e)
+
+
+def _run_forever():
+    while True:
+        session_id = _next_job()
+        try:
+            run_job(session_id)
+        except Exception:
+            metrics.increment("spotify.preresolve.errors")
+            logger.exception("pre-resolving session %s failed", session_id)
+        finally:
+            connections.close_all()
+
+
+def _start_worker():
+    global _thread
+    with _thread_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_run_forever, name="fnt-spotify-resolver", daemon=True)
+            _thread.start()
+
+
+#Helper, queue a session for pre-resolution after its playlist changed (no-op without a Spotify token,
+# the job reads the current token when it runs)
+def schedule_resolution(session_id, access_token):
+    if not access_token or not _setting("SPOTIFY_PRERESOLVE", True):
+        return
+    with _pending_lock:
+        if session_id in _pending:
+            return
+        _pending.add(session_id)
+    _start_worker()
+    _queue.put(session_id)
@@ -0,0 +1,186 @@
+import random
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from . import metrics
+
+PRIMARY = 'api'
+
+# global catalog models, kept on one database instead of being sharded
+CATALOG_MODELS = {'artist', 'track'}
+
+# session of the current request and whether this request already wrote to the primary
+# (_wrote stays None outside a request, scripts and threads don't pin themselves to the primary)
+_session_id = ContextVar('api_session_id', default=None)
+_wrote = ContextVar('api_wrote', default=None)
+
+
+#Helper, remember the session of the current request (picks its shard, reads after its writes stay on the primary)
+def bind_session(session_id):
+    if session_id:
+        _session_id.set(str(session_id))
+
+
+#Helper, route the queries inside the block to one session's shard (scripts, background jobs)
+@contextmanager
+def for_session(session_id):
+    token = _session_id.set(str(session_id))
+    try:
+        yield
+    finally:
+        _session_id.reset(token)
+
+
+def shards():
+    return getattr(settings, 'API_DB_SHARDS', [PRIMARY])
+
+
+def catalog_db():
+    return getattr(settings, 'API_CATALOG_DB', None) or shards()[0]
+
+
+#Helper, database alias that holds a session and its songs (stable hash, not Python's salted hash())
+def shard_for(session_id):
+    aliases = shards()
+    if len(aliases) == 1:
+        return aliases[0]
+    return aliases[zlib.crc32(str(session_id).encode()) % len(aliases)]
+
+
+def _sticky_key(session_id):
+    return f'fnt:read-primary:{session_id}'
+
+
+def _replicas(shard):
+    return getattr(settings, 'API_DB_REPLICAS', {}).get(shard, [])
+
+
+# database a model lives on: the catalog database, or the shard of the query's session
+def _primary_for(model, session_id):
+    if model._meta.model_name in CATALOG_MODELS:
+        return catalog_db()
+    return shard_for(session_id) if session_id else shards()[0]
+
+
+# session a query belongs to: the model instance it runs for, else the bound session
+# (Session's pk and Song's FK are both stored as session_id, read from __dict__ so a deferred
+# field never triggers a query from inside the router)
+def _hinted_session_id(hints):
+    instance = hints.get('instance')
+    if instance is not None:
+        session_id = vars(instance).get('session_id')
+        if session_id:
+            return session_id
+    return _session_id.get()
+
+
+class ApiRouter:
+    """
+    Send the api app to its own databases.
+
+    Sessions and their songs are sharded by a hash of session_id over
+    API_DB_SHARDS, the Artist/Track catalog stays on API_CATALOG_DB. Writes go
+    to the primary, reads to a random replica of it from API_DB_REPLICAS.
+
+    Reads stay on the primary inside a transaction, for the rest of a request
+    that wrote, and for API_REPLICA_LAG seconds after its session last wrote,
+    so a session always sees its own changes. That last rule is a key in the
+    Django cache, replicas require a shared cache backend (api/checks.py).
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'api':
+            return None
+        session_id = _hinted_session_id(hints)
+        shard = _primary_for(model, session_id)
+        replicas = _replicas(shard)
+        if not replicas:
+            metrics.increment('db.read.primary')
+            return shard
+
+        if connections[shard].in_atomic_block:
+            metrics.increment('db.read.transaction')
+            return shard
+        if _wrote.get():
+            metrics.increment('db.read.sticky')
+            return shard
+        if session_id and cache.get(_sticky_key(session_id)):
+            metrics.increment('db.read.sticky')
+            return shard
+
+        metrics.increment('db.read.replica')
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != 'api':
+            return None
+        session_id = _hinted_session_id(hints)
+        shard = _primary_for(model, session_id)
+        metrics.increment('db.write.primary')
+        if _replicas(shard):
+            if _wrote.get() is not None:
+                _wrote.set(True)
+            if session_id:
+                cache.set(_sticky_key(session_id), True, getattr(settings, 'API_REPLICA_LAG', 2))
+        return shard
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # a session's songs are routed by its session_id, so they always share its shard
+        if obj1._meta.app_label == 'api' or obj2._meta.app_label == 'api':
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # every shard gets the session tables, the catalog only its own database,
+        # replicas are migrated through their primary
+        if app_label == 'api':
+            if model_name in CATALOG_MODELS:
+                return db == catalog_db()
+            return db in shards()
+        return db == 'default'
+
+
+class ReadRoutingMiddleware:
+    """
+    Reset the routing state per request and bind the session from the URL or query string.
+
+    Async capable, so under ASGI the async views (Spotify proxy, events) are
+    not pushed onto a thread by this middleware.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        session_token = _session_id.set(None)
+        wrote_token = _wrote.set(False)
+        try:
+            return self.get_response(request)
+        finally:
+            _session_id.reset(session_token)
+            _wrote.reset(wrote_token)
+
+    async def __acall__(self, request):
+        session_token = _session_id.set(None)
+        wrote_token = _wrote.set(False)
+        try:
+            return await self.get_response(request)
+        finally:
+            _session_id.reset(session_token)
+            _wrote.reset(wrote_token)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        bind_session(view_kwargs.get('pk') or request.GET.get('session_id'))
+        return None
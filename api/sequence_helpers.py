@@ -0,0 +1,91 @@
+from contextlib import contextmanager
+
+from django.db import connections, router, transaction
+from django.db.models import F
+
+from .models import PlayedSong, Session, Song
+from .routers import for_session
+
+# Session counter fields, each holds the next free position of its list
+PLAYLIST = "next_playlist_sequence"
+VIBE = "next_vibe_sequence"
+HISTORY = "next_hist_sequence"
+
+
+class SessionInactive(Exception):
+    pass
+
+
+#Helper, transaction on the shard that holds the session's songs (allocation + insert commit together)
+# the session row is locked first so all list changes of one session run one after another
+@contextmanager
+def song_transaction(session_id):
+    with for_session(session_id):
+        using = router.db_for_write(Song)
+        with transaction.atomic(using=using):
+            # SQLite has no row locks, BEGIN IMMEDIATE already serialises writers there
+            if connections[using].features.has_select_for_update:
+                list(Session.objects.using(using).select_for_update().filter(session_id=session_id).values_list("pk"))
+            yield
+
+
+#Helper, reserve the next position of a list and return it (O(1), no MAX() over songs)
+# (count > 1 reserves a run of positions for a batch insert and returns the first)
+def allocate_sequence(session_id, counter, count=1):
+    # conditional update: the row is write-locked until the surrounding transaction commits,
+    # so concurrent adds can never read the same value
+    updated = Session.objects.filter(session_id=session_id, is_active=True).update(
+        **{counter: F(counter) + count}
+    )
+    if not updated:
+        raise SessionInactive(session_id)
+    next_free = Session.objects.filter(session_id=session_id).values_list(counter, flat=True).get()
+    return next_free - count
+
+
+#Helper, give a position back after a song left the list (never below 1)
+def release_sequence(session_id, counter):
+    Session.objects.filter(session_id=session_id, **{f"{counter}__gt": 1}).update(
+        **{counter: F(counter) - 1}
+    )
+
+
+#Helper, reset counters after a list was cleared
+def reset_sequences(session_id, *counters):
+    Session.objects.filter(session_id=session_id).update(**{counter: 1 for counter in counters})
+
+
+#Helper, a playlist song left the player queue: append it to the history (unless it was skipped),
+# take it off the playlist and close the gap, returns (history entry or None, songs moved up)
+def mark_played(session_id, song_id, track_id, spotify_track_id, skipped=False):
+    with song_transaction(session_id):
+        history_entry = None
+        if not skipped:
+            history_entry = PlayedSong.objects.create(
+                session_id=session_id,
+                sequence=allocate_sequence(session_id, HISTORY),
+                track_id=track_id,
+                spotify_track_id=spotify_track_id,
+            )
+
+        # re-read the positions under the session lock (the list may have been reordered meanwhile)
+        removed_sequence, vibe_sequence = Song.objects.filter(id=song_id).values_list(
+            "playlist_sequence", "vibe_sequence"
+        ).first() or (None, None)
+        if vibe_sequence and vibe_sequence > 0:
+            # still shapes the vibe, keep the row out of the playlist
+            Song.objects.filter(id=song_id).update(playlist_sequence=0, is_played=True, is_playing=not skipped)
+        else:
+            # played and not in the vibe list, only the history row is needed
+            Song.objects.filter(id=song_id).delete()
+
+        moved_up = 0
+        if removed_sequence and removed_sequence > 0:
+            moved_up = Song.objects.filter(
+                session_id=session_id, playlist_sequence__gt=removed_sequence
+            ).update(playlist_sequence=F("playlist_sequence") - 1)
+            release_sequence(session_id, PLAYLIST)
+
+        if not skipped:
+            Song.objects.filter(session_id=session_id, is_playing=True).exclude(id=song_id).update(is_playing=False)
+    return history_entry, moved_up
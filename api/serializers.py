@@ -1,15 +1,47 @@
 from rest_framework import serializers 
-from .models import  Session, Song
+from .models import  Session, Song, PlayedSong
+from .catalog import spotify_match, spotify_unresolvable
 
 class SessionSerializer(serializers.ModelSerializer):
     class Meta: 
         model = Session
         fields = '__all__'
 
+# song fields come from the catalog Track (prefetch 'track__artist')
 class SongSerializer(serializers.ModelSerializer):
+    artist_id = serializers.CharField(source='track.artist.mbid', read_only=True)
+    artist_name = serializers.CharField(source='track.artist.name', read_only=True)
+    song_id = serializers.CharField(source='track.mbid', read_only=True)
+    song_title = serializers.CharField(source='track.title', read_only=True)
+    song_popularity = serializers.IntegerField(source='track.popularity', read_only=True)
+    spotify_track_id = serializers.CharField(source='track.spotify_id', read_only=True)
+    duration_ms = serializers.IntegerField(source='track.duration_ms', read_only=True, allow_null=True)
+    spotify_status = serializers.SerializerMethodField()  # resolved / unresolvable / pending
+
     class Meta:
         model = Song
-        fields = '__all__'  
+        fields = [
+            'id', 'session', 'artist_id', 'artist_name', 'song_id', 'song_title', 'song_popularity',
+            'spotify_track_id', 'duration_ms', 'spotify_status',
+            'vibe_sequence', 'playlist_sequence', 'playlist_hist_sequence', 'is_playing', 'is_played',
+        ]
+
+    def get_spotify_status(self, song):
+        if spotify_match(song.track):
+            return 'resolved'
+        if spotify_unresolvable(song.track):
+            return 'unresolvable'
+        return 'pending'
+
+class PlayedSongSerializer(serializers.ModelSerializer):
+    artist_id = serializers.CharField(source='track.artist.mbid', read_only=True)
+    artist_name = serializers.CharField(source='track.artist.name', read_only=True)
+    song_id = serializers.CharField(source='track.mbid', read_only=True)
+    song_title = serializers.CharField(source='track.title', read_only=True)
+
+    class Meta:
+        model = PlayedSong
+        fields = ['id', 'sequence', 'artist_id', 'artist_name', 'song_id', 'song_title', 'spotify_track_id', 'played_at']
 
 
 class ArtistSearchResponseSerializer(serializers.Serializer):
@@ -72,3 +104,20 @@ class ClearVibeResponseSerializer(serializers.Serializer):
 
 class RecommendResponseSerializer(serializers.Serializer):
     results = serializers.JSONField() 
+
+class HistoryResponseSerializer(serializers.Serializer):
+    success = serializers.BooleanField()
+    history = PlayedSongSerializer(many=True)
+    next_before = serializers.IntegerField(allow_null=True)  # pass as before= for the next (older) page
+
+
+class SnapshotResponseSerializer(serializers.Serializer):
+    success = serializers.BooleanField()
+    session = serializers.JSONField()  # session_id, is_active
+    playlist = SongSerializer(many=True)
+    vibe = SongSerializer(many=True)
+    history = PlayedSongSerializer(many=True)
+    next_before = serializers.IntegerField(allow_null=True)  # older history: /api/history/?before=
+    now_playing = serializers.JSONField(allow_null=True)  # last song started, with started_at
+    spotify = serializers.JSONField()  # connected, profile (kept profile, null if not known yet)
+    last_event_id = serializers.IntegerField()  # open /api/events/ from here
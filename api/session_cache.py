@@ -0,0 +1,90 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router
+
+from .checks import cache_is_shared
+from .models import Session
+from .routers import for_session
+
+# Session columns kept in the cache (everything the polling endpoints need), in model order for from_db()
+CACHED_FIELDS = ("session_id", "created_date", "is_active", "last_active", "spotify_access_token",
+                 "spotify_token_expires")
+
+_entries = OrderedDict()  # session_id -> (values, version, loaded_at), oldest first
+_lock = threading.Lock()
+
+
+# off when the Django cache is process-local, other workers would never see an invalidation
+def _ttl():
+    return getattr(settings, "SESSION_CACHE_TTL", 30) if cache_is_shared() else 0
+
+
+def _max_size():
+    return getattr(settings, "SESSION_CACHE_SIZE", 1024)
+
+
+# version stamp lives in the shared Django cache so other worker processes see invalidations
+# (the entries are only used with a shared backend, see _ttl())
+def _version_key(session_id):
+    return f"fnt:session-version:{session_id}"
+
+
+def _current_version(session_id):
+    return cache.get(_version_key(session_id))
+
+
+def _build(values):
+    return Session.from_db(router.db_for_read(Session), CACHED_FIELDS, values)
+
+
+#Helper, Session with the requested fields, served from the cache when possible (None if not found)
+def get_session(session_id, fields=CACHED_FIELDS):
+    with for_session(session_id):
+        return _get_session(session_id, fields)
+
+
+def _get_session(session_id, fields):
+    if not set(fields) <= set(CACHED_FIELDS) or _ttl() <= 0:
+        return Session.objects.only(*fields).filter(session_id=session_id).first()
+
+    version = _current_version(session_id)
+    with _lock:
+        entry = _entries.get(session_id)
+        if entry is not None:
+            values, entry_version, loaded_at = entry
+            if entry_version == version and time.monotonic() - loaded_at < _ttl():
+                _entries.move_to_end(session_id)
+                return _build(values)
+            del _entries[session_id]
+
+    # version was read before the query, a write that lands in between leaves a stale stamp
+    # on the entry and the next read reloads it
+    values = Session.objects.filter(session_id=session_id).values_list(*CACHED_FIELDS).first()
+    if values is None:
+        return None
+
+    with _lock:
+        _entries[session_id] = (values, version, time.monotonic())
+        _entries.move_to_end(session_id)
+        while len(_entries) > _max_size():
+            _entries.popitem(last=False)
+    return _build(values)
+
+
+#Helper, call after writing a Session (tokens, active flag)
+def invalidate_session(session_id):
+    if not session_id:
+        return
+    with _lock:
+        _entries.pop(session_id, None)
+    cache.set(_version_key(session_id), uuid.uuid4().hex, None)
+
+
+def clear():
+    with _lock:
+        _entries.clear()
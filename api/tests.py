@@ -1,3 +1,1053 @@
-from django.test import TestCase
+import asyncio
+import contextvars
+import io
+import os
+import re
+import sys
+import threading
+import time
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from decouple import config
+from django.db import connections
+from django.conf import settings
+from django.core.management import call_command
+from django.core.cache import cache
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from spotify_api import account_cache
+
+from . import checks, events, metrics, playback, queue_ahead, reaper, recent_sync, resolver, session_cache
+from .catalog import get_track, save_spotify_match, spotify_match
+from .models import PlayedSong, Session, Song, Track
+from .routers import ApiRouter, ReadRoutingMiddleware, bind_session, shard_for, shards
+from .sequence_helpers import mark_played
+from .views import NextSongView
+
+SPOTIFY_MATCH = {'id': '4iV5W9uYEdYUVa79Axb7Rh', 'uri': 'spotify:track:4iV5W9uYEdYUVa79Axb7Rh', 'duration_ms': 215000}
+
+
+# the catalog may live on another database, so titles are looked up instead of joined
+def track_titles(track_ids):
+    titles = dict(Track.objects.filter(pk__in=track_ids).values_list('pk', 'title'))
+    return [titles[track_id] for track_id in track_ids]
+
+
+@skipUnless(connections['api'].vendor == 'sqlite', 'query plans are checked on SQLite')
+class SongQueryPlanTests(TestCase):
+    """
+    Run EXPLAIN QUERY PLAN on every query the hot views send to api_song and
+    fail if SQLite falls back to a table scan or a temp sort.
+    """
+    databases = '__all__'
+
+    # SCAN <table> is a full scan, TEMP B-TREE means ORDER BY could not use an index
+    BAD_PLAN = re.compile(r'\bSCAN (TABLE )?api_song\b|USE TEMP B-TREE')
+
+    def setUp(self):
+        session_cache.clear()
+        cache.clear()
+        self.client = APIClient()
+        self.session = Session.objects.create(session_id='123456')
+        for i in range(1, 6):
+            Song.objects.create(
+                session=self.session,
+                track=get_track(f'Song {i}', f'Artist {i}'),
+                vibe_sequence=i,
+                playlist_sequence=i,
+                playlist_hist_sequence=0,
+            )
+
+    def assertSongQueriesUseIndexes(self, call):
+        connection = connections[shard_for('123456')]
+        with CaptureQueriesContext(connection) as ctx:
+            response = call()
+        self.assertLess(response.status_code, 300, response.data)
+
+        song_queries = [q['sql'] for q in ctx.captured_queries if 'api_song' in q['sql']]
+        self.assertTrue(song_queries, 'no api_song queries captured')
+
+        for sql in song_queries:
+            if sql.startswith(('INSERT', 'SAVEPOINT', 'RELEASE')):
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                plan = '\n'.join(str(row[-1]) for row in cursor.fetchall())
+            self.assertIsNone(self.BAD_PLAN.search(plan), f'{sql}\n-> {plan}')
+
+    def test_get_playlist(self):
+        self.assertSongQueriesUseIndexes(lambda: self.client.get(
+            '/api/get-songs/', {'session_id': '123456', 'list_type': 'playlist'}))
+
+    def test_get_vibe(self):
+        self.assertSongQueriesUseIndexes(lambda: self.client.get(
+            '/api/get-songs/', {'session_id': '123456', 'list_type': 'vibe'}))
+
+    def test_add_playlist_vibe(self):
+        self.assertSongQueriesUseIndexes(lambda: self.client.post(
+            '/api/add-playlist-vibe/?session_id=123456&artist_name=New&song_name=Track'))
+
+    def test_add_song(self):
+        self.assertSongQueriesUseIndexes(lambda: self.client.post(
+            '/api/add-song/?session_id=123456&list_type=playlist,vibe&artist_name=New&song_title=Track'))
+
+    def test_remove_from_playlist(self):
+        song = Song.objects.using(shard_for('123456')).get(session=self.session, playlist_sequence=2)
+        self.assertSongQueriesUseIndexes(lambda: self.client.post(
+            f'/api/remove-list/?session_id=123456&list_type=playlist&id={song.id}'))
+
+    def test_remove_from_vibe(self):
+        song = Song.objects.using(shard_for('123456')).get(session=self.session, vibe_sequence=2)
+        self.assertSongQueriesUseIndexes(lambda: self.client.post(
+            f'/api/remove-list/?session_id=123456&list_type=vibe&id={song.id}'))
+
+    def test_snapshot(self):
+        self.assertSongQueriesUseIndexes(lambda: self.client.get('/api/snapshot/', {'session_id': '123456'}))
+
+    @mock.patch.object(NextSongView, '_play_track_on_spotify', return_value={'success': True})
+    @mock.patch.object(NextSongView, '_search_track_on_spotify', return_value=SPOTIFY_MATCH)
+    def test_next_song(self, *mocks):
+        self.assertSongQueriesUseIndexes(lambda: self.client.post(
+            '/api/next-song/', {'session_id': '123456'}, format='json'))
+
+
+class SequenceCounterTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        cache.clear()
+        self.client = APIClient()
+        self.session = Session.objects.create(session_id='654321')
+
+    def add_song(self, title, list_type='playlist,vibe'):
+        response = self.client.post(
+            f'/api/add-song/?session_id=654321&list_type={list_type}&artist_name=Artist&song_title={title}')
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data['results']['song_id']
+
+    def test_positions_follow_adds_and_removes(self):
+        first = self.add_song('One')
+        self.add_song('Two')
+        self.add_song('Three', list_type='playlist')
+
+        self.client.post(f'/api/remove-list/?session_id=654321&list_type=playlist&id={first}')
+        self.add_song('Four', list_type='playlist')
+
+        playlist = list(Song.objects.using(shard_for('654321')).filter(session=self.session, playlist_sequence__gt=0)
+                        .order_by('playlist_sequence').values_list('track_id', 'playlist_sequence'))
+        self.assertEqual(track_titles([track_id for track_id, _ in playlist]), ['Two', 'Three', 'Four'])
+        self.assertEqual([position for _, position in playlist], [1, 2, 3])
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.next_playlist_sequence, 4)
+        self.assertEqual(self.session.next_vibe_sequence, 3)
+
+    def test_inactive_session_rejects_allocation(self):
+        Session.objects.using(shard_for('654321')).filter(pk=self.session.pk).update(is_active=False)
+        session_cache.invalidate_session(self.session.pk)
+        response = self.client.post(
+            '/api/add-song/?session_id=654321&list_type=playlist&artist_name=Artist&song_title=One')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Song.objects.using(shard_for('654321')).filter(session=self.session).exists())
+
+
+class SessionResolutionTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        self.client = APIClient()
+        Session.objects.create(session_id='111111', spotify_access_token='token')
+
+    def test_single_session_lookup_per_request(self):
+        with CaptureQueriesContext(connections[shard_for('111111')]) as ctx:
+            response = self.client.get('/api/get-songs/', {'session_id': '111111', 'list_type': 'playlist'})
+        self.assertEqual(response.status_code, 200)
+        session_queries = [q['sql'] for q in ctx.captured_queries if 'FROM "api_session"' in q['sql']]
+        self.assertEqual(len(session_queries), 1)
+        self.assertNotIn('spotify_refresh_token', session_queries[0])
+
+    @mock.patch.object(session_cache, 'cache_is_shared', return_value=True)
+    def test_cached_session_skips_database(self, shared):
+        self.client.get('/api/get-songs/', {'session_id': '111111', 'list_type': 'playlist'})
+        with CaptureQueriesContext(connections[shard_for('111111')]) as ctx:
+            response = self.client.get('/api/get-songs/', {'session_id': '111111', 'list_type': 'vibe'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q for q in ctx.captured_queries if 'FROM "api_session"' in q['sql']])
+
+    @mock.patch.object(checks, 'cache_is_shared', return_value=False)
+    @mock.patch.object(session_cache, 'cache_is_shared', return_value=False)
+    def test_process_local_cache_turns_the_session_cache_off(self, *local):
+        self.client.get('/api/get-songs/', {'session_id': '111111', 'list_type': 'playlist'})
+        with CaptureQueriesContext(connections[shard_for('111111')]) as ctx:
+            self.client.get('/api/get-songs/', {'session_id': '111111', 'list_type': 'vibe'})
+        self.assertTrue([q for q in ctx.captured_queries if 'FROM "api_session"' in q['sql']])
+        self.assertEqual([warning.id for warning in checks.check_session_cache(None)], ['api.W001'])
+
+    @mock.patch.object(session_cache, 'cache_is_shared', return_value=True)
+    def test_stop_session_invalidates_cache(self, shared):
+        self.client.get('/api/get-songs/', {'session_id': '111111', 'list_type': 'playlist'})
+        self.client.delete('/api/sessions/111111/stop/')
+        response = self.client.get('/api/get-songs/', {'session_id': '111111', 'list_type': 'playlist'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_stop_session_leaves_the_sequence_counters_alone(self):
+        with CaptureQueriesContext(connections[shard_for('111111')]) as ctx:
+            self.assertEqual(self.client.delete('/api/sessions/111111/stop/').status_code, 200)
+        updates = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE "api_session"')]
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('next_', updates[0])
+        self.assertEqual(self.client.delete('/api/sessions/999999/stop/').status_code, 404)
+
+    def test_validation_errors(self):
+        response = self.client.get('/api/get-songs/', {'list_type': 'playlist'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/get-songs/', {'session_id': '999999', 'list_type': 'playlist'})
+        self.assertEqual(response.status_code, 404)
+        Session.objects.using(shard_for('111111')).filter(pk='111111').update(is_active=False)
+        session_cache.invalidate_session('111111')
+        response = self.client.get('/api/get-songs/', {'session_id': '111111', 'list_type': 'playlist'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ConcurrentWriteTests(TransactionTestCase):
+    """
+    Many threads adding and reordering songs on one session must never hit a
+    lock error, and must keep up a minimum write throughput.
+
+    Also the write benchmark: FNT_BENCH_ROUNDS=25 python manage.py test
+    api.tests.ConcurrentWriteTests runs more rounds and prints the numbers.
+    """
+    databases = '__all__'
+
+    THREADS = 8
+    ROUNDS = config('FNT_BENCH_ROUNDS', default=5, cast=int)
+    # well below what a laptop reaches (~120 writes/s on SQLite with WAL + BEGIN IMMEDIATE, ~45 on
+    # PostgreSQL), writers waiting out busy_timeout retries end up under them
+    MIN_WRITES_PER_SECOND = 15
+    MAX_P95_SECONDS = 1.0
+
+    def setUp(self):
+        session_cache.clear()
+        Session.objects.create(session_id='222222')
+
+    def tearDown(self):
+        # replicas mirror the test database, their pools must not outlive it
+        for replicas in settings.API_DB_REPLICAS.values():
+            for alias in replicas:
+                connections[alias].close_pool()
+
+    def timed(self, call, latencies):
+        started = time.perf_counter()
+        response = call()
+        latencies.append(time.perf_counter() - started)
+        return response
+
+    def worker(self, number, failures, latencies):
+        client = APIClient()
+        try:
+            for round_number in range(self.ROUNDS):
+                added = []
+                for suffix in ('a', 'b'):
+                    response = self.timed(lambda: client.post(
+                        '/api/add-song/?session_id=222222&list_type=playlist,vibe'
+                        f'&artist_name=Artist&song_title=Song {number}-{round_number}{suffix}'), latencies)
+                    if response.status_code != 200:
+                        failures.append(response.data)
+                        return
+                    added.append(response.data['results'])
+
+                # swap the two songs this thread just added
+                first, second = added
+                response = self.timed(lambda: client.post('/api/order-playlist/?session_id=222222', [
+                    {'id': first['song_id'], 'playlist_sequence': second['playlist_sequence']},
+                    {'id': second['song_id'], 'playlist_sequence': first['playlist_sequence']},
+                ], format='json'), latencies)
+                if response.status_code != 200:
+                    failures.append(response.data)
+                    return
+        except Exception as e:
+            failures.append(repr(e))
+        finally:
+            connections.close_all()
+
+    def test_parallel_adds_and_reorders(self):
+        failures, latencies = [], []
+        threads = [threading.Thread(target=self.worker, args=(n, failures, latencies)) for n in range(self.THREADS)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        self.assertEqual(failures, [])
+        throughput = len(latencies) / elapsed
+        p95 = sorted(latencies)[int(len(latencies) * 0.95) - 1]
+        result = (f'{self.THREADS} threads x {self.ROUNDS} rounds: {len(latencies)} writes in {elapsed:.2f}s, '
+                  f'{throughput:.0f} writes/s, p95 {p95 * 1000:.0f} ms ({connections[shard_for("222222")].vendor})')
+        if 'FNT_BENCH_ROUNDS' in os.environ:
+            print(f'\n{result}', file=sys.stderr)
+        self.assertGreaterEqual(throughput, self.MIN_WRITES_PER_SECOND, result)
+        self.assertLessEqual(p95, self.MAX_P95_SECONDS, result)
+
+        total = self.THREADS * self.ROUNDS * 2
+        shard = shard_for('222222')
+        positions = sorted(Song.objects.using(shard).filter(session_id='222222').values_list('playlist_sequence', flat=True))
+        self.assertEqual(positions, list(range(1, total + 1)))
+        self.assertEqual(Session.objects.using(shard).get(pk='222222').next_playlist_sequence, total + 1)
+
+
+@override_settings(METRICS_TOKEN='scraper')
+class MetricsAccessTests(SimpleTestCase):
+    def test_only_staff_and_the_metrics_token(self):
+        client = APIClient()
+        self.assertIn(client.get('/api/metrics/').status_code, (401, 403))
+        self.assertIn(client.get('/api/metrics/', headers={'Authorization': 'Bearer guess'}).status_code, (401, 403))
+        self.assertEqual(client.get('/api/metrics/', headers={'Authorization': 'Bearer scraper'}).status_code, 200)
+        client.force_authenticate(user=mock.Mock(is_staff=True))
+        self.assertEqual(client.get('/api/metrics/').status_code, 200)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_no_token_configured(self):
+        self.assertIn(APIClient().get('/api/metrics/', headers={'Authorization': 'Bearer '}).status_code, (401, 403))
+
+
+@override_settings(API_DB_SHARDS=['api'], API_DB_REPLICAS={'api': ['api_replica_1']}, API_REPLICA_LAG=5)
+class ReadRoutingTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+        self.router = ApiRouter()
+
+    # every call runs in a fresh context through the middleware, like a separate request
+    def in_request(self, session_id, *calls):
+        def view(request):
+            bind_session(session_id)
+            return [call(Song) for call in calls]
+        return contextvars.copy_context().run(ReadRoutingMiddleware(view), None)
+
+    def test_reads_go_to_replica_and_writes_to_primary(self):
+        self.assertEqual(self.in_request('333333', self.router.db_for_read, self.router.db_for_write),
+                         ['api_replica_1', 'api'])
+        self.assertEqual(metrics.snapshot(), {'db.read.replica': 1, 'db.write.primary': 1})
+
+    def test_session_reads_from_primary_after_write(self):
+        self.assertEqual(self.in_request('333333', self.router.db_for_write, self.router.db_for_read),
+                         ['api', 'api'])
+        # the next request of the same session is still inside the lag window
+        self.assertEqual(self.in_request('333333', self.router.db_for_read), ['api'])
+        # other sessions keep using the replica
+        self.assertEqual(self.in_request('444444', self.router.db_for_read), ['api_replica_1'])
+        self.assertEqual(metrics.snapshot()['db.read.sticky'], 2)
+
+    def test_window_expires(self):
+        # the request that wrote stays on the primary even without the cached window
+        self.assertEqual(self.in_request(None, self.router.db_for_write, self.router.db_for_read),
+                         ['api', 'api'])
+        self.in_request('333333', self.router.db_for_write)
+        cache.delete('fnt:read-primary:333333')
+        self.assertEqual(self.in_request('333333', self.router.db_for_read), ['api_replica_1'])
+
+    def test_replicas_require_a_shared_cache(self):
+        with mock.patch.object(checks, 'cache_is_shared', return_value=False):
+            self.assertEqual([error.id for error in checks.check_replica_cache(None)], ['api.E001'])
+        with mock.patch.object(checks, 'cache_is_shared', return_value=True):
+            self.assertEqual(checks.check_replica_cache(None), [])
+
+    @override_settings(API_DB_REPLICAS={})
+    def test_without_replicas_everything_uses_primary(self):
+        self.assertEqual(self.in_request('333333', self.router.db_for_read), ['api'])
+        self.assertEqual(self.router.allow_migrate('api_replica_1', 'api'), False)
+
+
+@override_settings(API_DB_SHARDS=['api', 'api_shard_1', 'api_shard_2'], API_DB_REPLICAS={})
+class ShardRoutingTests(SimpleTestCase):
+    def setUp(self):
+        self.router = ApiRouter()
+
+    def test_session_and_songs_share_a_shard(self):
+        session = Session(session_id='555555')
+        song = Song(session=session)
+        self.assertEqual(self.router.db_for_write(Session, instance=session), shard_for('555555'))
+        self.assertEqual(self.router.db_for_write(Song, instance=song), shard_for('555555'))
+
+    def test_sessions_spread_over_all_shards(self):
+        used = {shard_for(str(session_id)) for session_id in range(100000, 100100)}
+        self.assertEqual(used, {'api', 'api_shard_1', 'api_shard_2'})
+
+    def test_bound_session_picks_shard(self):
+        def request():
+            bind_session('555555')
+            return self.router.db_for_read(Song)
+        self.assertEqual(contextvars.copy_context().run(ReadRoutingMiddleware(lambda r: request()), None),
+                         shard_for('555555'))
+        self.assertTrue(self.router.allow_migrate('api_shard_2', 'api'))
+        self.assertFalse(self.router.allow_migrate('default', 'api'))
+
+
+@skipUnless(len(shards()) > 1, 'needs API_SHARDS > 1')
+class RebalanceShardsTests(TransactionTestCase):
+    databases = '__all__'
+
+    def test_misplaced_session_moves_with_its_songs(self):
+        cache.clear()
+        session_id = '666666'
+        target = shard_for(session_id)
+        wrong = next(alias for alias in shards() if alias != target)
+
+        session = Session.objects.using(wrong).create(session_id=session_id, next_playlist_sequence=3)
+        for position in (1, 2):
+            Song.objects.using(wrong).create(session=session, track=get_track(f'Song {position}', 'Artist'),
+                                             playlist_sequence=position)
+
+        call_command('rebalance_shards', stdout=io.StringIO())
+
+        self.assertFalse(Session.objects.using(wrong).filter(pk=session_id).exists())
+        self.assertEqual(Session.objects.using(target).get(pk=session_id).next_playlist_sequence, 3)
+        self.assertEqual(track_titles(list(Song.objects.using(target).filter(session_id=session_id)
+                                           .order_by('playlist_sequence').values_list('track_id', flat=True))),
+                         ['Song 1', 'Song 2'])
+
+
+@override_settings(SESSION_IDLE_TIMEOUT=3600, SESSION_MAX_AGE=86400)
+class SessionReaperTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        metrics.reset()
+        cache.clear()
+        now = timezone.now()
+        self.sessions = {
+            'fresh': Session.objects.create(session_id='700001'),
+            'idle': Session.objects.create(session_id='700002', last_active=now - timedelta(hours=2)),
+            'old': Session.objects.create(session_id='700003'),
+        }
+        Session.objects.using(shard_for('700003')).filter(pk='700003').update(
+            created_date=now - timedelta(days=2))
+        for session in self.sessions.values():
+            for i in range(5):
+                Song.objects.create(session=session, track=get_track(f'Song {i}', 'Artist'),
+                                    playlist_sequence=i + 1)
+            PlayedSong.objects.create(session=session, sequence=1, track=get_track('Played', 'Artist'))
+
+    def remaining(self):
+        return {name: Session.objects.using(shard_for(s.pk)).filter(pk=s.pk).exists()
+                for name, s in self.sessions.items()}
+
+    def test_reaps_expired_sessions_in_batches(self):
+        reclaimed = reaper.reap(batch_size=2, pause=0)
+
+        self.assertEqual(reclaimed, {'sessions': 2, 'songs': 10, 'history': 2})
+        self.assertEqual(self.remaining(), {'fresh': True, 'idle': False, 'old': False})
+        self.assertEqual(Song.objects.using(shard_for('700001')).filter(session_id='700001').count(), 5)
+        counters = metrics.snapshot()
+        self.assertEqual((counters['reaper.sessions_deleted'], counters['reaper.songs_deleted']), (2, 10))
+
+    def test_request_keeps_session_alive(self):
+        Session.objects.using(shard_for('700002')).filter(pk='700002').update(
+            last_active=timezone.now() - timedelta(minutes=50))
+        response = APIClient().get('/api/get-songs/', {'session_id': '700002', 'list_type': 'playlist'})
+        self.assertEqual(response.status_code, 200)
+        reaper.reap(pause=0, now=timezone.now() + timedelta(minutes=30))
+        self.assertTrue(self.remaining()['idle'])
+
+    @mock.patch.object(reaper, 'start_background_reaper')
+    def test_thread_starts_with_the_first_served_request(self, start):
+        from django.core.handlers.wsgi import WSGIHandler
+        from django.core.signals import request_started
+        request_started.connect(reaper.start_on_first_request, dispatch_uid=reaper.REAPER_SIGNAL_UID)
+        self.addCleanup(request_started.disconnect, dispatch_uid=reaper.REAPER_SIGNAL_UID)
+        APIClient().get('/api/')
+        start.assert_not_called()
+        for _ in range(2):
+            request_started.send(sender=WSGIHandler, environ={})
+        start.assert_called_once()
+
+    def test_expired_session_is_rejected_before_it_is_reaped(self):
+        client = APIClient()
+        for session_id in ('700002', '700003'):  # idle, too old
+            response = client.get('/api/get-songs/', {'session_id': session_id, 'list_type': 'playlist'})
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(client.get(f'/api/sessions/{session_id}/check/').status_code, 404)
+        self.assertEqual(self.remaining(), {'fresh': True, 'idle': True, 'old': True})
+        reaper.reap(pause=0)  # the refused requests did not revive them
+        self.assertEqual(self.remaining(), {'fresh': True, 'idle': False, 'old': False})
+
+
+@mock.patch.object(NextSongView, '_play_track_on_spotify', return_value={'success': True})
+@mock.patch.object(NextSongView, '_search_track_on_spotify', return_value=SPOTIFY_MATCH)
+class PlayHistoryTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        cache.clear()
+        self.client = APIClient()
+        self.session = Session.objects.create(session_id='800001')
+        self.songs = Song.objects.using(shard_for('800001'))
+
+    def add_song(self, title, list_type):
+        response = self.client.post(
+            f'/api/add-song/?session_id=800001&list_type={list_type}&artist_name=Artist&song_title={title}')
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def next_song(self):
+        response = self.client.post('/api/next-song/', {'session_id': '800001'}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_played_songs_leave_the_song_table(self, *mocks):
+        self.add_song('Queued', 'playlist')
+        self.add_song('Vibe', 'playlist,vibe')
+
+        self.assertEqual(self.next_song()['song']['history_sequence'], 1)
+        self.next_song()
+
+        # only the vibe row is left, out of the playlist
+        remaining = list(self.songs.filter(session=self.session).values_list(
+            'track_id', 'playlist_sequence', 'vibe_sequence'))
+        self.assertEqual(len(remaining), 1)
+        self.assertEqual(track_titles([remaining[0][0]]), ['Vibe'])
+        self.assertEqual(remaining[0][1:], (0, 1))
+        history = list(PlayedSong.objects.using(shard_for('800001')).filter(session=self.session)
+                       .order_by('sequence').values_list('sequence', 'track_id', 'spotify_track_id'))
+        self.assertEqual(track_titles([track_id for _, track_id, _ in history]), ['Queued', 'Vibe'])
+        self.assertEqual([(sequence, spotify_id) for sequence, _, spotify_id in history],
+                         [(1, '4iV5W9uYEdYUVa79Axb7Rh'), (2, '4iV5W9uYEdYUVa79Axb7Rh')])
+
+        # a played song still counts as part of the session
+        response = self.client.post(
+            '/api/add-song/?session_id=800001&list_type=playlist&artist_name=Artist&song_title=Queued')
+        self.assertEqual(response.status_code, 400)
+
+    def test_history_pages_newest_first(self, *mocks):
+        for i in range(5):
+            self.add_song(f'Song {i}', 'playlist')
+            self.next_song()
+
+        first = self.client.get('/api/history/', {'session_id': '800001', 'limit': 2}).data
+        self.assertEqual([entry['song_title'] for entry in first['history']], ['Song 4', 'Song 3'])
+        second = self.client.get('/api/history/', {'session_id': '800001', 'limit': 2,
+                                                   'before': first['next_before']}).data
+        self.assertEqual([entry['song_title'] for entry in second['history']], ['Song 2', 'Song 1'])
+        last = self.client.get('/api/history/', {'session_id': '800001', 'limit': 2,
+                                                 'before': second['next_before']}).data
+        self.assertEqual([entry['song_title'] for entry in last['history']], ['Song 0'])
+        self.assertIsNone(last['next_before'])
+
+
+class TrackCatalogTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        cache.clear()
+        self.client = APIClient()
+        for session_id in ('900001', '900002'):
+            Session.objects.create(session_id=session_id)
+
+    def test_sessions_share_catalog_tracks(self):
+        for session_id, artist in (('900001', 'The Beatles'), ('900002', '  the  beatles ')):
+            response = self.client.post(f'/api/add-song/?session_id={session_id}&list_type=playlist'
+                                        f'&artist_name={artist}&song_title=Something')
+            self.assertEqual(response.status_code, 200, response.data)
+
+        self.assertEqual(Track.objects.count(), 1)
+        track = Track.objects.get()
+        for session_id in ('900001', '900002'):
+            self.assertEqual(Song.objects.using(shard_for(session_id)).get(session_id=session_id).track_id, track.pk)
+
+        # the song payload keeps its flat shape
+        songs = self.client.get('/api/get-songs/', {'session_id': '900002', 'list_type': 'playlist'}).data['songs']
+        self.assertEqual(songs[0]['artist_name'], 'The Beatles')
+        self.assertEqual(songs[0]['song_title'], 'Something')
+        self.assertEqual(songs[0]['playlist_sequence'], 1)
+
+    @mock.patch.object(NextSongView, '_play_track_on_spotify', return_value={'success': True})
+    @mock.patch.object(NextSongView, '_search_track_on_spotify', return_value=SPOTIFY_MATCH)
+    def test_spotify_match_is_searched_once(self, search, play):
+        for session_id in ('900001', '900002'):
+            self.client.post(f'/api/add-song/?session_id={session_id}&list_type=playlist'
+                             f'&artist_name=Artist&song_title=Something')
+            response = self.client.post('/api/next-song/', {'session_id': session_id}, format='json')
+            self.assertEqual(response.status_code, 200, response.data)
+            self.assertEqual(response.data['song']['duration_ms'], 215000)
+
+        # the second session plays the stored match
+        search.assert_called_once()
+        self.assertEqual(play.call_args.args[1], 'spotify:track:4iV5W9uYEdYUVa79Axb7Rh')
+        self.assertEqual(Track.objects.get().spotify_id, '4iV5W9uYEdYUVa79Axb7Rh')
+
+        # past SPOTIFY_RESOLVE_TTL the match is searched again
+        track = Track.objects.get()
+        self.assertIsNotNone(spotify_match(track))
+        self.assertIsNone(spotify_match(track, now=timezone.now() + timedelta(days=31)))
+
+
+@override_settings(SPOTIFY_SEARCH_INTERVAL=0, SPOTIFY_RESOLVE_AHEAD=2)
+class SpotifyPreResolutionTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        cache.clear()
+        self.client = APIClient()
+        self.session = Session.objects.create(session_id='910001')
+        for position, title in enumerate(['Known', 'Missing', 'Later'], start=1):
+            Song.objects.create(session=self.session, track=get_track(title, 'Artist'), playlist_sequence=position)
+
+    def search(self, access_token, song_title, artist_name):
+        return SPOTIFY_MATCH if song_title == 'Known' else None
+
+    def statuses(self):
+        songs = self.client.get('/api/get-songs/', {'session_id': '910001', 'list_type': 'playlist'}).data['songs']
+        return {song['song_title']: song['spotify_status'] for song in songs}
+
+    def test_upcoming_songs_are_resolved_ahead(self):
+        with mock.patch.object(resolver, 'search_spotify_track', side_effect=self.search) as search:
+            self.assertEqual(resolver.resolve_upcoming('910001', 'token'), 2)
+            # stored results, missing ones included, are not searched again
+            self.assertEqual(resolver.resolve_upcoming('910001', 'token'), 0)
+        self.assertEqual(search.call_count, 2)
+        self.assertEqual(self.statuses(), {'Known': 'resolved', 'Missing': 'unresolvable', 'Later': 'pending'})
+
+    @mock.patch.object(NextSongView, '_search_track_on_spotify')
+    def test_unresolvable_song_is_not_searched_inline(self, search):
+        with mock.patch.object(resolver, 'search_spotify_track', return_value=None):
+            resolver.resolve_upcoming('910001', 'token')
+        Song.objects.using(shard_for('910001')).filter(playlist_sequence=1).update(playlist_sequence=4)
+
+        response = self.client.post('/api/next-song/', {'session_id': '910001'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        search.assert_not_called()
+
+    def test_rate_limit_stops_the_batch(self):
+        with mock.patch.object(resolver, 'search_spotify_track', side_effect=resolver.SpotifyRateLimited(3)):
+            with self.assertRaises(resolver.SpotifyRateLimited):
+                resolver.resolve_upcoming('910001', 'token')
+        self.assertEqual(set(self.statuses().values()), {'pending'})
+
+    def test_sessions_without_spotify_token_are_not_queued(self):
+        with mock.patch.object(resolver, '_start_worker') as start:
+            resolver.schedule_resolution('910001', None)
+        start.assert_not_called()
+
+    def queued_job(self):
+        # schedule with the token the view saw, then take the job the worker would get
+        self.addCleanup(self.reset_worker_state)
+        with mock.patch.object(resolver, '_start_worker'):
+            resolver.schedule_resolution('910001', 'token seen by the view')
+        return resolver._queue.get_nowait()
+
+    def reset_worker_state(self):
+        with resolver._pending_lock:
+            resolver._pending.clear()
+            resolver._delayed.clear()
+        while not resolver._queue.empty():
+            resolver._queue.get_nowait()
+
+    @mock.patch.object(resolver, 'ensure_fresh_token', return_value='refreshed')
+    @mock.patch.object(resolver, 'resolve_upcoming')
+    def test_job_reads_the_token_when_it_runs(self, resolve, fresh):
+        Session.objects.using(shard_for('910001')).filter(pk='910001').update(
+            spotify_access_token='rotated', spotify_token_expires=timezone.now() + timedelta(seconds=10))
+        resolver.run_job(self.queued_job())
+        self.assertEqual(fresh.call_args.args[0].spotify_access_token, 'rotated')
+        resolve.assert_called_once_with('910001', 'refreshed')
+
+    @mock.patch.object(resolver, 'resolve_upcoming', side_effect=resolver.SpotifyRateLimited(30))
+    @mock.patch.object(resolver.time, 'sleep', side_effect=AssertionError('the worker must not sleep'))
+    def test_rate_limited_job_is_retried_later(self, sleep, resolve):
+        Session.objects.using(shard_for('910001')).filter(pk='910001').update(
+            spotify_access_token='token', spotify_token_expires=timezone.now() + timedelta(hours=1))
+        resolver.run_job(self.queued_job())
+        (due, session_id), = resolver._delayed
+        self.assertEqual(session_id, '910001')
+        self.assertAlmostEqual(due - time.monotonic(), 30, delta=1)
+        self.assertIn('910001', resolver._pending)  # a change meanwhile does not queue it twice
+
+
+@mock.patch('api.views.schedule_resolution')  # the session has a token, keep the resolver thread out
+@mock.patch.object(playback, '_start_worker')
+@mock.patch.object(NextSongView, '_play_track_on_spotify', return_value={'success': True})
+@mock.patch.object(NextSongView, '_search_track_on_spotify', return_value=SPOTIFY_MATCH)
+@override_settings(SCHEDULER_LEAD_MS=1000, SCHEDULER_DRIFT_MS=2000)
+class PlaybackSchedulerTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        cache.clear()
+        self.client = APIClient()
+        self.session = Session.objects.create(session_id='930001', spotify_access_token='token',
+                                              spotify_token_expires=timezone.now() + timedelta(hours=1))
+        for position, title in enumerate(['First', 'Second'], start=1):
+            Song.objects.create(session=self.session, track=get_track(title, 'Artist'), playlist_sequence=position)
+        self.addCleanup(playback.cancel, '930001')
+
+    def player(self, track_id='4iV5W9uYEdYUVa79Axb7Rh', progress_ms=200000, is_playing=True):
+        state = {'is_playing': is_playing, 'track_id': track_id, 'progress_ms': progress_ms, 'duration_ms': 215000}
+        return mock.patch.object(playback, 'read_playback', return_value=state)
+
+    def sync(self, **data):
+        response = self.client.post('/api/playback/sync/', {'session_id': '930001', **data}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data['playback']
+
+    def test_sync_plans_the_advance_from_one_read(self, *mocks):
+        with self.player() as read:
+            state = self.sync(auto_advance=True)
+        read.assert_called_once()
+        self.assertEqual(state['advance_in_ms'], 14000)
+        self.assertEqual(playback.plan_for('930001')['track_id'], '4iV5W9uYEdYUVa79Axb7Rh')
+
+        # paused in the Spotify app, nothing to advance
+        with self.player(is_playing=False):
+            self.assertIsNone(self.sync()['advance_in_ms'])
+        self.assertIsNone(playback.plan_for('930001'))
+
+    def test_played_song_is_planned_without_reading_the_player(self, *mocks):
+        playback.set_auto_advance('930001', True)
+        with mock.patch.object(playback, 'read_playback') as read:
+            self.client.post('/api/next-song/', {'session_id': '930001'}, format='json')
+        read.assert_not_called()
+        self.assertEqual(playback.plan_for('930001')['track_id'], '4iV5W9uYEdYUVa79Axb7Rh')
+
+        playback.set_auto_advance('930001', False)
+        self.assertIsNone(playback.plan_for('930001'))
+
+    def test_advance_plays_the_next_song_at_the_end(self, *mocks):
+        playback.set_auto_advance('930001', True)
+        with self.player(progress_ms=214500):
+            playback._advance('930001', '4iV5W9uYEdYUVa79Axb7Rh')
+        self.assertEqual(track_titles(list(PlayedSong.objects.using(shard_for('930001')).values_list(
+            'track_id', flat=True))), ['First'])
+        # and the song it started is planned in turn
+        self.assertIsNotNone(playback.plan_for('930001'))
+
+    def test_drift_is_replanned_instead_of_skipping(self, *mocks):
+        playback.set_auto_advance('930001', True)
+        with self.player(progress_ms=100000):  # seeked back in the Spotify app
+            playback._advance('930001', '4iV5W9uYEdYUVa79Axb7Rh')
+        self.assertFalse(PlayedSong.objects.using(shard_for('930001')).exists())
+        self.assertEqual(playback.plan_for('930001')['track_id'], '4iV5W9uYEdYUVa79Axb7Rh')
+
+
+class SessionEventsTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        cache.clear()
+        self.client = APIClient()
+        self.session = Session.objects.create(session_id='940001')
+        patcher = mock.patch.object(events, '_broker', events.LocalBroker())
+        self.broker = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def published(self):
+        return [(event['type'], event['data']) for event in self.broker._backlog['940001']]
+
+    def test_song_changes_carry_the_new_order(self):
+        self.broker.last_event_id('940001')  # a page read the snapshot, it subscribes next
+        response = self.client.post(
+            '/api/add-song/?session_id=940001&list_type=playlist&artist_name=Artist&song_title=One')
+        song_id = response.data['results']['song_id']
+        self.client.post(f'/api/remove-list/?session_id=940001&list_type=playlist&id={song_id}')
+
+        (added_type, added), (removed_type, removed) = self.published()
+        self.assertEqual(added_type, 'songs_added')
+        self.assertEqual([song['song_title'] for song in added['songs']], ['One'])
+        self.assertEqual(added['order'], {'playlist': [[song_id, 1]]})
+        self.assertEqual((removed_type, removed), ('songs_removed', {'ids': [song_id], 'order': {'playlist': []}}))
+
+    def test_unwatched_session_builds_no_events(self):
+        with CaptureQueriesContext(connections[shard_for('940001')]) as ctx:
+            self.assertIsNone(events.notify('940001', 'songs_reordered', lists=('playlist', 'vibe')))
+        self.assertFalse([q for q in ctx.captured_queries if 'api_song' in q['sql']])
+        self.assertNotIn('940001', self.broker._backlog)
+
+    def test_backlog_is_dropped_once_nobody_watches(self):
+        async def stream():
+            subscription, _, _ = self.broker.subscribe('940001')
+            events.notify('940001', 'lists_cleared')
+            self.broker.unsubscribe('940001', subscription)
+
+        asyncio.run(stream())
+        self.assertTrue(self.broker.wanted('940001'))  # kept for a reconnect
+        with override_settings(EVENTS_BACKLOG_TTL=0):
+            self.assertFalse(self.broker.wanted('940001'))
+        self.assertNotIn('940001', self.broker._backlog)
+
+    def test_reconnect_gets_the_missed_events(self):
+        async def stream():
+            first = self.broker.publish('940001', 'lists_cleared', {})
+            self.broker.publish('940001', 'songs_reordered', {})
+            _, queue, missed = self.broker.subscribe('940001', last_event_id=first['id'])
+            self.broker.publish('940001', 'now_playing', {})
+            return [event['type'] for event in missed], (await queue.get())['type']
+
+        self.assertEqual(asyncio.run(stream()), (['songs_reordered'], 'now_playing'))
+
+    @override_settings(EVENTS_QUEUE_SIZE=1)
+    def test_slow_subscriber_is_dropped(self):
+        async def stream():
+            _, queue, _ = self.broker.subscribe('940001')
+            for _ in range(3):
+                self.broker.publish('940001', 'songs_reordered', {})
+            await asyncio.sleep(0)  # let the loop deliver
+            return await queue.get()
+
+        self.assertIsNone(asyncio.run(stream()))  # end of stream, the page reconnects with Last-Event-ID
+        self.assertNotIn('940001', self.broker._subscribers)
+
+    def test_process_local_broker_is_flagged_for_deploys(self):
+        self.assertEqual([warning.id for warning in checks.check_events_broker(None)], ['api.W003'])
+        with override_settings(EVENTS_BROKER='example.SharedBroker'):
+            self.assertEqual(checks.check_events_broker(None), [])
+
+    @override_settings(SESSION_IDLE_TIMEOUT=60)
+    async def test_expired_session_opens_no_stream(self):
+        await Session.objects.using(shard_for('940001')).filter(session_id='940001').aupdate(last_active=timezone.now() - timedelta(minutes=5))
+        response = await AsyncClient().get('/api/events/', {'session_id': '940001'})
+        self.assertEqual(response.status_code, 404)
+
+    async def test_stream_replays_events_after_last_event_id(self):
+        first = self.broker.publish('940001', 'lists_cleared', {'order': {'vibe': []}})
+        self.broker.publish('940001', 'songs_removed', {'ids': [7]})
+        response = await AsyncClient().get('/api/events/', {'session_id': '940001'},
+                                           headers={'Last-Event-ID': str(first['id'])})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(await anext(chunks), b'retry: 3000\n\n')
+        self.assertEqual(await anext(chunks),
+                         f'id: {first["id"] + 1}\nevent: songs_removed\ndata: {{"ids": [7]}}\n\n'.encode())
+        await chunks.aclose()
+
+
+@mock.patch('api.views.schedule_resolution')
+@mock.patch.object(playback, '_start_worker')
+@override_settings(SPOTIFY_QUEUE_AHEAD=2)
+class QueueAheadTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        cache.clear()
+        self.client = APIClient()
+        self.session = Session.objects.create(session_id='950001', spotify_access_token='token',
+                                              spotify_token_expires=timezone.now() + timedelta(hours=1))
+        for position, title in enumerate(['First', 'Second', 'Third', 'Fourth'], start=1):
+            track = get_track(title, 'Artist')
+            save_spotify_match(track, {'id': f'id-{title}', 'uri': f'spotify:track:id-{title}', 'duration_ms': 1000})
+            Song.objects.create(session=self.session, track=track, playlist_sequence=position)
+        patcher = mock.patch.object(queue_ahead.spotify, 'post', return_value=mock.Mock(status_code=204))
+        self.post = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def playlist(self):
+        return track_titles(list(Song.objects.using(shard_for('950001')).filter(
+            playlist_sequence__gt=0).order_by('playlist_sequence').values_list('track_id', flat=True)))
+
+    def history(self):
+        return track_titles(list(PlayedSong.objects.using(shard_for('950001')).order_by(
+            'sequence').values_list('track_id', flat=True)))
+
+    def next_song(self):
+        return self.client.post('/api/next-song/', {'session_id': '950001'}, format='json')
+
+    @mock.patch.object(NextSongView, '_play_track_on_spotify', return_value={'success': True})
+    def test_next_songs_wait_in_spotifys_queue(self, play, *mocks):
+        self.next_song()
+        self.assertEqual([c.args[0] for c in self.post.call_args_list],
+                         ['/me/player/queue?uri=spotify%3Atrack%3Aid-Second',
+                          '/me/player/queue?uri=spotify%3Atrack%3Aid-Third'])
+
+        # Spotify moved on to Second by itself, the playlist catches up and the queue is topped up
+        session = session_cache.get_session('950001')
+        self.assertTrue(queue_ahead.observe(session, {'is_playing': True, 'track_id': 'id-Second'}))
+        self.assertEqual(self.history(), ['First', 'Second'])
+        self.assertEqual(self.playlist(), ['Third', 'Fourth'])
+        self.assertEqual([entry['spotify_id'] for entry in queue_ahead.queued('950001')], ['id-Third', 'id-Fourth'])
+
+    @mock.patch.object(NextSongView, '_play_track_on_spotify', return_value={'success': True})
+    @mock.patch.object(NextSongView, '_skip_on_spotify', return_value={'success': True})
+    def test_next_skips_to_a_queued_song(self, skip, play, *mocks):
+        self.next_song()
+        self.next_song()
+        play.assert_called_once()
+        skip.assert_called_once()
+        self.assertEqual(self.history(), ['First', 'Second'])
+        self.assertEqual([entry['spotify_id'] for entry in queue_ahead.queued('950001')], ['id-Third', 'id-Fourth'])
+
+    def test_songs_skipped_in_spotify_leave_the_playlist(self, *mocks):
+        session = session_cache.get_session('950001')
+        queue_ahead.fill(session)
+        queue_ahead.observe(session, {'is_playing': True, 'track_id': 'id-Second'})
+        self.assertEqual(self.history(), ['Second'])
+        self.assertEqual(self.playlist(), ['Third', 'Fourth'])
+
+
+class RecentlyPlayedSyncTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        cache.clear()
+        self.client = APIClient()
+        self.session = Session.objects.create(session_id='960001', spotify_access_token='token',
+                                              spotify_token_expires=timezone.now() + timedelta(hours=1))
+        self.started = self.session.created_date
+
+    def millis(self, minutes):
+        return int((self.started + timedelta(minutes=minutes)).timestamp() * 1000)
+
+    # a recently-played page, newest first like Spotify's
+    def page(self, *plays):
+        items = [{'played_at': (self.started + timedelta(minutes=minutes)).isoformat(),
+                  'track': {'id': f'id-{title}', 'name': title, 'uri': f'spotify:track:id-{title}',
+                            'duration_ms': 180000, 'artists': [{'name': 'Artist'}]}}
+                 for title, minutes in reversed(plays)]
+        cursors = {'after': str(self.millis(plays[-1][1]))} if plays else None
+        return mock.Mock(status_code=200, json=mock.Mock(return_value={'items': items, 'cursors': cursors}))
+
+    def history(self):
+        return track_titles(list(PlayedSong.objects.using(shard_for('960001')).order_by(
+            'sequence').values_list('track_id', flat=True)))
+
+    def sync(self):
+        return self.client.post('/api/history/sync/', {'session_id': '960001'}, format='json')
+
+    def test_only_plays_after_the_stored_cursor_are_fetched(self):
+        with mock.patch.object(recent_sync.spotify, 'get', return_value=self.page(('One', 4), ('Two', 8))) as get:
+            self.assertEqual(self.sync().json(), {'success': True, 'added': 2})
+        self.assertIn(f'after={self.millis(0)}', get.call_args.args[0])  # a first sync starts at the session
+        self.assertEqual(self.history(), ['One', 'Two'])
+        self.assertEqual(Session.objects.using(shard_for('960001')).get(session_id='960001').spotify_played_cursor,
+                         self.millis(8))
+
+        with mock.patch.object(recent_sync.spotify, 'get', return_value=self.page()) as get:
+            self.assertEqual(self.sync().json()['added'], 0)
+        self.assertIn(f'after={self.millis(8)}', get.call_args.args[0])
+        self.assertEqual(self.history(), ['One', 'Two'])
+
+    def test_plays_we_recorded_are_not_added_twice(self):
+        track = get_track('One', 'Artist')
+        song = Song.objects.create(session=self.session, track=track, vibe_sequence=1)
+        with mock.patch('django.utils.timezone.now', return_value=self.started + timedelta(minutes=1)):
+            mark_played('960001', song.id, track.pk, 'id-One')
+        Song.objects.create(session=self.session, track=get_track('Two', 'Artist'), vibe_sequence=2)
+
+        with mock.patch.object(recent_sync.spotify, 'get', return_value=self.page(('One', 4), ('Two', 8))):
+            self.assertEqual(self.sync().json()['added'], 1)
+        self.assertEqual(self.history(), ['One', 'Two'])
+        self.assertEqual(list(Song.objects.using(shard_for('960001')).order_by('vibe_sequence').values_list(
+            'is_played', flat=True)), [True, True])
+
+    def test_concurrent_syncs_record_a_play_once(self):
+        tracks = recent_sync._tracks
+        calls = []
+
+        # another request's sync commits while this one is between Spotify and its transaction
+        def tracks_after_a_concurrent_sync(plays):
+            calls.append(plays)
+            if len(calls) == 1:
+                self.assertEqual(recent_sync.sync_recently_played(self.session), 2)
+            return tracks(plays)
+
+        with mock.patch.object(recent_sync.spotify, 'get', return_value=self.page(('One', 4), ('Two', 8))), \
+                mock.patch.object(recent_sync, '_tracks', side_effect=tracks_after_a_concurrent_sync):
+            self.assertEqual(recent_sync.sync_recently_played(self.session), 0)
+        self.assertEqual(self.history(), ['One', 'Two'])
+
+    def test_history_page_syncs_at_most_once_per_interval(self):
+        with mock.patch.object(recent_sync.spotify, 'get', return_value=self.page(('One', 4))) as get:
+            self.client.get('/api/history/', {'session_id': '960001'})
+            response = self.client.get('/api/history/', {'session_id': '960001'})
+        get.assert_called_once()
+        self.assertEqual([entry['song_title'] for entry in response.json()['history']], ['One'])
+
+    def test_spotify_errors_are_reported(self):
+        with mock.patch.object(recent_sync.spotify, 'get', return_value=mock.Mock(status_code=401)):
+            response = self.sync()
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(self.history(), [])
+
+
+class PlayDeviceTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        cache.clear()
+        Session.objects.create(session_id='970001', spotify_access_token='token',
+                               spotify_token_expires=timezone.now() + timedelta(hours=1))
+        self.session = session_cache.get_session('970001', ('session_id', 'is_active', 'spotify_access_token'))
+
+    def play(self, *answers):
+        with mock.patch('api.views.spotify.put', side_effect=[mock.Mock(status_code=code) for code in answers]) as put, \
+                mock.patch.object(account_cache.client, 'get') as devices:
+            devices.return_value = mock.Mock(status_code=200, json=mock.Mock(return_value={
+                'devices': [{'id': 'speaker', 'is_active': False}]}))
+            result = NextSongView()._play_track_on_spotify(self.session, 'spotify:track:a')
+        return result, [c.args[0] for c in put.call_args_list], devices.call_count
+
+    def test_no_active_device_plays_on_the_remembered_one(self):
+        account_cache.remember_device('970001', 'phone')
+        result, urls, device_lists = self.play(404, 204)
+        self.assertTrue(result['success'])
+        self.assertEqual(urls[1], 'https://api.spotify.com/v1/me/player/play?device_id=phone')
+        self.assertEqual(device_lists, 0)
+
+    def test_first_listed_device_is_used_and_remembered(self):
+        result, urls, device_lists = self.play(404, 204)
+        self.assertTrue(result['success'])
+        self.assertEqual(urls[1], 'https://api.spotify.com/v1/me/player/play?device_id=speaker')
+        self.assertEqual(account_cache.remembered_device('970001'), 'speaker')
+
+
+class SessionSnapshotTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        cache.clear()
+        self.client = APIClient()
+        Session.objects.create(session_id='980001', spotify_access_token='token',
+                               spotify_token_expires=timezone.now() + timedelta(hours=1))
+        for i, (playlist, vibe) in enumerate([(2, 0), (1, 1), (0, 2)], 1):
+            Song.objects.using(shard_for('980001')).create(
+                session_id='980001', track=get_track(f'Song {i}', 'Artist'),
+                playlist_sequence=playlist, vibe_sequence=vibe, playlist_hist_sequence=0)
+        patcher = mock.patch.object(events, '_broker', events.LocalBroker())
+        self.broker = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_both_lists_come_from_one_song_query(self):
+        with CaptureQueriesContext(connections[shard_for('980001')]) as ctx:
+            response = self.client.get('/api/snapshot/', {'session_id': '980001'})
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual([song['song_title'] for song in response.data['playlist']], ['Song 2', 'Song 1'])
+        self.assertEqual([song['song_title'] for song in response.data['vibe']], ['Song 2', 'Song 3'])
+        self.assertEqual(len([q for q in ctx.captured_queries if 'FROM "api_song"' in q['sql']]), 1)
+        self.assertEqual(response.data['session'], {'session_id': '980001', 'is_active': True})
+
+    def test_now_playing_profile_and_last_event_id(self):
+        events.song_started('980001', {'id': 1, 'title': 'Song 1', 'duration_ms': 1000})
+        cache.set(account_cache._key(account_cache.PROFILE, 'Bearer token'), {'display_name': 'DJ'})
+        with mock.patch.object(account_cache.client, 'get') as spotify_get:
+            response = self.client.get('/api/snapshot/', {'session_id': '980001'})
+        spotify_get.assert_not_called()
+        self.assertEqual(response.data['now_playing']['title'], 'Song 1')
+        self.assertIn('started_at', response.data['now_playing'])
+        self.assertEqual(response.data['spotify'], {'connected': True, 'profile': {'display_name': 'DJ'}})
+        self.assertEqual(response.data['last_event_id'], self.broker.last_event_id())
+
+    def test_unknown_session(self):
+        self.assertEqual(self.client.get('/api/snapshot/', {'session_id': '980999'}).status_code, 404)
@@ -9,7 +9,13 @@ from .views import (
     # Playlist/Vibe management views
     AddPlaylistVibeView, GetSongsView, OrderPlaylistView, OrderVibeView,
     RemoveListView, ClearVibeView, RecommendView, AddRecommendationsView,
-    AddSongView, ClearSessionSongsView, NextSongView
+    AddSongView, ClearSessionSongsView, NextSongView, PlaybackSyncView,
+    # Live updates
+    SessionEventsView, SessionSnapshotView,
+    # Play history
+    HistoryView, HistorySyncView,
+    # Monitoring
+    MetricsView
 )
 
 
@@ -34,7 +40,13 @@ class APIRootView(APIView):
                     "clear_session_songs": "/api/clear-session-songs/ (POST)",
                     "get": "/api/recommend/ (GET)",
                     "add": "/api/add-recommendations/ (POST)",
-                    "next_song": "/api/next-song/ (POST)"
+                    "next_song": "/api/next-song/ (POST)",
+                    "playback_sync": "/api/playback/sync/ (POST)",
+                    "events": "/api/events/ (GET, text/event-stream)",
+                    "snapshot": "/api/snapshot/ (GET)",
+                    "history": "/api/history/ (GET)",
+                    "history_sync": "/api/history/sync/ (POST)",
+                    "metrics": "/api/metrics/ (GET)"
                 }
             
         })
@@ -73,4 +85,16 @@ urlpatterns = [
     
     # Next song functionality 
     path('next-song/', NextSongView.as_view(), name='next_song'),
+    path('playback/sync/', PlaybackSyncView.as_view(), name='playback_sync'),
+
+    # Live updates (server-sent events)
+    path('events/', SessionEventsView.as_view(), name='session_events'),
+    path('snapshot/', SessionSnapshotView.as_view(), name='session_snapshot'),
+
+    # Play history
+    path('history/', HistoryView.as_view(), name='history'),
+    path('history/sync/', HistorySyncView.as_view(), name='history_sync'),
+
+    # Monitoring
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
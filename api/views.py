@@ -1,16 +1,22 @@
+import asyncio
 import random
-import base64
-import requests
-from urllib.parse import urlencode, quote
 from django.db import models
 from django.conf import settings
-from django.http import HttpResponseRedirect
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import conditional_page
+from django.views import View
+from asgiref.sync import sync_to_async
 from rest_framework import viewsets
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from drf_spectacular.utils import extend_schema, OpenApiParameter
-from .models import Session, Song
+from spotify_api import account_cache, client as spotify
+from .models import Session, Song, PlayedSong
+from .catalog import get_track, save_spotify_match, spotify_match, spotify_unresolvable
 from .serializers import (
     SessionSerializer,
     SongSerializer,
@@ -26,6 +32,9 @@ from .serializers import (
     RemoveListResponseSerializer,
     ClearVibeResponseSerializer,
     RecommendResponseSerializer,
+    PlayedSongSerializer,
+    HistoryResponseSerializer,
+    SnapshotResponseSerializer,
 )
 from .helperfunctions import (
     find_artist,
@@ -34,21 +43,48 @@ from .helperfunctions import (
     get_top_tracks_for_artist_by_name,
 )
 from .recommendation_helpers import recommend_tracks
+from .authentication import SPOTIFY_SESSION_FIELDS, get_session_id, load_session, request_session
+from .permissions import MetricsAccess
+from .reaper import is_expired
+from .session_cache import invalidate_session
+from .events import broker, format_event, notify, now_playing, song_started
+from .playback import set_auto_advance, sync as sync_playback, track_started
+from .recent_sync import RecentSyncError, maybe_sync as maybe_sync_recently_played, sync_recently_played
+from .resolver import SpotifySearchError, schedule_resolution, search_spotify_track
+from .routers import shard_for
+from . import metrics, queue_ahead
+from .sequence_helpers import (
+    PLAYLIST,
+    VIBE,
+    HISTORY,
+    SessionInactive,
+    song_transaction,
+    allocate_sequence,
+    release_sequence,
+    reset_sequences,
+    mark_played,
+)
+
 
 
+# history page size for HistoryView
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+SNAPSHOT_HISTORY = 10  # history entries in /api/snapshot/
+
 
 # helper function to check if session is valid
-def validate_session(session_id):
-    if not session_id:
-        return False, Response({"error": "session_id required"}, status=400)
-    
-    try:
-        session = Session.objects.get(session_id=session_id)
-        if not session.is_active:
-            return False, Response({"error": "Session not active"}, status=400)
-        return True, None
-    except Session.DoesNotExist:
+# (the session was already resolved once by SessionIdAuthentication)
+def validate_session(request):
+    session = request_session(request)
+    if session is None:
+        if not get_session_id(request):
+            return False, Response({"error": "session_id required"}, status=400)
         return False, Response({"error": "Session not found"}, status=404)
+    
+    if not session.is_active:
+        return False, Response({"error": "Session not active"}, status=400)
+    return True, None
 
 
 class SessionViewSet(viewsets.ViewSet):
@@ -63,7 +99,7 @@ class SessionViewSet(viewsets.ViewSet):
     def start_session(self, request):
         # Generate random session ID - TODO: maybe use UUIDs instead?
         session_id = str(random.randint(100000, 999999))
-        while Session.objects.filter(session_id=session_id).exists():
+        while Session.objects.filter(pk=session_id).using(shard_for(session_id)).exists():
             session_id = str(random.randint(100000, 999999))
         
         session = Session.objects.create(session_id=session_id)
@@ -86,16 +122,14 @@ class SessionViewSet(viewsets.ViewSet):
     )
     @action(detail=True, methods=['delete'])
     def stop_session(self, request, pk=None):
-        try:
-            session = Session.objects.get(session_id=pk)
-            session.is_active = False
-            session.save()
-            return Response({
-                'session_id': session.session_id,
-                'message': 'Session deactivated successfully'
-            })
-        except Session.DoesNotExist:
+        # only the flag, a full-row save would roll back the concurrently bumped sequence counters
+        if not Session.objects.filter(session_id=pk).update(is_active=False):
             return Response({'error': 'Session not found'}, status=404)
+        invalidate_session(pk)
+        return Response({
+            'session_id': pk,
+            'message': 'Session deactivated successfully'
+        })
 
     @extend_schema(
         description='Check session status',
@@ -114,6 +148,8 @@ class SessionViewSet(viewsets.ViewSet):
     def check_session(self, request, pk=None):
         try:
             session = Session.objects.get(session_id=pk)
+            if is_expired(session):
+                return Response({'error': 'Session not found'}, status=404)
             serializer = SessionSerializer(session)
             return Response({'session': serializer.data})
         except Session.DoesNotExist:
@@ -129,7 +165,6 @@ class ArtistSearchLFMView(APIView):
     serializer_class = ArtistSearchResponseSerializer
     
     def get(self, request, *args, **kwargs):
-        session_id = request.query_params.get("session_id")
         artist_name = request.query_params.get("artist_name")
         
         if not artist_name:
@@ -181,12 +216,11 @@ class ArtistSearchSongLFMView(APIView):
         ]
     )
     def get(self, request, *args, **kwargs):
-        session_id = request.query_params.get("session_id")
         artist_name = request.query_params.get("artist_name")
         artist_mbid = request.query_params.get("artist_mbid")
         
         # Validate session
-        is_valid, error_response = validate_session(session_id)
+        is_valid, error_response = validate_session(request)
         if not is_valid:
             return error_response
         
@@ -228,12 +262,11 @@ class SongSearchLFMView(APIView):
         ]
     )
     def get(self, request, *args, **kwargs):
-        session_id = request.query_params.get("session_id")
         song_name = request.query_params.get("song_name")
         artist_name = request.query_params.get("artist_name")  # Optional parameter
         
         # Validate session
-        is_valid, error_response = validate_session(session_id)
+        is_valid, error_response = validate_session(request)
         if not is_valid:
             return error_response
         
@@ -247,6 +280,7 @@ class SongSearchLFMView(APIView):
 
 class AddPlaylistVibeView(APIView):
     serializer_class = AddPlaylistVibeResponseSerializer
+    session_fields = SPOTIFY_SESSION_FIELDS  # token for the Spotify pre-resolution
     
     @extend_schema(
         description='Add song to playlist and vibe with sequence management',
@@ -304,7 +338,7 @@ class AddPlaylistVibeView(APIView):
         popularity = request.query_params.get("popularity", 0)
         
         # Validate session
-        is_valid, error_response = validate_session(session_id)
+        is_valid, error_response = validate_session(request)
         if not is_valid:
             return error_response
         
@@ -315,7 +349,7 @@ class AddPlaylistVibeView(APIView):
             return Response({"error": "song_name required"}, status=400)
         
         try:
-            session = Session.objects.get(session_id=session_id)
+            session = request_session(request)
             
             # Convert popularity to int
             try:
@@ -323,31 +357,32 @@ class AddPlaylistVibeView(APIView):
             except:
                 popularity = 0
             
-            # Update existing vibe_sequence values - increment by 1
-            Song.objects.filter(session=session, vibe_sequence__gt=0).update(
-                vibe_sequence=models.F('vibe_sequence') + 1
-            )
-            
-            # Get max playlist_sequence and add 1
-            max_playlist_seq = Song.objects.filter(session=session).aggregate(
-                max_seq=models.Max('playlist_sequence')
-            )['max_seq']
-            new_playlist_sequence = (max_playlist_seq or 0) + 1
+            # Catalog entry first, it may live on another database than the session
+            track = get_track(song_name, artist_name, song_mbid, artist_mbid, popularity)
             
-            # Create new song
-            new_song = Song.objects.create(
-                session=session,
-                artist_id=artist_mbid,
-                artist_name=artist_name,
-                song_id=song_mbid,
-                song_title=song_name,
-                song_popularity=popularity,
-                vibe_sequence=1,  # Set to 1 (highest priority)
-                playlist_sequence=new_playlist_sequence,
-                playlist_hist_sequence=0,
-                is_playing=False,
-                is_played=False
-            )
+            with song_transaction(session_id):
+                # Update existing vibe_sequence values - increment by 1
+                Song.objects.filter(session=session, vibe_sequence__gt=0).update(
+                    vibe_sequence=models.F('vibe_sequence') + 1
+                )
+                allocate_sequence(session_id, VIBE)  # vibe list grows by one
+                
+                # Next free playlist position from the session counter
+                new_playlist_sequence = allocate_sequence(session_id, PLAYLIST)
+                
+                # Create new song
+                new_song = Song.objects.create(
+                    session=session,
+                    track=track,
+                    vibe_sequence=1,  # Set to 1 (highest priority)
+                    playlist_sequence=new_playlist_sequence,
+                    playlist_hist_sequence=0,
+                    is_playing=False,
+                    is_played=False
+                )
+            schedule_resolution(session_id, session.spotify_access_token)
+            notify(session_id, "songs_added", lists=("playlist", "vibe"),
+                   songs=SongSerializer([new_song], many=True).data)
             
             return Response({
                 "success": True,
@@ -357,8 +392,8 @@ class AddPlaylistVibeView(APIView):
                 "playlist_sequence": new_song.playlist_sequence
             })
             
-        except Session.DoesNotExist:
-            return Response({"error": "Session not found"}, status=404)
+        except SessionInactive:
+            return Response({"error": "Session not active"}, status=400)
         except Exception as e:
             return Response({"error": f"Failed to add song: {str(e)}"}, status=500)
 
@@ -387,11 +422,10 @@ class GetSongsView(APIView):
         ]
     )
     def get(self, request, *args, **kwargs):
-        session_id = request.query_params.get("session_id")
         list_type = request.query_params.get("list_type")
         
         # Validate session
-        is_valid, error_response = validate_session(session_id)
+        is_valid, error_response = validate_session(request)
         if not is_valid:
             return error_response
         
@@ -402,7 +436,7 @@ class GetSongsView(APIView):
             return Response({"error": "list_type must be 'playlist' or 'vibe'"}, status=400)
         
         try:
-            session = Session.objects.get(session_id=session_id)
+            session = request_session(request)
             
             if list_type == 'playlist':
                 # Get playlist songs ordered by sequence
@@ -410,14 +444,14 @@ class GetSongsView(APIView):
                     session=session,
                     playlist_sequence__isnull=False,
                     playlist_sequence__gt=0
-                ).order_by('playlist_sequence')
+                ).order_by('playlist_sequence').prefetch_related('track__artist')
             else:  # vibe
                 # Get vibe songs ordered by sequence
                 songs = Song.objects.filter(
                     session=session,
                     vibe_sequence__isnull=False,
                     vibe_sequence__gt=0
-                ).order_by('vibe_sequence')
+                ).order_by('vibe_sequence').prefetch_related('track__artist')
             
             return Response({
                 "success": True,
@@ -425,14 +459,13 @@ class GetSongsView(APIView):
                 "songs": SongSerializer(songs, many=True).data
             })
             
-        except Session.DoesNotExist:
-            return Response({"error": "Session not found"}, status=404)
         except Exception as e:
             return Response({"error": f"Failed to retrieve songs: {str(e)}"}, status=500)
 
 
 class OrderPlaylistView(APIView):
     serializer_class = OrderPlaylistResponseSerializer
+    session_fields = SPOTIFY_SESSION_FIELDS  # token for the Spotify pre-resolution
     
     @extend_schema(
         description='Update playlist sequence order for multiple songs',
@@ -467,7 +500,7 @@ class OrderPlaylistView(APIView):
         session_id = request.query_params.get("session_id")
         
         # Validate session
-        is_valid, error_response = validate_session(session_id)
+        is_valid, error_response = validate_session(request)
         if not is_valid:
             return error_response
         
@@ -481,22 +514,25 @@ class OrderPlaylistView(APIView):
             return Response({"error": "Invalid data format", "details": serializer.errors}, status=400)
         
         try:
-            session = Session.objects.get(session_id=session_id)
+            session = request_session(request)
             updated_count = 0
             
-            # Update each song's playlist_sequence
-            for item in serializer.validated_data:
-                song_id = item['id']
-                new_sequence = item['playlist_sequence']
-                
-                # Update the song if it exists and belongs to the session
-                updated = Song.objects.filter(
-                    id=song_id,
-                    session=session
-                ).update(playlist_sequence=new_sequence)
-                
-                if updated:
-                    updated_count += 1
+            # Update each song's playlist_sequence (one transaction, one commit)
+            with song_transaction(session_id):
+                for item in serializer.validated_data:
+                    song_id = item['id']
+                    new_sequence = item['playlist_sequence']
+                    
+                    # Update the song if it exists and belongs to the session
+                    updated = Song.objects.filter(
+                        id=song_id,
+                        session=session
+                    ).update(playlist_sequence=new_sequence)
+                    
+                    if updated:
+                        updated_count += 1
+            schedule_resolution(session_id, session.spotify_access_token)
+            notify(session_id, "songs_reordered", lists=("playlist",))
             
             return Response({
                 "success": True,
@@ -504,8 +540,6 @@ class OrderPlaylistView(APIView):
                 "updated_songs": updated_count
             })
             
-        except Session.DoesNotExist:
-            return Response({"error": "Session not found"}, status=404)
         except Exception as e:
             return Response({"error": f"Failed to update playlist order: {str(e)}"}, status=500)
 
@@ -546,7 +580,7 @@ class OrderVibeView(APIView):
         session_id = request.query_params.get("session_id")
         
         # Validate session
-        is_valid, error_response = validate_session(session_id)
+        is_valid, error_response = validate_session(request)
         if not is_valid:
             return error_response
         
@@ -560,22 +594,24 @@ class OrderVibeView(APIView):
             return Response({"error": "Invalid data format", "details": serializer.errors}, status=400)
         
         try:
-            session = Session.objects.get(session_id=session_id)
+            session = request_session(request)
             updated_count = 0
             
-            # Update each song's vibe_sequence
-            for item in serializer.validated_data:
-                song_id = item['id']
-                new_sequence = item['vibe_sequence']
-                
-                # Update the song if it exists and belongs to the session
-                updated = Song.objects.filter(
-                    id=song_id,
-                    session=session
-                ).update(vibe_sequence=new_sequence)
-                
-                if updated:
-                    updated_count += 1
+            # Update each song's vibe_sequence (one transaction, one commit)
+            with song_transaction(session_id):
+                for item in serializer.validated_data:
+                    song_id = item['id']
+                    new_sequence = item['vibe_sequence']
+                    
+                    # Update the song if it exists and belongs to the session
+                    updated = Song.objects.filter(
+                        id=song_id,
+                        session=session
+                    ).update(vibe_sequence=new_sequence)
+                    
+                    if updated:
+                        updated_count += 1
+            notify(session_id, "songs_reordered", lists=("vibe",))
             
             return Response({
                 "success": True,
@@ -583,14 +619,13 @@ class OrderVibeView(APIView):
                 "updated_songs": updated_count
             })
             
-        except Session.DoesNotExist:
-            return Response({"error": "Session not found"}, status=404)
         except Exception as e:
             return Response({"error": f"Failed to update vibe order: {str(e)}"}, status=500)
 
 
 class RemoveListView(APIView):
     serializer_class = RemoveListResponseSerializer
+    session_fields = SPOTIFY_SESSION_FIELDS  # token for the Spotify pre-resolution
     
     @extend_schema(
         description='Remove a song from playlist or vibe list and reorder sequences',
@@ -625,7 +660,7 @@ class RemoveListView(APIView):
         song_id = request.query_params.get("id")
         
         # Validate session
-        is_valid, error_response = validate_session(session_id)
+        is_valid, error_response = validate_session(request)
         if not is_valid:
             return error_response
         
@@ -643,51 +678,57 @@ class RemoveListView(APIView):
             return Response({"error": "id must be a valid integer"}, status=400)
         
         try:
-            session = Session.objects.get(session_id=session_id)
-            
-            # Check if song exists and belongs to the session
-            try:
-                song_to_remove = Song.objects.get(id=song_id, session=session)
-            except Song.DoesNotExist:
-                return Response({"error": "Song not found in this session"}, status=404)
+            session = request_session(request)
             
-            if list_type == 'playlist':
-                # Get the current playlist_sequence to remove
-                removed_sequence = song_to_remove.playlist_sequence
-                
-                # Set playlist_sequence to 0 for the removed song
-                song_to_remove.playlist_sequence = 0
-                song_to_remove.save()
+            with song_transaction(session_id):
+                # Check if song exists and belongs to the session (read under the session lock)
+                try:
+                    song_to_remove = Song.objects.get(id=song_id, session=session)
+                except Song.DoesNotExist:
+                    return Response({"error": "Song not found in this session"}, status=404)
                 
-                # Reorder remaining songs (move all higher sequences down by 1)
-                if removed_sequence and removed_sequence > 0:
-                    reordered_count = Song.objects.filter(
-                        session=session,
-                        playlist_sequence__gt=removed_sequence
-                    ).update(playlist_sequence=models.F('playlist_sequence') - 1)
-                else:
-                    reordered_count = 0
+                if list_type == 'playlist':
+                    # Get the current playlist_sequence to remove
+                    removed_sequence = song_to_remove.playlist_sequence
                     
-                list_name = "playlist"
-                
-            else:  # list_type == 'vibe'
-                # Get the current vibe_sequence to remove
-                removed_sequence = song_to_remove.vibe_sequence
-                
-                # Set vibe_sequence to 0 for the removed song
-                song_to_remove.vibe_sequence = 0
-                song_to_remove.save()
-                
-                # Reorder remaining songs (move all higher sequences down by 1)
-                if removed_sequence and removed_sequence > 0:
-                    reordered_count = Song.objects.filter(
-                        session=session,
-                        vibe_sequence__gt=removed_sequence
-                    ).update(vibe_sequence=models.F('vibe_sequence') - 1)
-                else:
-                    reordered_count = 0
+                    # Set playlist_sequence to 0 for the removed song
+                    song_to_remove.playlist_sequence = 0
+                    song_to_remove.save(update_fields=['playlist_sequence'])
+                    
+                    # Reorder remaining songs (move all higher sequences down by 1)
+                    if removed_sequence and removed_sequence > 0:
+                        reordered_count = Song.objects.filter(
+                            session=session,
+                            playlist_sequence__gt=removed_sequence
+                        ).update(playlist_sequence=models.F('playlist_sequence') - 1)
+                        release_sequence(session_id, PLAYLIST)
+                    else:
+                        reordered_count = 0
+                        
+                    list_name = "playlist"
                     
-                list_name = "vibe"
+                else:  # list_type == 'vibe'
+                    # Get the current vibe_sequence to remove
+                    removed_sequence = song_to_remove.vibe_sequence
+                    
+                    # Set vibe_sequence to 0 for the removed song
+                    song_to_remove.vibe_sequence = 0
+                    song_to_remove.save(update_fields=['vibe_sequence'])
+                    
+                    # Reorder remaining songs (move all higher sequences down by 1)
+                    if removed_sequence and removed_sequence > 0:
+                        reordered_count = Song.objects.filter(
+                            session=session,
+                            vibe_sequence__gt=removed_sequence
+                        ).update(vibe_sequence=models.F('vibe_sequence') - 1)
+                        release_sequence(session_id, VIBE)
+                    else:
+                        reordered_count = 0
+                        
+                    list_name = "vibe"
+            if list_name == "playlist":
+                schedule_resolution(session_id, session.spotify_access_token)  # a new song moved up
+            notify(session_id, "songs_removed", lists=(list_name,), ids=[song_id])
             
             return Response({
                 "success": True,
@@ -696,8 +737,6 @@ class RemoveListView(APIView):
                 "reordered_songs": reordered_count
             })
             
-        except Session.DoesNotExist:
-            return Response({"error": "Session not found"}, status=404)
         except Exception as e:
             return Response({"error": f"Failed to remove song from list: {str(e)}"}, status=500)
 
@@ -721,19 +760,22 @@ class ClearVibeView(APIView):
         session_id = request.query_params.get("session_id")
         
         # Validate session
-        is_valid, error_response = validate_session(session_id)
+        is_valid, error_response = validate_session(request)
         if not is_valid:
             return error_response
         
         try:
-            session = Session.objects.get(session_id=session_id)
+            session = request_session(request)
             
-            # Set vibe_sequence = 0 for all songs in the session that have a vibe_sequence
-            cleared_count = Song.objects.filter(
-                session=session,
-                vibe_sequence__isnull=False,
-                vibe_sequence__gt=0
-            ).update(vibe_sequence=0)
+            with song_transaction(session_id):
+                # Set vibe_sequence = 0 for all songs in the session that have a vibe_sequence
+                cleared_count = Song.objects.filter(
+                    session=session,
+                    vibe_sequence__isnull=False,
+                    vibe_sequence__gt=0
+                ).update(vibe_sequence=0)
+                reset_sequences(session_id, VIBE)
+            notify(session_id, "lists_cleared", lists=("vibe",))
             
             return Response({
                 "success": True,
@@ -741,8 +783,6 @@ class ClearVibeView(APIView):
                 "cleared_songs": cleared_count
             })
             
-        except Session.DoesNotExist:
-            return Response({"error": "Session not found"}, status=404)
         except Exception as e:
             return Response({"error": f"Failed to clear vibe list: {str(e)}"}, status=500)
 
@@ -770,11 +810,10 @@ class RecommendView(APIView):
         ]
     )
     def get(self, request, *args, **kwargs):
-        session_id = request.query_params.get("session_id")
         artist_name = request.query_params.get("artist_name")
         
         # Validate session
-        is_valid, error_response = validate_session(session_id)
+        is_valid, error_response = validate_session(request)
         if not is_valid:
             return error_response
         
@@ -792,6 +831,7 @@ class RecommendView(APIView):
 
 class AddRecommendationsView(APIView):
     serializer_class = AddPlaylistVibeResponseSerializer
+    session_fields = SPOTIFY_SESSION_FIELDS  # token for the Spotify pre-resolution
     
     @extend_schema(
         description='Get track recommendations and add them to session playlist/vibe with popularity data',
@@ -833,7 +873,7 @@ class AddRecommendationsView(APIView):
         add_to_vibe = request.query_params.get("add_to_vibe", "true").lower() == "true"
         
         # Validate session
-        is_valid, error_response = validate_session(session_id)
+        is_valid, error_response = validate_session(request)
         if not is_valid:
             return error_response
         
@@ -841,8 +881,8 @@ class AddRecommendationsView(APIView):
             return Response({"error": "artist_name required"}, status=400)
         
         try:
-            # Get session object
-            session = Session.objects.get(session_id=session_id)
+            # Session resolved by SessionIdAuthentication
+            session = request_session(request)
             
             # Get recommendations using the sophisticated algorithm
             recommendations_data = recommend_tracks(artist_name)
@@ -858,6 +898,7 @@ class AddRecommendationsView(APIView):
             
             added_songs = []
             added_count = 0
+            new_songs = []
             
             for rec in recommendations:
                 song_name = rec.get("name", "")
@@ -869,12 +910,16 @@ class AddRecommendationsView(APIView):
                 if not song_name or not artist_name_rec:
                     continue
                 
-                # Check if song already exists in this session
+                track = get_track(song_name, artist_name_rec, song_mbid, artist_mbid, popularity)
+                
+                # Check if song already exists in this session (queued, in the vibe or already played)
                 existing_song = Song.objects.filter(
                     session=session,
-                    song_title=song_name,
-                    artist_name=artist_name_rec
-                ).first()
+                    track=track
+                ).exists() or PlayedSong.objects.filter(
+                    session=session,
+                    track=track
+                ).exists()
                 
                 if existing_song:
                     continue  # Skip if already exists
@@ -883,38 +928,24 @@ class AddRecommendationsView(APIView):
                 vibe_sequence = None
                 playlist_sequence = None
                 
-                if add_to_vibe:
-                    max_vibe_seq = Song.objects.filter(
-                        session=session,
-                        vibe_sequence__isnull=False
-                    ).aggregate(
-                        max_seq=models.Max('vibe_sequence')
-                    )['max_seq']
-                    vibe_sequence = (max_vibe_seq or 0) + 1
-                
-                if add_to_playlist:
-                    max_playlist_seq = Song.objects.filter(
+                with song_transaction(session_id):
+                    if add_to_vibe:
+                        vibe_sequence = allocate_sequence(session_id, VIBE)
+                    
+                    if add_to_playlist:
+                        playlist_sequence = allocate_sequence(session_id, PLAYLIST)
+                    
+                    # Create new song record
+                    new_song = Song.objects.create(
                         session=session,
-                        playlist_sequence__isnull=False
-                    ).aggregate(
-                        max_seq=models.Max('playlist_sequence')
-                    )['max_seq']
-                    playlist_sequence = (max_playlist_seq or 0) + 1
-                
-                # Create new song record
-                new_song = Song.objects.create(
-                    session=session,
-                    artist_id=artist_mbid,
-                    artist_name=artist_name_rec,
-                    song_id=song_mbid,
-                    song_title=song_name,
-                    song_popularity=popularity,  # Use popularity from recommendation
-                    vibe_sequence=vibe_sequence,
-                    playlist_sequence=playlist_sequence,
-                    playlist_hist_sequence=0,
-                    is_playing=False,
-                    is_played=False
-                )
+                        track=track,  # catalog entry carries the popularity from the recommendation
+                        vibe_sequence=vibe_sequence,
+                        playlist_sequence=playlist_sequence,
+                        playlist_hist_sequence=0,
+                        is_playing=False,
+                        is_played=False
+                    )
+                new_songs.append(new_song)
                 
                 added_songs.append({
                     "song_title": song_name,
@@ -924,6 +955,12 @@ class AddRecommendationsView(APIView):
                     "playlist_sequence": playlist_sequence
                 })
                 added_count += 1
+            if add_to_playlist and added_count:
+                schedule_resolution(session_id, session.spotify_access_token)
+            if new_songs:
+                notify(session_id, "songs_added", lists=[name for name, added in
+                                                         (("playlist", add_to_playlist), ("vibe", add_to_vibe)) if added],
+                       songs=SongSerializer(new_songs, many=True).data)
             
             return Response({
                 "results": {
@@ -935,12 +972,15 @@ class AddRecommendationsView(APIView):
                 }
             })
             
+        except SessionInactive:
+            return Response({"error": "Session not active"}, status=400)
         except Exception as e:
             return Response({"error": f"Failed to add recommendations: {str(e)}"}, status=500)
 
 
 class AddSongView(APIView):
     serializer_class = AddPlaylistVibeResponseSerializer
+    session_fields = SPOTIFY_SESSION_FIELDS  # token for the Spotify pre-resolution
     
     @extend_schema(
         description='Add a song to playlist and/or vibe with flexible list_type parameter',
@@ -1006,7 +1046,7 @@ class AddSongView(APIView):
         song_popularity = request.query_params.get("song_popularity", "0")
         
         # Validate session
-        is_valid, error_response = validate_session(session_id)
+        is_valid, error_response = validate_session(request)
         if not is_valid:
             return error_response
         
@@ -1036,15 +1076,20 @@ class AddSongView(APIView):
             popularity = 0
         
         try:
-            # Get session object
-            session = Session.objects.get(session_id=session_id)
+            # Session resolved by SessionIdAuthentication
+            session = request_session(request)
+            
+            # Catalog entry first, it may live on another database than the session
+            track = get_track(song_title, artist_name, song_id, artist_id, popularity)
             
-            # Check if song already exists in this session
+            # Check if song already exists in this session (queued, in the vibe or already played)
             existing_song = Song.objects.filter(
                 session=session,
-                song_title=song_title,
-                artist_name=artist_name
-            ).first()
+                track=track
+            ).exists() or PlayedSong.objects.filter(
+                session=session,
+                track=track
+            ).exists()
             
             if existing_song:
                 return Response({"error": "Song already exists in this session"}, status=400)
@@ -1053,40 +1098,37 @@ class AddSongView(APIView):
             vibe_sequence = None
             playlist_sequence = None
             
-            if add_to_vibe:
-                # Increment all existing vibe sequences by 1
-                Song.objects.filter(
-                    session=session,
-                    vibe_sequence__isnull=False
-                ).update(vibe_sequence=models.F('vibe_sequence') + 1)
+            with song_transaction(session_id):
+                if add_to_vibe:
+                    # Increment all vibe sequences by 1 (0 = removed from vibe, leave those alone)
+                    Song.objects.filter(
+                        session=session,
+                        vibe_sequence__gt=0
+                    ).update(vibe_sequence=models.F('vibe_sequence') + 1)
+                    allocate_sequence(session_id, VIBE)  # vibe list grows by one
+                    
+                    # Set new song vibe_sequence = 1
+                    vibe_sequence = 1
                 
-                # Set new song vibe_sequence = 1
-                vibe_sequence = 1
-            
-            if add_to_playlist:
-                # Get max playlist_sequence and add 1
-                max_playlist_seq = Song.objects.filter(
+                if add_to_playlist:
+                    # Next free playlist position from the session counter
+                    playlist_sequence = allocate_sequence(session_id, PLAYLIST)
+                
+                # Create new song record
+                new_song = Song.objects.create(
                     session=session,
-                    playlist_sequence__isnull=False
-                ).aggregate(
-                    max_seq=models.Max('playlist_sequence')
-                )['max_seq']
-                playlist_sequence = (max_playlist_seq or 0) + 1
-            
-            # Create new song record
-            new_song = Song.objects.create(
-                session=session,
-                artist_id=artist_id,
-                artist_name=artist_name,
-                song_id=song_id,
-                song_title=song_title,
-                song_popularity=popularity,
-                vibe_sequence=vibe_sequence,
-                playlist_sequence=playlist_sequence,
-                playlist_hist_sequence=0,  # Always set to 0
-                is_playing=False,  # Always set to False
-                is_played=False    # Always set to False
-            )
+                    track=track,
+                    vibe_sequence=vibe_sequence,
+                    playlist_sequence=playlist_sequence,
+                    playlist_hist_sequence=0,  # Always set to 0
+                    is_playing=False,  # Always set to False
+                    is_played=False    # Always set to False
+                )
+            if add_to_playlist:
+                schedule_resolution(session_id, session.spotify_access_token)
+            notify(session_id, "songs_added", lists=[name for name, added in
+                                                     (("playlist", add_to_playlist), ("vibe", add_to_vibe)) if added],
+                   songs=SongSerializer([new_song], many=True).data)
             
             return Response({
                 "results": {
@@ -1100,6 +1142,8 @@ class AddSongView(APIView):
                 }
             })
             
+        except SessionInactive:
+            return Response({"error": "Session not active"}, status=400)
         except Exception as e:
             return Response({"error": f"Failed to add song: {str(e)}"}, status=500)
 
@@ -1149,16 +1193,21 @@ class ClearSessionSongsView(APIView):
         session_id = request.query_params.get("session_id")
         
         # Validate session
-        is_valid, error_response = validate_session(session_id)
+        is_valid, error_response = validate_session(request)
         if not is_valid:
             return error_response
         
         try:
-            session = Session.objects.get(session_id=session_id)
+            session = request_session(request)
             
-            # Delete all songs for this session
-            deleted_count = Song.objects.filter(session=session).count()
-            Song.objects.filter(session=session).delete()
+            with song_transaction(session_id):
+                # Delete all songs for this session, the play history included
+                deleted_count, _ = Song.objects.filter(session=session).delete()
+                deleted_history, _ = PlayedSong.objects.filter(session=session).delete()
+                deleted_count += deleted_history
+                reset_sequences(session_id, PLAYLIST, VIBE, HISTORY)
+            queue_ahead.forget(session_id)
+            notify(session_id, "lists_cleared", lists=("playlist", "vibe"))
             
             return Response({
                 "success": True,
@@ -1166,1186 +1215,203 @@ class ClearSessionSongsView(APIView):
                 "deleted_songs": deleted_count
             })
             
-        except Session.DoesNotExist:
-            return Response({"error": "Session not found"}, status=404)
         except Exception as e:
             return Response({"error": f"Failed to clear session songs: {str(e)}"}, status=500)
 
 
-# SPOTIFY
-
-def _auth_header(request):
-    """
-    Extract Spotify access token from Session model and format as Authorization header.
-    
-    Args:
-        request (HttpRequest): Django request object containing session_id parameter
-        
-    Returns:
-        dict: Authorization header with Bearer token, or None if no token exists
-        
-    Note:
-        Access tokens are stored in the Session model spotify_access_token field.
-        Tokens typically expire after 1 hour.
-    """
-    session_id = request.query_params.get("session_id") or request.data.get("session_id")
-    if not session_id:
-        return None
-    
-    try:
-        session = Session.objects.get(session_id=session_id)
-        token = session.spotify_access_token
-        if not token:
-            return None
-        return {"Authorization": f"Bearer {token}"}
-    except Session.DoesNotExist:
-        return None
-
+class HistoryView(APIView):
+    serializer_class = HistoryResponseSerializer
+    session_fields = SPOTIFY_SESSION_FIELDS  # token for the recently-played sync
 
-class SpotifyDevicesView(APIView):
-    """
-    Retrieve all available Spotify Connect devices for the authenticated user.
-    
-    Returns a list of devices where Spotify can play music, including:
-    - Desktop/mobile Spotify apps
-    - Web players
-    - Smart speakers and other Connect-enabled devices
-    - Device metadata: name, type, volume, active status
-    """
-    
     @extend_schema(
-        description='Get all available Spotify Connect devices for the authenticated user',
-        responses={
-            200: {
-                'type': 'object',
-                'properties': {
-                    'devices': {
-                        'type': 'array',
-                        'items': {
-                            'type': 'object',
-                            'properties': {
-                                'id': {'type': 'string', 'description': 'Device ID'},
-                                'is_active': {'type': 'boolean', 'description': 'Whether device is currently active'},
-                                'name': {'type': 'string', 'description': 'Device name'},
-                                'type': {'type': 'string', 'description': 'Device type (Computer, Smartphone, etc.)'},
-                                'volume_percent': {'type': 'integer', 'description': 'Device volume (0-100)'}
-                            }
-                        }
-                    }
-                }
-            },
-            401: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Authentication error'}
-                }
-            }
-        }
+        description='Songs played in this session, newest first, one page at a time',
+        parameters=[
+            OpenApiParameter(
+                name="session_id",
+                required=True,
+                type=str,
+                location=OpenApiParameter.QUERY,
+                description="Session ID"
+            ),
+            OpenApiParameter(
+                name="limit",
+                required=False,
+                type=int,
+                location=OpenApiParameter.QUERY,
+                description=f"Page size (default {HISTORY_PAGE_SIZE}, max {HISTORY_MAX_PAGE_SIZE})"
+            ),
+            OpenApiParameter(
+                name="before",
+                required=False,
+                type=int,
+                location=OpenApiParameter.QUERY,
+                description="Only entries older than this history sequence (next_before of the previous page)"
+            )
+        ]
     )
     def get(self, request, *args, **kwargs):
-        headers = _auth_header(request)
-        if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
-            
+        # Validate session
+        is_valid, error_response = validate_session(request)
+        if not is_valid:
+            return error_response
+
         try:
-            r = requests.get("https://api.spotify.com/v1/me/player/devices", headers=headers, timeout=15)
-            
-            # Handle different HTTP status codes
-            if r.status_code == 401:
-                return Response({"error": "Spotify token expired or invalid"}, status=401)
-            elif r.status_code == 403:
-                return Response({"error": "Spotify API access forbidden"}, status=403)
-            elif r.status_code == 429:
-                return Response({"error": "Spotify API rate limit exceeded"}, status=429)
-            elif r.status_code >= 500:
-                return Response({"error": f"Spotify API server error: {r.status_code}"}, status=502)
-            elif not r.ok:
-                return Response({"error": f"Spotify API error: {r.status_code}"}, status=r.status_code)
-            
-            # Try to parse JSON response
-            try:
-                return Response(r.json())
-            except ValueError:
-                # If JSON parsing fails, return the raw text or empty response
-                return Response({"devices": [], "error": "Invalid response from Spotify API"})
-                
-        except requests.exceptions.Timeout:
-            return Response({"error": "Spotify API request timed out"}, status=504)
-        except requests.exceptions.ConnectionError:
-            return Response({"error": "Unable to connect to Spotify API"}, status=503)
+            limit = min(int(request.query_params.get("limit", HISTORY_PAGE_SIZE)), HISTORY_MAX_PAGE_SIZE)
+            before = request.query_params.get("before")
+            before = int(before) if before else None
+        except ValueError:
+            return Response({"error": "limit and before must be integers"}, status=400)
+        if limit < 1:
+            return Response({"error": "limit must be positive"}, status=400)
+
+        try:
+            session = request_session(request)
+            if before is None:
+                maybe_sync_recently_played(session)  # plays from the Spotify apps, at most once a minute
+
+            # keyset pagination on (session, sequence), no OFFSET scans on long sessions
+            entries = PlayedSong.objects.filter(session=session)
+            if before is not None:
+                entries = entries.filter(sequence__lt=before)
+            page = list(entries.order_by('-sequence').prefetch_related('track__artist')[:limit + 1])
+
+            has_more = len(page) > limit
+            page = page[:limit]
+            return Response({
+                "success": True,
+                "history": PlayedSongSerializer(page, many=True).data,
+                "next_before": page[-1].sequence if has_more else None
+            })
+
         except Exception as e:
-            # Log the actual error for debugging
-            import logging
-            logging.error(f"SpotifyDevicesView error: {str(e)}")
-            return Response({"error": f"Internal error: {str(e)}"}, status=500)
+            return Response({"error": f"Failed to retrieve history: {str(e)}"}, status=500)
 
 
-class SpotifyCurrentlyPlayingView(APIView):
+class SessionSnapshotView(APIView):
     """
-    Get information about the user's current playback, including track details.
-    
-    Provides detailed information about the currently playing track:
-    - Track name, artist(s), album
-    - Playback progress and duration
-    - Playback context (playlist, album, etc.)
-    - Device information
+    Everything a page shows on load in one answer: session status, playlist,
+    vibe, the latest history entries, the song playing and the Spotify
+    connection.
+
+    One session resolution and one song query for both lists (their catalog
+    tracks are prefetched). The Spotify part comes from the server's caches
+    without a call to Spotify. Pages open /api/events/ from last_event_id to
+    keep it current.
     """
-    
+    serializer_class = SnapshotResponseSerializer
+    session_fields = SPOTIFY_SESSION_FIELDS  # connected or not, kept profile
+
     @extend_schema(
-        description='Get information about the currently playing track',
-        responses={
-            200: {
-                'type': 'object',
-                'properties': {
-                    'item': {
-                        'type': 'object',
-                        'properties': {
-                            'name': {'type': 'string', 'description': 'Track name'},
-                            'artists': {
-                                'type': 'array',
-                                'items': {
-                                    'type': 'object',
-                                    'properties': {
-                                        'name': {'type': 'string', 'description': 'Artist name'}
-                                    }
-                                }
-                            },
-                            'album': {
-                                'type': 'object',
-                                'properties': {
-                                    'name': {'type': 'string', 'description': 'Album name'}
-                                }
-                            },
-                            'duration_ms': {'type': 'integer', 'description': 'Track duration in milliseconds'}
-                        }
-                    },
-                    'progress_ms': {'type': 'integer', 'description': 'Current playback progress in milliseconds'},
-                    'is_playing': {'type': 'boolean', 'description': 'Whether track is currently playing'}
-                }
-            },
-            204: {
-                'type': 'object',
-                'properties': {
-                    'message': {'type': 'string', 'description': 'Nothing currently playing'}
-                }
-            },
-            401: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Authentication error'}
-                }
-            }
-        }
+        description='Session status, playlist, vibe, recent history and now playing in one call',
+        parameters=[
+            OpenApiParameter(
+                name="session_id",
+                required=True,
+                type=str,
+                location=OpenApiParameter.QUERY,
+                description="Session ID"
+            ),
+            OpenApiParameter(
+                name="history",
+                required=False,
+                type=int,
+                location=OpenApiParameter.QUERY,
+                description=f"History entries (default {SNAPSHOT_HISTORY}, max {HISTORY_MAX_PAGE_SIZE})"
+            )
+        ]
     )
     def get(self, request, *args, **kwargs):
-        headers = _auth_header(request)
-        if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
-            
+        is_valid, error_response = validate_session(request)
+        if not is_valid:
+            return error_response
+
         try:
-            r = requests.get("https://api.spotify.com/v1/me/player/currently-playing", headers=headers, timeout=15)
-            
-            if r.status_code == 204:  # No content - nothing playing
-                return Response({"message": "Nothing currently playing"})
-            elif r.status_code == 401:
-                return Response({"error": "Spotify token expired or invalid"}, status=401)
-            elif r.status_code == 403:
-                return Response({"error": "Spotify API access forbidden"}, status=403)
-            elif r.status_code == 429:
-                return Response({"error": "Spotify API rate limit exceeded"}, status=429)
-            elif r.status_code >= 500:
-                return Response({"error": f"Spotify API server error: {r.status_code}"}, status=502)
-            elif not r.ok:
-                return Response({"error": f"Spotify API error: {r.status_code}"}, status=r.status_code)
-            
-            # Try to parse JSON response
-            try:
-                return Response(r.json())
-            except ValueError:
-                return Response({"error": "Invalid response from Spotify API"}, status=502)
-                
-        except requests.exceptions.Timeout:
-            return Response({"error": "Spotify API request timed out"}, status=504)
-        except requests.exceptions.ConnectionError:
-            return Response({"error": "Unable to connect to Spotify API"}, status=503)
+            limit = min(int(request.query_params.get("history", SNAPSHOT_HISTORY)), HISTORY_MAX_PAGE_SIZE)
+        except ValueError:
+            return Response({"error": "history must be an integer"}, status=400)
+        if limit < 0:
+            return Response({"error": "history must not be negative"}, status=400)
+
+        try:
+            session = request_session(request)
+            # before reading, a change made meanwhile is replayed (and kept until the page subscribes)
+            last_event_id = broker().last_event_id(session.session_id)
+
+            songs = SongSerializer(
+                Song.objects.filter(session=session)
+                .filter(models.Q(playlist_sequence__gt=0) | models.Q(vibe_sequence__gt=0))
+                .prefetch_related('track__artist'),
+                many=True
+            ).data
+            history = list(PlayedSong.objects.filter(session=session)
+                           .order_by('-sequence').prefetch_related('track__artist')[:limit + 1])
+
+            token = session.spotify_access_token
+            return Response({
+                "success": True,
+                "session": {"session_id": session.session_id, "is_active": session.is_active},
+                "playlist": sorted([song for song in songs if (song["playlist_sequence"] or 0) > 0],
+                                   key=lambda song: song["playlist_sequence"]),
+                "vibe": sorted([song for song in songs if (song["vibe_sequence"] or 0) > 0],
+                               key=lambda song: song["vibe_sequence"]),
+                "history": PlayedSongSerializer(history[:limit], many=True).data,
+                "next_before": history[limit - 1].sequence if len(history) > limit and limit > 0 else None,
+                "now_playing": now_playing(session.session_id),
+                "spotify": {
+                    "connected": bool(token),
+                    "profile": account_cache.peek(account_cache.PROFILE, f"Bearer {token}") if token else None,
+                },
+                "last_event_id": last_event_id,
+            })
+
         except Exception as e:
-            import logging
-            logging.error(f"SpotifyCurrentlyPlayingView error: {str(e)}")
-            return Response({"error": f"Internal error: {str(e)}"}, status=500)
+            return Response({"error": f"Failed to load the session: {str(e)}"}, status=500)
 
 
-class SpotifyPlaybackStateView(APIView):
-    """
-    Get the user's complete playback state including device and settings.
-    
-    Returns comprehensive playback information:
-    - Currently playing track (if any)
-    - Active device details
-    - Shuffle and repeat mode settings
-    - Playback progress and volume
-    - Context information (playlist/album being played)
-    """
-    
+class MetricsView(APIView):
+    permission_classes = [MetricsAccess]
+
     @extend_schema(
-        description='Get complete playback state including device and settings',
+        description='Process counters (database routing, caches, Spotify calls)',
         responses={
             200: {
                 'type': 'object',
                 'properties': {
-                    'device': {
-                        'type': 'object',
-                        'properties': {
-                            'name': {'type': 'string', 'description': 'Device name'},
-                            'volume_percent': {'type': 'integer', 'description': 'Device volume'}
-                        }
-                    },
-                    'shuffle_state': {'type': 'boolean', 'description': 'Shuffle mode state'},
-                    'repeat_state': {'type': 'string', 'description': 'Repeat mode (off, context, track)'},
-                    'item': {'type': 'object', 'description': 'Currently playing track'},
-                    'is_playing': {'type': 'boolean', 'description': 'Whether playback is active'},
-                    'progress_ms': {'type': 'integer', 'description': 'Current playback progress'}
-                }
-            },
-            204: {
-                'type': 'object',
-                'properties': {
-                    'message': {'type': 'string', 'description': 'No active playback'}
-                }
-            },
-            401: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Authentication error'}
+                    'metrics': {'type': 'object', 'additionalProperties': {'type': 'integer'}}
                 }
             }
         }
     )
     def get(self, request, *args, **kwargs):
-        headers = _auth_header(request)
-        if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
-            
-        r = requests.get("https://api.spotify.com/v1/me/player", headers=headers, timeout=15)
-        
-        if r.status_code == 204:  # No content - nothing playing
-            return Response({"message": "No active playback"})
-        return Response(r.json())
+        return Response({"metrics": metrics.snapshot()})
 
 
-class SpotifyRecentTracksView(APIView):
+# SPOTIFY
+
+@method_decorator(conditional_page, name="dispatch")
+class SpotifyTokenView(APIView):
     """
-    Get the user's recently played tracks history.
-    
-    Returns the last 10 tracks played by the user, including:
-    - Track details (name, artist, album)
-    - Timestamp of when each track was played
-    - Context information (playlist/album source)
+    Base for views that call Spotify with the session's access token.
+
+    GET answers carry an ETag, a browser revalidating with If-None-Match
+    gets a bodiless 304.
     """
-    
-    @extend_schema(
-        description='Get recently played tracks history (last 10 tracks)',
-        responses={
-            200: {
-                'type': 'object',
-                'properties': {
-                    'items': {
-                        'type': 'array',
-                        'items': {
-                            'type': 'object',
-                            'properties': {
-                                'track': {
-                                    'type': 'object',
-                                    'properties': {
-                                        'name': {'type': 'string', 'description': 'Track name'},
-                                        'artists': {
-                                            'type': 'array',
-                                            'items': {
-                                                'type': 'object',
-                                                'properties': {
-                                                    'name': {'type': 'string', 'description': 'Artist name'}
-                                                }
-                                            }
-                                        }
-                                    }
-                                },
-                                'played_at': {'type': 'string', 'description': 'When track was played (ISO 8601)'},
-                                'context': {
-                                    'type': 'object',
-                                    'properties': {
-                                        'type': {'type': 'string', 'description': 'Context type (playlist, album, etc.)'},
-                                        'href': {'type': 'string', 'description': 'Context URL'}
-                                    }
-                                }
-                            }
-                        }
-                    }
-                }
-            },
-            401: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Authentication error'}
-                }
-            }
-        }
-    )
-    def get(self, request, *args, **kwargs):
-        headers = _auth_header(request)
-        if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
-            
-        r = requests.get("https://api.spotify.com/v1/me/player/recently-played?limit=10", headers=headers, timeout=15)
-        return Response(r.json())
+    session_fields = SPOTIFY_SESSION_FIELDS
 
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if request.method == "GET":
+            patch_cache_control(response, private=True, no_cache=True)  # per user, revalidate every time
+        return response
 
-class SpotifyUserProfileView(APIView):
+
+class NextSongView(SpotifyTokenView):
     """
-    Get the current user's Spotify profile information.
-    
-    Returns basic profile data for the authenticated user:
-    - Display name and user ID
-    - Profile images
-    - Follower count
-    - Country and subscription level (Premium/Free)
-    """
-    
-    @extend_schema(
-        description='Get current user\'s Spotify profile information',
-        responses={
-            200: {
-                'type': 'object',
-                'properties': {
-                    'display_name': {'type': 'string', 'description': 'User display name'},
-                    'id': {'type': 'string', 'description': 'User ID'},
-                    'images': {
-                        'type': 'array',
-                        'items': {
-                            'type': 'object',
-                            'properties': {
-                                'url': {'type': 'string', 'description': 'Profile image URL'}
-                            }
-                        }
-                    },
-                    'followers': {
-                        'type': 'object',
-                        'properties': {
-                            'total': {'type': 'integer', 'description': 'Follower count'}
-                        }
-                    },
-                    'country': {'type': 'string', 'description': 'User country'},
-                    'product': {'type': 'string', 'description': 'Subscription level (premium/free)'}
-                }
-            },
-            401: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Authentication error'}
-                }
-            }
-        }
-    )
-    def get(self, request, *args, **kwargs):
-        headers = _auth_header(request)
-        if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
-            
-        r = requests.get("https://api.spotify.com/v1/me", headers=headers, timeout=15)
-        return Response(r.json())
-
-
-class SpotifySearchTracksView(APIView):
-    """
-    Search for tracks using Spotify's search API.
-    
-    Searches across Spotify's catalog for matching tracks and returns
-    the first 10 results with complete metadata including:
-    - Track name and duration
-    - Artist(s) and album information
-    - Spotify URI for playback
-    - Preview URLs (if available)
-    - Popularity scores
-    """
-    
-    @extend_schema(
-        description='Search for tracks using Spotify\'s search API',
-        parameters=[
-            OpenApiParameter(
-                name="q",
-                required=True,
-                type=str,
-                location=OpenApiParameter.QUERY,
-                description="Search query string (artist, track, album, or combination)"
-            )
-        ],
-        responses={
-            200: {
-                'type': 'object',
-                'properties': {
-                    'tracks': {
-                        'type': 'object',
-                        'properties': {
-                            'items': {
-                                'type': 'array',
-                                'items': {
-                                    'type': 'object',
-                                    'properties': {
-                                        'name': {'type': 'string', 'description': 'Track name'},
-                                        'artists': {
-                                            'type': 'array',
-                                            'items': {
-                                                'type': 'object',
-                                                'properties': {
-                                                    'name': {'type': 'string', 'description': 'Artist name'}
-                                                }
-                                            }
-                                        },
-                                        'album': {
-                                            'type': 'object',
-                                            'properties': {
-                                                'name': {'type': 'string', 'description': 'Album name'}
-                                            }
-                                        },
-                                        'uri': {'type': 'string', 'description': 'Spotify URI for playback'},
-                                        'duration_ms': {'type': 'integer', 'description': 'Track duration'},
-                                        'popularity': {'type': 'integer', 'description': 'Popularity score (0-100)'}
-                                    }
-                                }
-                            },
-                            'total': {'type': 'integer', 'description': 'Total results available'},
-                            'limit': {'type': 'integer', 'description': 'Results limit'}
-                        }
-                    }
-                }
-            },
-            400: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Missing search query'}
-                }
-            },
-            401: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Authentication error'}
-                }
-            }
-        }
-    )
-    def get(self, request, *args, **kwargs):
-        query = request.query_params.get("q", "")
-        if not query:
-            return Response({"error": "No search query provided"}, status=400)
-        
-        headers = _auth_header(request)
-        if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
-        
-        try:
-            url = f"https://api.spotify.com/v1/search?q={query}&type=track&limit=10"
-            r = requests.get(url, headers=headers, timeout=15)
-            
-            if r.status_code == 401:
-                return Response({"error": "Spotify token expired or invalid"}, status=401)
-            elif r.status_code == 403:
-                return Response({"error": "Spotify API access forbidden"}, status=403)
-            elif r.status_code == 429:
-                return Response({"error": "Spotify API rate limit exceeded"}, status=429)
-            elif r.status_code >= 500:
-                return Response({"error": f"Spotify API server error: {r.status_code}"}, status=502)
-            elif not r.ok:
-                return Response({"error": f"Spotify API error: {r.status_code}"}, status=r.status_code)
-            
-            try:
-                return Response(r.json())
-            except ValueError:
-                return Response({"error": "Invalid response from Spotify API"}, status=502)
-                
-        except requests.exceptions.Timeout:
-            return Response({"error": "Spotify API request timed out"}, status=504)
-        except requests.exceptions.ConnectionError:
-            return Response({"error": "Unable to connect to Spotify API"}, status=503)
-        except Exception as e:
-            import logging
-            logging.error(f"SpotifySearchTracksView error: {str(e)}")
-            return Response({"error": f"Internal error: {str(e)}"}, status=500)
-
-
-class SpotifyPlayTrackView(APIView):
-    """
-    Start playback of a specific track by Spotify URI.
-    
-    This endpoint immediately starts playing the specified track,
-    interrupting any current playback. The track URI can be obtained
-    from search results or other Spotify API endpoints.
-    """
-    
-    @extend_schema(
-        description='Start playback of a specific track by Spotify URI',
-        parameters=[
-            OpenApiParameter(
-                name="device_id",
-                required=False,
-                type=str,
-                location=OpenApiParameter.QUERY,
-                description="Target device for playback (optional)"
-            )
-        ],
-        request={
-            'application/json': {
-                'type': 'object',
-                'properties': {
-                    'track_uri': {
-                        'type': 'string',
-                        'description': 'Spotify track URI (e.g., spotify:track:4iV5W9uYEdYUVa79Axb7Rh)'
-                    }
-                },
-                'required': ['track_uri'],
-                'example': {'track_uri': 'spotify:track:4iV5W9uYEdYUVa79Axb7Rh'}
-            }
-        },
-        responses={
-            200: {
-                'type': 'object',
-                'properties': {
-                    'status': {'type': 'integer', 'description': 'HTTP status from Spotify API'},
-                    'message': {'type': 'string', 'description': 'Result message'},
-                    'response': {'type': 'string', 'description': 'Response body from Spotify API'}
-                }
-            },
-            400: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Missing or invalid track URI'}
-                }
-            },
-            401: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Authentication error'}
-                }
-            }
-        }
-    )
-    def post(self, request, *args, **kwargs):
-        
-        headers = _auth_header(request)
-        if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
-        
-        track_uri = request.data.get("track_uri")
-        device_id = request.query_params.get("device_id")
-        
-        if not track_uri:
-            return Response({"error": "No track URI provided"}, status=400)
-        
-        try:
-            # Build Spotify API URL with optional device targeting
-            url = f"https://api.spotify.com/v1/me/player/play"
-            if device_id:
-                url += f"?device_id={device_id}"
-            
-            # Spotify expects URIs in an array format
-            payload = {"uris": [track_uri]}
-            
-            r = requests.put(url, headers=headers, json=payload, timeout=15)
-            
-            if r.status_code == 204:
-                return Response({
-                    "status": r.status_code,
-                    "message": "Track started successfully",
-                    "response": "No response body"
-                })
-            elif r.status_code == 401:
-                return Response({"error": "Spotify token expired or invalid"}, status=401)
-            elif r.status_code == 403:
-                return Response({"error": "Spotify API access forbidden"}, status=403)
-            elif r.status_code == 404:
-                return Response({"error": "No active device found. Open Spotify on a device first."}, status=404)
-            elif r.status_code == 429:
-                return Response({"error": "Spotify API rate limit exceeded"}, status=429)
-            elif r.status_code >= 500:
-                return Response({"error": f"Spotify API server error: {r.status_code}"}, status=502)
-            else:
-                return Response({
-                    "status": r.status_code,
-                    "message": "Error playing track",
-                    "response": r.text if r.text else "No response body",
-                    "error": f"Spotify API returned status {r.status_code}"
-                }, status=r.status_code)
-                
-        except requests.exceptions.Timeout:
-            return Response({"error": "Spotify API request timed out"}, status=504)
-        except requests.exceptions.ConnectionError:
-            return Response({"error": "Unable to connect to Spotify API"}, status=503)
-        except Exception as e:
-            import logging
-            logging.error(f"SpotifyPlayTrackView error: {str(e)}")
-            return Response({"error": f"Internal error: {str(e)}"}, status=500)
-
-
-class SpotifyPlayView(APIView):
-    """
-    Resume playbook or start a default playlist if no active context exists.
-    
-    This endpoint attempts to resume the current playback context (playlist,
-    album, or queue). If there's no active context to resume, it will
-    automatically start playing Spotify's "Today's Top Hits" playlist.
-    """
-    
-    @extend_schema(
-        description='Resume playback or start default playlist if no active context',
-        parameters=[
-            OpenApiParameter(
-                name="device_id",
-                required=False,
-                type=str,
-                location=OpenApiParameter.QUERY,
-                description="Target device for playback (optional)"
-            )
-        ],
-        responses={
-            200: {
-                'type': 'object',
-                'properties': {
-                    'status': {'type': 'integer', 'description': 'HTTP status from Spotify API'},
-                    'url': {'type': 'string', 'description': 'API URL called'},
-                    'headers_sent': {'type': 'boolean', 'description': 'Whether auth headers were sent'},
-                    'response': {'type': 'string', 'description': 'Response body from Spotify API'}
-                }
-            },
-            401: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Authentication error'}
-                }
-            }
-        }
-    )
-    def post(self, request, *args, **kwargs):
-        headers = _auth_header(request)
-        if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
-        
-        device_id = request.query_params.get("device_id")
-        url = f"https://api.spotify.com/v1/me/player/play"
-        if device_id:
-            url += f"?device_id={device_id}"
-        
-        # Step 1: Try to resume current playback context
-        r = requests.put(url, headers=headers, json={}, timeout=15)
-        
-        # Step 2: If no active context, start a popular playlist
-        if r.status_code == 404 and "Device not found" not in r.text:
-            # Fallback to Today's Top Hits playlist (globally popular playlist)
-            payload = {
-                "context_uri": "spotify:playlist:37i9dQZF1DXcBWIGoYBM5M",
-                "position_ms": 0  # Start from beginning
-            }
-            r = requests.put(url, headers=headers, json=payload, timeout=15)
-        
-        return Response({
-            "status": r.status_code,
-            "url": url,
-            "headers_sent": bool(headers.get("Authorization")),
-            "response": r.text if r.text else "No response body"
-        })
-
-
-class SpotifyPauseView(APIView):
-    """
-    Pause the user's currently active playback.
-    
-    This endpoint pauses playback on the specified or currently active device.
-    The playback position is preserved and can be resumed later.
-    """
-    
-    @extend_schema(
-        description='Pause currently active playback',
-        parameters=[
-            OpenApiParameter(
-                name="device_id",
-                required=False,
-                type=str,
-                location=OpenApiParameter.QUERY,
-                description="Target device to pause (optional)"
-            )
-        ],
-        responses={
-            200: {
-                'type': 'object',
-                'properties': {
-                    'status': {'type': 'integer', 'description': 'HTTP status from Spotify API (204 = success)'}
-                }
-            },
-            401: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Authentication error'}
-                }
-            }
-        }
-    )
-    def post(self, request, *args, **kwargs):
-        headers = _auth_header(request)
-        if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
-        
-        device_id = request.query_params.get("device_id")
-        url = f"https://api.spotify.com/v1/me/player/pause"
-        if device_id:
-            url += f"?device_id={device_id}"
-        
-        r = requests.put(url, headers=headers, timeout=15)
-        return Response({"status": r.status_code})
-
-
-class SpotifyNextTrackView(APIView):
-    """
-    Skip to the next track in the user's playback queue.
-    
-    This endpoint advances to the next track in the current playback context
-    (playlist, album, queue, etc.). If shuffle is enabled, the next track 
-    will be randomly selected from the remaining tracks in the context.
-    """
-    
-    @extend_schema(
-        description='Skip to the next track in playback queue',
-        parameters=[
-            OpenApiParameter(
-                name="device_id",
-                required=False,
-                type=str,
-                location=OpenApiParameter.QUERY,
-                description="Target device for the skip command (optional)"
-            )
-        ],
-        responses={
-            200: {
-                'type': 'object',
-                'properties': {
-                    'status': {'type': 'integer', 'description': 'HTTP status from Spotify API (204 = success)'}
-                }
-            },
-            401: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Authentication error'}
-                }
-            }
-        }
-    )
-    def post(self, request, *args, **kwargs):
-        headers = _auth_header(request)
-        if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
-        
-        device_id = request.query_params.get("device_id")
-        url = f"https://api.spotify.com/v1/me/player/next"
-        if device_id:
-            url += f"?device_id={device_id}"
-        
-        r = requests.post(url, headers=headers, timeout=15)
-        return Response({"status": r.status_code})
-
-
-class SpotifyAuthView(APIView):
-
-    @extend_schema(
-        description='Initiate Spotify OAuth flow. Returns authorization URL for JSON format or redirects for browser use.',
-        parameters=[
-            OpenApiParameter(
-                name="redirect_uri",
-                required=False,
-                type=str,
-                location=OpenApiParameter.QUERY,
-                description="Optional custom redirect URI (defaults to configured SPOTIFY_REDIRECT_URI)"
-            ),
-            OpenApiParameter(
-                name="format",
-                required=False,
-                type=str,
-                location=OpenApiParameter.QUERY,
-                description="Response format: 'json' returns authorization URL, 'redirect' redirects to Spotify",
-                enum=['json', 'redirect']
-            ),
-            OpenApiParameter(
-                name="session_id",
-                required=False,
-                type=str,
-                location=OpenApiParameter.QUERY,
-                description="Session ID to associate with Spotify tokens"
-            )
-        ],
-        responses={
-            200: {
-                'type': 'object',
-                'properties': {
-                    'authorization_url': {'type': 'string', 'description': 'Spotify authorization URL'},
-                    'client_id': {'type': 'string', 'description': 'Spotify client ID'},
-                    'redirect_uri': {'type': 'string', 'description': 'Configured redirect URI'},
-                    'scopes': {'type': 'string', 'description': 'Requested OAuth scopes'},
-                    'instructions': {'type': 'string', 'description': 'Usage instructions'}
-                }
-            },
-            302: {'description': 'Redirect to Spotify authorization page'},
-            500: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Error message'}
-                }
-            }
-        }
-    )
-    def get(self, request, *args, **kwargs):
-        # get spotify stuff from settings directly
-        try:
-            client_id = settings.SPOTIFY_CLIENT_ID
-            redirect_uri = request.query_params.get("redirect_uri", getattr(settings, "SPOTIFY_REDIRECT_URI", "http://127.0.0.1:8000/api/spotify/callback/"))
-        except Exception as e:
-            print("settings problem:", e)
-            return Response({"error": "spotify settings not set right"}, status=500)
-
-        scopes = "user-read-playback-state user-modify-playback-state user-read-currently-playing user-read-recently-played"
-        
-        # Get session_id and include it in the state parameter
-        session_id = request.query_params.get("session_id")
-        state = session_id if session_id else ""
-
-        qs = {
-            "client_id": client_id,
-            "response_type": "code",
-            "redirect_uri": redirect_uri,
-            "scope": scopes,
-            "state": state
-        }
-
-        url = "https://accounts.spotify.com/authorize?" + urlencode(qs)
-        
-        # Check if JSON response is requested or if this is an API call
-        response_format = request.query_params.get("format")
-        accept_header = request.headers.get('Accept', '')
-        
-        # Default to JSON for API calls (Swagger, curl with Accept: application/json, etc.)
-        # Default to redirect for browser calls
-        if response_format == "json" or (response_format != "redirect" and "application/json" in accept_header):
-            return Response({
-                "authorization_url": url,
-                "client_id": client_id,
-                "redirect_uri": redirect_uri,
-                "scopes": scopes,
-                "instructions": "Copy the authorization_url and open it in your browser to authorize the application"
-            })
-        
-        # Default behavior for browser: redirect to Spotify
-        return HttpResponseRedirect(url)
-
-    @extend_schema(
-        parameters=[
-            OpenApiParameter(name="code", required=True, type=str, location=OpenApiParameter.QUERY, description="auth code"),
-            OpenApiParameter(name="state", required=False, type=str, location=OpenApiParameter.QUERY, description="state param"),
-            OpenApiParameter(name="error", required=False, type=str, location=OpenApiParameter.QUERY, description="error from spotify"),
-            OpenApiParameter(name="session_id", required=True, type=str, location=OpenApiParameter.QUERY, description="session id")
-        ]
-    )
-    def post(self, request, *args, **kwargs):
-        # check for error
-        if request.query_params.get("error"):
-            return Response({"error": "spotify said no :("}, status=400)
-
-        code = request.query_params.get("code")
-        session_id = request.query_params.get("session_id")
-        
-        if not code:
-            return Response({"error": "missing code"}, status=400)
-            
-        if not session_id:
-            return Response({"error": "missing session_id"}, status=400)
-
-        try:
-            client_id = settings.SPOTIFY_CLIENT_ID
-            client_secret = settings.SPOTIFY_CLIENT_SECRET
-            redirect_uri = settings.SPOTIFY_REDIRECT_URI
-        except Exception as e:
-            print("settings problem:", e)
-            return Response({"error": "spotify settings not configured"}, status=500)
-
-        # auth header
-        try:
-            raw = f"{client_id}:{client_secret}".encode()
-            basic = base64.b64encode(raw).decode()
-        except Exception as e:
-            print("encoding err:", e)
-            return Response({"error": "could not make auth header"}, status=500)
-
-        data = {
-            "grant_type": "authorization_code",
-            "code": code,
-            "redirect_uri": redirect_uri
-        }
-
-        headers = {"Authorization": "Basic " + basic}
-
-        # request
-        try:
-            r = requests.post("https://accounts.spotify.com/api/token", data=data, headers=headers)
-        except Exception as e:
-            print("network err:", e)
-            return Response({"error": "network problem"}, status=500)
-
-        if r.status_code != 200:
-            # not super detailed
-            print("bad status:", r.status_code, r.text)
-            return Response({"error": "could not get tokens"}, status=r.status_code)
-
-        try:
-            tokens = r.json()
-        except Exception:
-            tokens = {}
-
-        # Store tokens in Session model instead of Django session
-        try:
-            session = Session.objects.get(session_id=session_id)
-            session.spotify_access_token = tokens.get("access_token", "")
-            session.spotify_refresh_token = tokens.get("refresh_token", "")
-            session.spotify_user_id = tokens.get("user_id", "")
-            
-            # Calculate expiry time
-            expires_in = tokens.get("expires_in", 3600)  # Default to 1 hour
-            from django.utils import timezone
-            import datetime
-            session.spotify_token_expires = timezone.now() + datetime.timedelta(seconds=expires_in)
-            
-            session.save()
-        except Session.DoesNotExist:
-            return Response({"error": "invalid session_id"}, status=400)
-
-        return Response({
-            "success": True,
-            "message": "ok",
-            "access_token": tokens.get("access_token", ""),
-            "token_type": tokens.get("token_type", ""),
-            "expires_in": tokens.get("expires_in", 0),
-            "scope": tokens.get("scope", "")
-        }, status=200)
-
-
-class SpotifyCallbackView(APIView):
-    @extend_schema(
-        description='Handle Spotify OAuth callback with authorization code',
-        parameters=[
-            OpenApiParameter(name="code", required=True, type=str, location=OpenApiParameter.QUERY, description="Authorization code from Spotify"),
-            OpenApiParameter(name="state", required=False, type=str, location=OpenApiParameter.QUERY, description="State parameter"),
-            OpenApiParameter(name="error", required=False, type=str, location=OpenApiParameter.QUERY, description="Error from Spotify")
-        ],
-        responses={
-            200: {
-                'type': 'object',
-                'properties': {
-                    'success': {'type': 'boolean', 'description': 'Whether authorization was successful'},
-                    'message': {'type': 'string', 'description': 'Success message'},
-                    'access_token': {'type': 'string', 'description': 'Access token'},
-                    'token_type': {'type': 'string', 'description': 'Token type'},
-                    'expires_in': {'type': 'integer', 'description': 'Token expiration time'},
-                    'scope': {'type': 'string', 'description': 'Granted scopes'}
-                }
-            },
-            400: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Error message'}
-                }
-            }
-        }
-    )
-    def get(self, request, *args, **kwargs):
-        # Handle the callback from Spotify (same logic as the old POST method)
-        # Check for error
-        if request.query_params.get("error"):
-            return HttpResponseRedirect("/?error=spotify_denied")
-
-        code = request.query_params.get("code")
-        state = request.query_params.get("state")  # This contains the session_id
-        
-        if not code:
-            return HttpResponseRedirect("/?error=missing_code")
-            
-        if not state:  # session_id is required
-            return HttpResponseRedirect("/?error=missing_session")
-
-        try:
-            client_id = settings.SPOTIFY_CLIENT_ID
-            client_secret = settings.SPOTIFY_CLIENT_SECRET
-            redirect_uri = settings.SPOTIFY_REDIRECT_URI
-        except Exception as e:
-            print("settings problem:", e)
-            return HttpResponseRedirect("/?error=spotify_settings")
-
-        # Auth header
-        try:
-            raw = f"{client_id}:{client_secret}".encode()
-            basic = base64.b64encode(raw).decode()
-        except Exception as e:
-            print("encoding err:", e)
-            return HttpResponseRedirect("/?error=encoding")
-
-        data = {
-            "grant_type": "authorization_code",
-            "code": code,
-            "redirect_uri": redirect_uri
-        }
-
-        headers = {"Authorization": "Basic " + basic}
-
-        # Request tokens
-        try:
-            r = requests.post("https://accounts.spotify.com/api/token", data=data, headers=headers)
-        except Exception as e:
-            print("network err:", e)
-            return HttpResponseRedirect("/?error=network")
-
-        if r.status_code != 200:
-            print("bad status:", r.status_code, r.text)
-            return HttpResponseRedirect("/?error=token_exchange")
-
-        try:
-            tokens = r.json()
-        except Exception:
-            tokens = {}
-
-        # Store tokens in Session model instead of Django session
-        try:
-            session = Session.objects.get(session_id=state)  # state contains session_id
-            session.spotify_access_token = tokens.get("access_token", "")
-            session.spotify_refresh_token = tokens.get("refresh_token", "")
-            session.spotify_user_id = tokens.get("user_id", "")
-            
-            # Calculate expiry time
-            expires_in = tokens.get("expires_in", 3600)  # Default to 1 hour
-            from django.utils import timezone
-            import datetime
-            session.spotify_token_expires = timezone.now() + datetime.timedelta(seconds=expires_in)
-            
-            session.save()
-            
-            # Redirect back to the Spotify section with success
-            return HttpResponseRedirect("/?spotify=connected")
-            
-        except Session.DoesNotExist:
-            return HttpResponseRedirect("/?error=invalid_session")
-
-
-class SpotifyRefreshTokenView(APIView):
-    @extend_schema(
-        description='Refresh Spotify access token using the refresh token stored in session',
-        request=None,
-        responses={
-            200: {
-                'type': 'object',
-                'properties': {
-                    'success': {'type': 'boolean', 'description': 'Whether refresh was successful'},
-                    'message': {'type': 'string', 'description': 'Success message'},
-                    'access_token': {'type': 'string', 'description': 'New access token'},
-                    'token_type': {'type': 'string', 'description': 'Token type (usually "Bearer")'},
-                    'expires_in': {'type': 'integer', 'description': 'Token expiration time in seconds'}
-                }
-            },
-            400: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Error message (no refresh token in session)'}
-                }
-            },
-            500: {
-                'type': 'object',
-                'properties': {
-                    'error': {'type': 'string', 'description': 'Error message (server configuration or network issues)'}
-                }
-            }
-        }
-    )
-    def post(self, request, *args, **kwargs):
-        session_id = request.data.get("session_id") or request.query_params.get("session_id")
-        if not session_id:
-            return Response({"error": "session_id required"}, status=400)
-        
-        # Get refresh token from Session model
-        try:
-            session = Session.objects.get(session_id=session_id)
-            refresh_token = session.spotify_refresh_token
-            if not refresh_token:
-                return Response({"error": "no refresh_token in session"}, status=400)
-        except Session.DoesNotExist:
-            return Response({"error": "invalid session_id"}, status=400)
-
-        # pull client creds straight from settings again
-        try:
-            cid = settings.SPOTIFY_CLIENT_ID
-            cs = settings.SPOTIFY_CLIENT_SECRET
-        except Exception as e:
-            print("settings problem:", e)
-            return Response({"error": "missing spotify creds"}, status=500)
-
-       #auth 
-        try:
-            raw2 = f"{cid}:{cs}".encode()
-            basic2 = base64.b64encode(raw2).decode()
-        except Exception as e:
-            print("encoding err:", e)
-            return Response({"error": "auth header fail"}, status=500)
-
-        stuff = {
-            "grant_type": "refresh_token",
-            "refresh_token": refresh_token
-        }
-        hdrs = {"Authorization": "Basic " + basic2}
-
-        try:
-            res = requests.post("https://accounts.spotify.com/api/token", data=stuff, headers=hdrs)
-        except Exception as e:
-            print("network err:", e)
-            return Response({"error": "network problem"}, status=500)
-
-        if res.status_code != 200:
-            print("refresh fail:", res.status_code, res.text)
-            return Response({"error": "refresh failed"}, status=res.status_code)
-
-        try:
-            new_tokens = res.json()
-        except Exception:
-            new_tokens = {}
-
-        # Update Session model
-        session.spotify_access_token = new_tokens.get("access_token", session.spotify_access_token)
-        
-        # Update expiry time if provided
-        expires_in = new_tokens.get("expires_in")
-        if expires_in:
-            from django.utils import timezone
-            import datetime
-            session.spotify_token_expires = timezone.now() + datetime.timedelta(seconds=expires_in)
-            
-        # Update refresh token if provided (sometimes Spotify provides a new one)
-        if "refresh_token" in new_tokens:
-            session.spotify_refresh_token = new_tokens["refresh_token"]
-            
-        session.save()
-
-        return Response({
-            "success": True,
-            "message": "refreshed",
-            "access_token": new_tokens.get("access_token", ""),
-            "token_type": new_tokens.get("token_type", ""),
-            "expires_in": new_tokens.get("expires_in", 0)
-        }, status=200)
-
-
-class NextSongView(APIView):
-    """
-    Play the next song from the playlist:
-    1. Get the #1 song from the playlist (lowest playlist_sequence)
-    2. Play the song via Spotify API
-    3. Move the song to playlist history 
-    4. Remove it from active playlist
+    Play the next song from the playlist:
+    1. Get the #1 song from the playlist (lowest playlist_sequence)
+    2. Play the song via Spotify API (track id from the catalog, searched only on a miss)
+    3. Append the song to the play history (PlayedSong)
+    4. Remove it from active playlist (the Song row is kept only while it is in the vibe list)
     """
     
     def post(self, request, *args, **kwargs):
@@ -2354,20 +1420,24 @@ class NextSongView(APIView):
         # Debug logging
         print(f"NextSongView: Received session_id: {session_id}")
         
-        valid, error_response = validate_session(session_id)
+        valid, error_response = validate_session(request)
         if not valid:
             print(f"NextSongView: Session validation failed")
             return error_response
-            
+        
+        return self.play_next(request_session(request))
+    
+    def play_next(self, session):
+        """Play the head of the session's playlist (also called by the playback scheduler)"""
+        session_id = session.session_id
         try:
-            session = Session.objects.get(session_id=session_id)
             print(f"NextSongView: Found session: {session}")
             
             # Get the first song in the playlist (lowest playlist_sequence, excluding 0)
             first_song = Song.objects.filter(
                 session=session,
                 playlist_sequence__gt=0
-            ).order_by('playlist_sequence').first()
+            ).order_by('playlist_sequence').prefetch_related('track__artist').first()
             
             print(f"NextSongView: Found first song: {first_song}")
             
@@ -2378,21 +1448,36 @@ class NextSongView(APIView):
                     "message": "Add some songs to your playlist first"
                 }, status=400)
             
-            # Search for the song on Spotify to get the track ID
-            spotify_track_id = self._search_track_on_spotify(session, first_song.song_title, first_song.artist_name)
+            track = first_song.track
+            
+            # Spotify track stored on the catalog track, search Spotify only if it was never resolved
+            match = spotify_match(track)
+            if match:
+                metrics.increment("spotify.resolve.hit")
+            elif spotify_unresolvable(track):
+                # a recent search (usually the pre-resolution worker) found nothing, don't repeat it
+                metrics.increment("spotify.resolve.unresolvable")
+            else:
+                metrics.increment("spotify.resolve.miss")
+                match = self._search_track_on_spotify(session, track.title, track.artist.name)
+                if match:
+                    match = save_spotify_match(track, match)
             
-            if not spotify_track_id:
+            if not match:
                 return Response({
                     "error": "Song not found on Spotify",
-                    "message": f"Could not find '{first_song.song_title}' by '{first_song.artist_name}' on Spotify"
+                    "message": f"Could not find '{track.title}' by '{track.artist.name}' on Spotify"
                 }, status=400)
             
-            # Build Spotify track URI with the found track ID
-            track_uri = f"spotify:track:{spotify_track_id}"
-            print(f"NextSongView: Built track URI: {track_uri}")
+            spotify_track_id = match["id"]
+            track_uri = match["uri"]
+            print(f"NextSongView: Track URI: {track_uri}")
             
-            # Call Spotify API to play the track
-            spotify_response = self._play_track_on_spotify(session, track_uri)
+            # Call Spotify API to play the track (skip to it when it already waits in Spotify's queue)
+            if queue_ahead.is_next(session_id, first_song.id):
+                spotify_response = self._skip_on_spotify(session)
+            else:
+                spotify_response = self._play_track_on_spotify(session, track_uri)
             print(f"NextSongView: Spotify response: {spotify_response}")
             
             if spotify_response.get('error'):
@@ -2401,49 +1486,29 @@ class NextSongView(APIView):
                     "details": spotify_response['error']
                 }, status=400)
             
-            # Move song to history - find the highest hist_sequence and add 1
-            max_hist_seq = Song.objects.filter(
-                session=session,
-                playlist_hist_sequence__isnull=False
-            ).aggregate(models.Max('playlist_hist_sequence'))['playlist_hist_sequence__max'] or 0
-            
-            # Update the song
-            first_song.playlist_hist_sequence = max_hist_seq + 1
-            first_song.is_played = True
-            first_song.is_playing = True
-            
-            # Remove from active playlist
-            removed_sequence = first_song.playlist_sequence
-            first_song.playlist_sequence = 0  # 0 means not in active playlist
-            first_song.save()
-            
-            # Reorder remaining playlist songs
-            remaining_songs = Song.objects.filter(
-                session=session,
-                playlist_sequence__gt=removed_sequence
-            ).order_by('playlist_sequence')
-            
-            reordered_count = 0
-            for song in remaining_songs:
-                song.playlist_sequence -= 1
-                song.save()
-                reordered_count += 1
-            
-            # Mark other songs as not currently playing
-            Song.objects.filter(
-                session=session,
-                is_playing=True
-            ).exclude(id=first_song.id).update(is_playing=False)
+            # Append the song to the history table and take it off the playlist
+            history_entry, reordered_count = mark_played(
+                session_id, first_song.id, first_song.track_id, spotify_track_id
+            )
+            queue_ahead.started(session_id, first_song.id)
+            schedule_resolution(session_id, session.spotify_access_token)  # queue moved up by one
+            queue_ahead.fill(session)
+            track_started(session_id, spotify_track_id, match["duration_ms"])  # next auto-advance
+            song = {
+                "id": first_song.id,
+                "title": track.title,
+                "artist": track.artist.name,
+                "song_id": track.mbid,
+                "spotify_track_id": spotify_track_id,
+                "duration_ms": match["duration_ms"],
+                "history_sequence": history_entry.sequence
+            }
+            song_started(session_id, song)
             
             return Response({
                 "success": True,
-                "message": f"Now playing: {first_song.song_title} by {first_song.artist_name}",
-                "song": {
-                    "id": first_song.id,
-                    "title": first_song.song_title,
-                    "artist": first_song.artist_name,
-                    "song_id": first_song.song_id
-                },
+                "message": f"Now playing: {track.title} by {track.artist.name}",
+                "song": song,
                 "playlist_reordered": reordered_count,
                 "spotify_response": spotify_response
             }, status=200)
@@ -2463,7 +1528,17 @@ class NextSongView(APIView):
         payload = {"uris": [track_uri]}
         
         try:
-            response = requests.put(url, json=payload, headers=headers, timeout=15)
+            response = spotify.put(url, json=payload, headers=headers)
+            if response.status_code == 404:
+                # no active device: the one this session played on last, else the first Spotify lists
+                device_id = account_cache.remembered_device(session.session_id) or account_cache.pick_device(
+                    account_cache.devices(headers["Authorization"]))
+                if device_id:
+                    response = spotify.put(f"{url}?device_id={device_id}", json=payload, headers=headers)
+                    if response.status_code in (200, 204):
+                        account_cache.remember_device(session.session_id, device_id)
+                    else:
+                        account_cache.forget_device(session.session_id)  # gone, list the devices next time
             
             if response.status_code == 204:
                 return {"success": True, "message": "Track started successfully"}
@@ -2479,38 +1554,186 @@ class NextSongView(APIView):
         except Exception as e:
             return {"error": f"Network error: {str(e)}"}
     
+    def _skip_on_spotify(self, session):
+        """Helper method to move Spotify to the next song of its own queue"""
+        headers = {"Authorization": f"Bearer {session.spotify_access_token}"}
+        try:
+            response = spotify.post("/me/player/next", headers=headers)
+        except Exception as e:
+            return {"error": f"Network error: {str(e)}"}
+        if response.status_code in (200, 204):
+            return {"success": True, "message": "Skipped to the queued track"}
+        return {"error": f"HTTP {response.status_code}"}
+
     def _search_track_on_spotify(self, session, song_title, artist_name):
-        """Helper method to search for a track on Spotify and get its ID"""
+        """Helper method to search for a track on Spotify, returns its id, uri and duration"""
         if not session.spotify_access_token:
             return None
         
-        headers = {"Authorization": f"Bearer {session.spotify_access_token}"}
+        try:
+            match = search_spotify_track(session.spotify_access_token, song_title, artist_name)
+        except SpotifySearchError as e:
+            print(f"Spotify search failed: {str(e)}")
+            return None
         
-        # Clean up the search query - remove special characters and extra spaces
-        query = f"track:{song_title} artist:{artist_name}"
-        query = query.replace('"', '').replace("'", "").strip()
+        if match:
+            print(f"Found Spotify track: {song_title} by {artist_name} (ID: {match['id']})")
+        else:
+            print(f"No Spotify tracks found for: {song_title} by {artist_name}")
+        return match
+
+
+class PlaybackSyncView(SpotifyTokenView):
+    """
+    Sync the server-side playback scheduler with the Spotify player.
+
+    Called when auto-advance is switched on or off and after user actions
+    (play, pause, seek). The scheduler reads the player once and moves to
+    the next song just before the current one ends, the browser no longer
+    polls Spotify.
+    """
+    
+    @extend_schema(
+        description='Re-read the Spotify player and plan the next auto-advance',
+        request={
+            'application/json': {
+                'type': 'object',
+                'properties': {
+                    'session_id': {'type': 'string', 'description': 'Session ID'},
+                    'auto_advance': {'type': 'boolean', 'description': 'Turn auto-advance on or off (default: unchanged)'}
+                },
+                'required': ['session_id']
+            }
+        },
+        responses={
+            200: {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean'},
+                    'playback': {
+                        'type': 'object',
+                        'description': 'is_playing, track_id, progress_ms, duration_ms, auto_advance and '
+                                       'advance_in_ms (ms until the next song, null if nothing is planned)'
+                    }
+                }
+            }
+        }
+    )
+    def post(self, request, *args, **kwargs):
+        valid, error_response = validate_session(request)
+        if not valid:
+            return error_response
+        
+        session = request_session(request)
+        auto_advance = request.data.get("auto_advance")
+        if auto_advance is not None:
+            set_auto_advance(session.session_id, str(auto_advance).lower() in ("true", "1"))
         
-        url = f"https://api.spotify.com/v1/search?q={quote(query)}&type=track&limit=1"
+        if not session.spotify_access_token:
+            return Response({"error": "Not authenticated"}, status=401)
         
         try:
-            response = requests.get(url, headers=headers, timeout=15)
-            
-            if response.status_code == 200:
-                data = response.json()
-                tracks = data.get('tracks', {}).get('items', [])
-                
-                if tracks:
-                    track_id = tracks[0]['id']
-                    print(f"Found Spotify track: {tracks[0]['name']} by {tracks[0]['artists'][0]['name']} (ID: {track_id})")
-                    return track_id
-                else:
-                    print(f"No Spotify tracks found for: {song_title} by {artist_name}")
-                    return None
-                    
-            else:
-                print(f"Spotify search failed: HTTP {response.status_code}")
-                return None
-                
+            return Response({"success": True, "playback": sync_playback(session)})
         except Exception as e:
-            print(f"Error searching Spotify: {str(e)}")
-            return None
+            return Response({"error": f"Failed to sync playback: {str(e)}"}, status=500)
+
+
+class SessionEventsView(View):
+    """
+    Server-sent events for one session: songs_added, songs_removed,
+    songs_reordered, lists_cleared and now_playing, each with the new order
+    of the lists it touched, so open pages apply the change instead of
+    re-fetching /api/get-songs/.
+
+    Async view: served without holding a worker thread when the project runs
+    on ASGI (FNTproject/asgi.py).
+    """
+    
+    async def get(self, request, *args, **kwargs):
+        if not isinstance(request, ASGIRequest):
+            # a WSGI server would buffer the endless stream, the page falls back to re-fetching
+            return JsonResponse({"error": "Live updates need the ASGI server"}, status=501)
+        session_id = request.GET.get("session_id")
+        if not session_id:
+            return JsonResponse({"error": "session_id required"}, status=400)
+        # like the API views: expired sessions are gone, opening the stream counts as activity
+        session = await sync_to_async(load_session)(session_id)
+        if session is None or not session.is_active:
+            return JsonResponse({"error": "Invalid or inactive session"}, status=404)
+        
+        try:
+            last_event_id = int(request.headers.get("Last-Event-ID") or request.GET.get("last_event_id") or 0) or None
+        except ValueError:
+            last_event_id = None
+        
+        response = StreamingHttpResponse(self.stream(session_id, last_event_id), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"  # nginx: pass events through as they come
+        return response
+    
+    async def stream(self, session_id, last_event_id):
+        subscription, queue, missed = broker().subscribe(session_id, last_event_id)
+        heartbeat = getattr(settings, "EVENTS_HEARTBEAT", 15)
+        try:
+            yield f"retry: {getattr(settings, 'EVENTS_RETRY_MS', 3000)}\n\n"
+            for event in missed:
+                yield format_event(event)
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"  # keeps proxies from closing an idle stream
+                    continue
+                if event is None:
+                    return
+                yield format_event(event)
+        finally:
+            broker().unsubscribe(session_id, subscription)
+
+
+class HistorySyncView(SpotifyTokenView):
+    """
+    Fold the tracks Spotify played since the last sync into the history.
+
+    Picks up songs played from the Spotify apps, not through FNT. Only plays
+    after the session's stored cursor are fetched, plays NextSong already
+    recorded are skipped.
+    """
+
+    @extend_schema(
+        description='Add the Spotify recently-played tracks since the last sync to the history',
+        request={
+            'application/json': {
+                'type': 'object',
+                'properties': {
+                    'session_id': {'type': 'string', 'description': 'Session ID'}
+                },
+                'required': ['session_id']
+            }
+        },
+        responses={
+            200: {
+                'type': 'object',
+                'properties': {
+                    'success': {'type': 'boolean'},
+                    'added': {'type': 'integer', 'description': 'History entries added'}
+                }
+            }
+        }
+    )
+    def post(self, request, *args, **kwargs):
+        valid, error_response = validate_session(request)
+        if not valid:
+            return error_response
+
+        session = request_session(request)
+        if not session.spotify_access_token:
+            return Response({"error": "Not authenticated"}, status=401)
+
+        try:
+            added = sync_recently_played(session)
+        except RecentSyncError as e:
+            return Response({"error": f"Failed to read recently played tracks: {str(e)}"}, status=502)
+        except Exception as e:
+            return Response({"error": f"Failed to sync history: {str(e)}"}, status=500)
+        return Response({"success": True, "added": added})
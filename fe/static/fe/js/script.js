@@ -2,6 +2,8 @@
 let currentSessionId = null;
 let currentPage = "home";
 let spotifyConnected = false;
+let sessionEvents = null; // EventSource of /api/events/
+const songLists = { playlist: null, vibe: null }; // last loaded songs, kept current by the events
 
 // HELPERS
 function showSpinner(container, message) {
@@ -103,6 +105,7 @@ async function createNewSession() {
     JSON.stringify({ id: currentSessionId, created: Date.now() })
   );
   updateSessionUI(SessionStates.ACTIVE, currentSessionId);
+  openSessionEvents();
 
   // Modal Pop Up  to guide user
   const modal = new bootstrap.Modal(
@@ -116,6 +119,7 @@ function clearLocal() {
   localStorage.removeItem("fnt_session_data");
   localStorage.removeItem("fnt_session_id");
   currentSessionId = null;
+  closeSessionEvents();
   updateSessionUI(SessionStates.NO_SESSION);
   navigate("home-section");
 }
@@ -148,13 +152,11 @@ async function restoreSession() {
     return false;
   }
 
-  const response = await fetch(`/api/sessions/${sessionId}/check/`, {
-    method: "GET",
-    headers: {
-      "Content-Type": "application/json",
-      "X-CSRFToken": getCSRFToken(),
-    },
-  });
+  // one call for the session, both lists, history and the Spotify connection
+  const response = await fetch(
+    `/api/snapshot/?session_id=${encodeURIComponent(sessionId)}`,
+    { method: "GET", headers: { Accept: "application/json" } }
+  );
 
   if (!response.ok) {
     clearLocalSession();
@@ -177,6 +179,10 @@ async function restoreSession() {
     localStorage.removeItem("fnt_session_id");
   }
   updateSessionUI(SessionStates.ACTIVE, currentSessionId);
+  openSessionEvents(data.last_event_id);
+  songLists.playlist = data.playlist;
+  songLists.vibe = data.vibe;
+  applySpotifyStatus(data.spotify.connected);
   return true;
 }
 
@@ -201,11 +207,16 @@ async function loadPlaylist() {
       '<div class="alert alert-warning">Please create a session first to view your playlist</div>';
     return;
   }
+  if (sessionEvents && songLists.playlist !== null) {
+    // loaded with the snapshot and kept current by the events
+    return displayPlaylist({ songs: songLists.playlist });
+  }
   showSpinner(container, "Loading playlist...");
   const response = await fetch(
     `/api/get-songs/?session_id=${currentSessionId}&list_type=playlist`
   );
   const data = await response.json();
+  songLists.playlist = data.songs || [];
   displayPlaylist(data);
 }
 
@@ -216,14 +227,75 @@ async function loadVibe() {
       '<div class="alert alert-warning">Please create a session first to view your vibe</div>';
     return;
   }
+  if (sessionEvents && songLists.vibe !== null) {
+    // loaded with the snapshot and kept current by the events
+    return displayVibe({ songs: songLists.vibe });
+  }
   showSpinner(container, "Loading vibe...");
   const response = await fetch(
     `/api/get-songs/?session_id=${currentSessionId}&list_type=vibe`
   );
   const data = await response.json();
+  songLists.vibe = data.songs || [];
   displayVibe(data);
 }
 
+// LIVE UPDATES
+const sequenceFields = { playlist: "playlist_sequence", vibe: "vibe_sequence" };
+
+// lastEventId: the snapshot the page was loaded from, changes made since are replayed
+function openSessionEvents(lastEventId) {
+  closeSessionEvents();
+  if (!currentSessionId || !window.EventSource) return;
+  // EventSource reconnects by itself and sends Last-Event-ID, the server replays what was missed
+  const resume = lastEventId ? `&last_event_id=${lastEventId}` : "";
+  sessionEvents = new EventSource(
+    `/api/events/?session_id=${encodeURIComponent(currentSessionId)}${resume}`
+  );
+  sessionEvents.onerror = () => {
+    // refused (e.g. not served over ASGI): back to re-fetching the lists after each change
+    if (sessionEvents && sessionEvents.readyState === EventSource.CLOSED) sessionEvents = null;
+  };
+  ["songs_added", "songs_removed", "songs_reordered", "lists_cleared", "now_playing"].forEach(
+    (type) =>
+      sessionEvents.addEventListener(type, (e) =>
+        applySessionEvent(type, JSON.parse(e.data))
+      )
+  );
+}
+
+function closeSessionEvents() {
+  if (sessionEvents) sessionEvents.close();
+  sessionEvents = null;
+  songLists.playlist = null;
+  songLists.vibe = null;
+}
+
+// apply a change to the loaded lists: new songs are merged, then each list takes the order it came with
+function applySessionEvent(type, data) {
+  Object.entries(data.order || {}).forEach(([listType, order]) => {
+    const current = songLists[listType];
+    if (current === null) return; // not loaded yet, the next load gets it
+    const known = new Map(current.concat(data.songs || []).map((song) => [song.id, song]));
+    if (order.some(([id]) => !known.has(id))) {
+      // a song this page has never seen (e.g. moved over from the other list):
+      // drop the list so the loader fetches it instead of keeping the copy
+      songLists[listType] = null;
+      return listType === "playlist" ? loadPlaylist() : loadVibe();
+    }
+    songLists[listType] = order.map(([id, sequence]) => ({
+      ...known.get(id),
+      [sequenceFields[listType]]: sequence,
+    }));
+    if (listType === "playlist") displayPlaylist({ songs: songLists.playlist });
+    else displayVibe({ songs: songLists.vibe });
+  });
+  if (type === "now_playing" && spotifyConnected) {
+    displaySpotifyUserInfo();
+    scheduleAutoPlayRefresh(data.song.duration_ms);
+  }
+}
+
 // NAVIGATION
 function updateNavigation(activePage) {
   document
@@ -514,8 +586,10 @@ async function removeSongFromList(songId, listType, btn) {
     item.style.opacity = "0";
     setTimeout(() => {
       item.remove();
-      if (listType === "playlist") loadPlaylist();
-      else loadVibe();
+      if (!sessionEvents) {
+        if (listType === "playlist") loadPlaylist();
+        else loadVibe();
+      }
     }, 200);
   }
 }
@@ -572,7 +646,7 @@ async function playlistReorder(fromIndex, toIndex) {
     },
     body: JSON.stringify(body),
   });
-  await loadPlaylist();
+  if (!sessionEvents) await loadPlaylist();
 }
 
 // DRAG & DROP — VIBE
@@ -627,7 +701,7 @@ async function vibeReorder(fromIndex, toIndex) {
     },
     body: JSON.stringify(body),
   });
-  await loadVibe();
+  if (!sessionEvents) await loadVibe();
 }
 
 // SONG ADDITION
@@ -923,8 +997,10 @@ document.addEventListener("DOMContentLoaded", async function () {
       if (e.newValue) {
         currentSessionId = JSON.parse(e.newValue).id;
         updateSessionUI(SessionStates.ACTIVE, currentSessionId);
+        openSessionEvents();
       } else {
         currentSessionId = null;
+        closeSessionEvents();
         updateSessionUI(SessionStates.NO_SESSION);
         if (currentPage !== "home-section") navigate("home-section");
       }
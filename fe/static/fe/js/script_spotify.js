@@ -1,9 +1,7 @@
-// AUTO-PLAY FEATURE
-let lastAutoPlayTrackId = null;
-let autoPlayInterval = null; // timer for checking playback
-let lastKnownTrack = null; // remember last song
+// AUTO-PLAY FEATURE (the server moves to the next song, see /api/playback/sync/)
+let autoPlayTimer = null; // refreshes the screen when the server changes song
 let autoPlayEnabled = false; // auto-play on/of
-let autoPlayInProgress = false; // stops double-triggering
+let spotifyRetryAt = 0; // no Spotify reads before this time (Retry-After)
 
 // HELPERS
 // Spotify button state
@@ -31,49 +29,30 @@ function updateSpotifyButtonState(state) {
     if (description) description.style.display = "block";
   }
 }
-// make Spotify requests, refresh token on failure
+// make Spotify requests (the server refreshes the token before it expires)
 async function makeSpotifyRequest(url, options = {}) {
-  try {
-    // Add session_id to URL if not already present and we have a current session
-    if (currentSessionId && !url.includes("session_id=")) {
-      const separator = url.includes("?") ? "&" : "?";
-      url = `${url}${separator}session_id=${currentSessionId}`;
-    }
-
-    const response = await fetch(url, options);
-    // If 401 (unauthorized), refresh token
-    if (response.status === 401) {
-      console.log("Token expired");
+  // Add session_id to URL if not already present and we have a current session
+  if (currentSessionId && !url.includes("session_id=")) {
+    const separator = url.includes("?") ? "&" : "?";
+    url = `${url}${separator}session_id=${currentSessionId}`;
+  }
 
-      if (!currentSessionId) {
-        console.log("No session ID for refresh");
-        return response;
-      }
+  // rate limited: don't poll again before Spotify's Retry-After (commands still go through)
+  const method = (options.method || "GET").toUpperCase();
+  if (method === "GET" && Date.now() < spotifyRetryAt) {
+    return new Response(JSON.stringify({ error: "Spotify API rate limit exceeded" }), {
+      status: 429,
+    });
+  }
 
-      // refresh the token
-      const refreshResponse = await fetch("/spotify/refresh/", {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-          "X-CSRFToken": getCSRFToken(),
-        },
-        body: JSON.stringify({ session_id: currentSessionId }),
-      });
-
-      if (refreshResponse.ok) {
-        console.log("Token refreshed");
-        // Retry original request
-        const retryResponse = await fetch(url, options);
-        return retryResponse;
-      } else {
-        console.log("Token refresh failed");
-        return response;
-      }
-    }
-    return response;
-  } catch (error) {
-    throw error;
+  const response = await fetch(url, options);
+  if (response.status === 401) {
+    console.log("Spotify authorization failed, reconnect to Spotify");
+  } else if (response.status === 429) {
+    const retryAfter = parseInt(response.headers.get("Retry-After"), 10) || 1;
+    spotifyRetryAt = Date.now() + retryAfter * 1000;
   }
+  return response;
 }
 
 // SPOTIFY INTEGRATION
@@ -532,6 +511,16 @@ async function displaySpotifyUserInfo() {
   }
 }
 
+// connection state from /api/snapshot/ on page load, without a call to Spotify
+function applySpotifyStatus(connected) {
+  spotifyConnected = connected;
+  updateSpotifyButtonState(connected ? "connected" : "disconnected");
+  const controlsDiv = document.getElementById("spotifyControls");
+  if (controlsDiv) {
+    controlsDiv.style.display = connected ? "block" : "none";
+  }
+}
+
 // Check if user is already connected to Spotify (for page refresh)
 async function checkSpotifyConnection() {
   try {
@@ -680,6 +669,7 @@ async function playNextSong() {
 
       // refresh Spotify info
       displaySpotifyUserInfo();
+      if (data.song.duration_ms) scheduleAutoPlayRefresh(data.song.duration_ms);
 
       // success message song title and artist
       const statusDiv = document.getElementById("spotifyStatus");
@@ -708,191 +698,62 @@ async function playNextSong() {
 }
 
 // auto-play function for continious playback
-function startAutoPlay() {
+async function startAutoPlay() {
   // if running, return
-  if (autoPlayInterval || !spotifyConnected) {
+  if (autoPlayEnabled || !spotifyConnected) {
     return;
   }
 
   console.log("Starting auto-play...");
   autoPlayEnabled = true;
-
-  // check for song end (2 sec interval)
-  autoPlayInterval = setInterval(checkForSongEnd, 2000);
-  setTimeout(checkForSongEnd, 1000);
+  setRepeatOff(); // best effort
+  await syncPlayback(true);
 }
 
 // stop the auto-play feature
-function stopAutoPlay() {
-  // stop if running
-  if (autoPlayInterval) {
-    console.log("Stopping auto-play...");
-    clearInterval(autoPlayInterval); // stop timer
-    autoPlayInterval = null;
-    autoPlayEnabled = false;
-    lastKnownTrack = null;
-    autoPlayInProgress = false; // reset flag
-  }
+async function stopAutoPlay() {
+  if (!autoPlayEnabled) return;
+  console.log("Stopping auto-play...");
+  autoPlayEnabled = false;
+  clearTimeout(autoPlayTimer);
+  autoPlayTimer = null;
+  if (currentSessionId) await syncPlayback(false);
 }
 
-//  if current song is near end -> play the next one
-async function checkForSongEnd() {
-  // checks
-  if (!autoPlayEnabled || !spotifyConnected || !currentSessionId) {
-    return;
-  }
-
+// tell the server to re-read the player (auto-play switched, play/pause pressed)
+async function syncPlayback(autoAdvance) {
+  if (!currentSessionId) return null;
   try {
-    // get current playback info
-    const currentData = await getCurrentlyPlaying();
-    if (!currentData || !currentData.item) {
-      // If Spotify says nothing, play next
-      if (autoPlayEnabled && spotifyConnected && currentSessionId) {
-        await autoPlayNextSong();
-      }
-      return;
-    }
-
-    const currentTrack = currentData.item;
-    const progress = currentData.progress_ms || 0;
-    const duration = currentTrack.duration_ms || 0;
-    const isPlaying = currentData.is_playing;
-
-    // check if new track
-    const trackId = currentTrack.id;
-    const trackChanged = lastKnownTrack && lastKnownTrack.id !== trackId;
-
-    // set current track
-    lastKnownTrack = {
-      id: trackId,
-      name: currentTrack.name,
-      artists: currentTrack.artists?.map((a) => a.name).join(", ") || "Unknown",
-      progress: progress,
-      duration: duration,
-    };
-
-    if (trackChanged) {
-      lastAutoPlayTrackId = null; // clear debounce so new song is immediately eligible
-      return;
-    }
-
-    const timeRemaining = duration - progress;
-    const isNearEnd = timeRemaining <= 3000;
-    const isVeryNearEnd = timeRemaining <= 1500;
-    if (
-      currentData.is_playing &&
-      isVeryNearEnd &&
-      lastAutoPlayTrackId !== trackId
-    ) {
-      lastAutoPlayTrackId = trackId; // one trigger per track
-      await autoPlayNextSong(trackId); // pass previous track id
-      return;
-    }
-
-    // if ending and still playing -> next song
-    if (isVeryNearEnd && isPlaying) {
-      await autoPlayNextSong();
-      return;
-    }
-
-    // if close to end and playing -> next song
-    if (isNearEnd && isPlaying) {
-      const waitTime = Math.max(timeRemaining - 500, 500); // wait until ~500ms before end
-      setTimeout(async () => {
-        if (!autoPlayEnabled || !spotifyConnected) return;
-        await autoPlayNextSong();
-      }, waitTime);
-    }
-  } catch (e) {
-    // TODO: consider how we get here and handle
-    console.error("Consider how we get here and handle:", e);
-    return;
-  }
-}
-
-async function ensureNextIsPlaying(prevTrackId) {
-  for (let i = 0; i < 4; i++) {
-    const cur = await getCurrentlyPlaying();
-    if (cur && cur.item) {
-      const sameTrack = prevTrackId && cur.item.id === prevTrackId;
-      if (!sameTrack && cur.is_playing) return true; // success
-      if (!sameTrack && !cur.is_playing) {
-        try {
-          const stateResp = await makeSpotifyRequest(
-            "/spotify/playback-state/"
-          );
-          const stateData = await stateResp.json();
-          const deviceId = stateData?.device?.id;
-          const playUrl =
-            "/spotify/play/" + (deviceId ? `?device_id=${deviceId}` : "");
-
-          await makeSpotifyRequest(playUrl, {
-            method: "POST",
-            headers: {
-              "Content-Type": "application/json",
-              "X-CSRFToken": getCSRFToken(),
-            },
-          });
-        } catch (e) {}
-      }
-    }
-    await waitMs(500);
-  }
-  return false;
-}
-
-function waitMs(ms) {
-  return new Promise((res) => setTimeout(res, ms));
-}
-
-async function autoPlayNextSong(prevTrackId) {
-  if (!autoPlayEnabled || !spotifyConnected || !currentSessionId) return;
-  if (autoPlayInProgress) return;
-  autoPlayInProgress = true;
-  try {
-    setRepeatOff(); // best effort
-    const response = await fetch("/api/next-song/", {
+    const body = { session_id: currentSessionId };
+    if (autoAdvance !== undefined) body.auto_advance = autoAdvance;
+    const response = await fetch("/api/playback/sync/", {
       method: "POST",
       headers: {
         "Content-Type": "application/json",
         "X-CSRFToken": getCSRFToken(),
       },
-      body: JSON.stringify({ session_id: currentSessionId }),
+      body: JSON.stringify(body),
     });
     const data = await response.json();
-    if (response.ok && data && data.success) {
-      await waitMs(700); // gap to ensure updates have time
-      const ok = await ensureNextIsPlaying(prevTrackId);
-      if (!ok) {
-        // start playback if stalled
-        try {
-          const stateResp = await makeSpotifyRequest(
-            "/spotify/playback-state/"
-          );
-          const stateData = await stateResp.json();
-          const deviceId = stateData?.device?.id;
-          const playUrl =
-            "/spotify/play/" + (deviceId ? `?device_id=${deviceId}` : "");
-
-          await makeSpotifyRequest(playUrl, {
-            method: "POST",
-            headers: {
-              "Content-Type": "application/json",
-              "X-CSRFToken": getCSRFToken(),
-            },
-          });
-        } catch (e) {}
-      }
-      // refresh screen
-      setTimeout(() => displaySpotifyUserInfo(), 1200);
-    } else {
-      if (data && data.error && data.error.includes("No songs in playlist")) {
-        stopAutoPlay();
-      }
+    if (response.ok && data.success) {
+      scheduleAutoPlayRefresh(data.playback.advance_in_ms);
+      return data.playback;
     }
-  } finally {
-    autoPlayInProgress = false;
+  } catch (e) {
+    console.log("syncPlayback error:", e);
   }
+  return null;
+}
+
+// refresh the screen once, right after the server has moved to the next song
+function scheduleAutoPlayRefresh(advanceInMs) {
+  clearTimeout(autoPlayTimer);
+  autoPlayTimer = null;
+  if (!autoPlayEnabled || advanceInMs === null || advanceInMs === undefined) return;
+  autoPlayTimer = setTimeout(async () => {
+    await syncPlayback();
+    displaySpotifyUserInfo();
+  }, advanceInMs + 2500);
 }
 
 // if connected to spotify start auto-play
@@ -933,6 +794,7 @@ async function pauseSpotifyPlayback() {
 
     // update the UI so it shows the paused state
     displaySpotifyUserInfo();
+    syncPlayback(); // nothing to advance while paused
 
     // user  pop up message
     const statusDiv = document.getElementById("spotifyStatus");
@@ -991,6 +853,7 @@ async function playSpotifyPlayback() {
 
     // update screens
     displaySpotifyUserInfo();
+    syncPlayback(); // plan the end of the resumed track
 
     // user pop up message
     const statusDiv = document.getElementById("spotifyStatus");
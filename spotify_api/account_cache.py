@@ -0,0 +1,124 @@
+"""
+Per-token cache of the Spotify profile and device list, and the device each session plays on.
+
+The profile does not change within a token's lifetime, it is kept for
+SPOTIFY_PROFILE_TTL seconds, so the page's connection check
+(/spotify/user-profile/) needs no call to Spotify. The device list is kept
+for SPOTIFY_DEVICES_TTL seconds. Entries live in the shared Django cache,
+keyed by a digest of the access token; store_tokens() and the disconnect
+view drop the entries of the token they replace.
+
+The device a session last played on is remembered (devices and playback
+state reads, see remember_device()), so NextSong can target it when
+Spotify answers "no active device" without listing the devices first.
+"""
+import hashlib
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+from api import metrics
+from . import client
+
+PROFILE, DEVICES = "profile", "devices"
+URLS = {PROFILE: "/me", DEVICES: "/me/player/devices"}
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _ttl(kind):
+    if kind == PROFILE:
+        return _setting("SPOTIFY_PROFILE_TTL", 3600)
+    return _setting("SPOTIFY_DEVICES_TTL", 30)
+
+
+def _key(kind, authorization):
+    return f"fnt:spotify-{kind}:" + hashlib.sha1(authorization.encode()).hexdigest()
+
+
+def _hit(kind, data):
+    metrics.increment(f"spotify.account_cache.{kind}.{'hit' if data is not None else 'miss'}")
+    return data
+
+
+def kept(kind, authorization, fetch):
+    """
+    Return the kept answer of a token's profile or devices call, else
+    fetch() it. fetch returns a (data, status) pair, only 200s are kept.
+    """
+    data = _hit(kind, cache.get(_key(kind, authorization)))
+    if data is not None:
+        return data, 200
+    data, status = fetch()
+    if status == 200:
+        cache.set(_key(kind, authorization), data, _ttl(kind))
+    return data, status
+
+
+async def kept_async(kind, authorization, fetch):
+    """kept() for async views, fetch is a coroutine function"""
+    data = _hit(kind, await cache.aget(_key(kind, authorization)))
+    if data is not None:
+        return data, 200
+    data, status = await fetch()
+    if status == 200:
+        await cache.aset(_key(kind, authorization), data, _ttl(kind))
+    return data, status
+
+
+#Helper, the kept profile or devices answer of a token, None if there is none (never calls Spotify)
+def peek(kind, authorization):
+    return cache.get(_key(kind, authorization))
+
+
+#Helper, the token is replaced or gone: drop what was kept for it
+def forget(authorization):
+    cache.delete_many([_key(kind, authorization) for kind in URLS])
+
+
+#Helper, the token's device list (kept, else one call to Spotify), None if it cannot be read
+def devices(authorization):
+    def fetch():
+        try:
+            r = client.get(URLS[DEVICES], headers={"Authorization": authorization})
+        except requests.RequestException:
+            return None, 502
+        if r.status_code != 200:
+            return None, r.status_code
+        return r.json(), 200
+
+    data, status = kept(DEVICES, authorization, fetch)
+    return (data or {}).get("devices") if status == 200 else None
+
+
+#Helper, id of the device to play on from a device list: the active one, else the first
+def pick_device(device_list):
+    device_list = [device for device in device_list or [] if device.get("id") and not device.get("is_restricted")]
+    active = [device for device in device_list if device.get("is_active")]
+    return (active or device_list or [{}])[0].get("id")
+
+
+# device a session plays on, kept as long as a token lives
+def _device_key(session_id):
+    return f"fnt:spotify-device:{session_id}"
+
+
+def remember_device(session_id, device_id):
+    if session_id and device_id:
+        cache.set(_device_key(session_id), device_id, _setting("SPOTIFY_PROFILE_TTL", 3600))
+
+
+async def remember_device_async(session_id, device_id):
+    if session_id and device_id:
+        await cache.aset(_device_key(session_id), device_id, _setting("SPOTIFY_PROFILE_TTL", 3600))
+
+
+def remembered_device(session_id):
+    return cache.get(_device_key(session_id))
+
+
+def forget_device(session_id):
+    cache.delete(_device_key(session_id))
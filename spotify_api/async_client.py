@@ -0,0 +1,136 @@
+"""
+Async client for the Spotify Web API, used by the async proxy views.
+
+Same contract as client.request() (limiter, player cache invalidation,
+ETags, retries, spotify.http.* metrics, see client.Call), but awaitable:
+with httpx installed the calls go through one httpx.AsyncClient with a
+keep-alive pool of SPOTIFY_POOL_SIZE connections, so a request waiting on
+Spotify holds no thread. Without httpx, calls run the pooled sync client in
+a worker thread.
+
+httpx clients are bound to the event loop that opened them. Under WSGI each
+async view runs on a new event loop (async_to_sync), so the client lives on
+one background loop per process and the views' loops hand their calls to
+it: the pool outlives every request, under WSGI and ASGI alike.
+"""
+import asyncio
+import threading
+import time
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import client, limiter
+
+try:
+    import httpx
+except ImportError:  # optional, see requirements.txt
+    httpx = None
+
+_loop = None  # background event loop running the Spotify calls
+_loop_lock = threading.Lock()
+_http = None  # its httpx.AsyncClient, only touched from that loop
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+#Helper, the process's background event loop, started by the first call
+def _background_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="spotify-http", daemon=True).start()
+        return _loop
+
+
+#Helper, the httpx.AsyncClient of the background loop
+def http_client():
+    global _http
+    if _http is None:
+        pool = _setting("SPOTIFY_POOL_SIZE", 10)
+        _http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool * 2, max_keepalive_connections=pool),
+        )
+    return _http
+
+
+def close():
+    """Close the pool and stop the background loop (shutdown, tests)"""
+    global _loop, _http
+    with _loop_lock:
+        loop, _loop = _loop, None
+    if loop is None:
+        return
+    if _http is not None:
+        asyncio.run_coroutine_threadsafe(_http.aclose(), loop).result()
+        _http = None
+    loop.call_soon_threadsafe(loop.stop)
+
+
+async def _send(call):
+    connect, read = call.timeout if isinstance(call.timeout, tuple) else (call.timeout, call.timeout)
+    try:
+        return await http_client().request(
+            call.method, call.url, timeout=httpx.Timeout(read, connect=connect), **call.kwargs
+        )
+    except httpx.TimeoutException as e:
+        raise requests.Timeout(str(e)) from e  # callers catch requests exceptions, as with the sync client
+    except httpx.TransportError as e:
+        raise requests.ConnectionError(str(e)) from e
+
+
+async def request(method, url, *, timeout=None, retries=None, priority=None, **kwargs):
+    """
+    Awaitable client.request(): returns the response (requests.Response
+    or httpx.Response, both with status_code, headers and json()) and
+    raises requests exceptions once the retries are used up.
+    """
+    if httpx is None:
+        return await sync_to_async(client.request, thread_sensitive=False)(
+            method, url, timeout=timeout, retries=retries, priority=priority, **kwargs
+        )
+    call = client.Call(method, url, timeout, retries, priority, **kwargs)
+    # the ETag store is read and written here with the async cache API, the
+    # background loop only sends: a sync cache call would block the loop
+    # (or raise SynchronousOnlyOperation with a database cache)
+    await call.lookup_async()
+    response = await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(_run(call), _background_loop()))
+    return await call.revalidated_async(response)
+
+
+# the calls of request(), on the background loop
+async def _run(call):
+    for attempt in range(1, call.attempts + 1):
+        if call.limited:
+            try:
+                await limiter.acquire_async(call.authorization, call.priority)
+            except limiter.Throttled as e:
+                return call.throttled(e.retry_after)
+        started = time.monotonic()
+        try:
+            response = await _send(call)
+        except (requests.ConnectionError, requests.Timeout):
+            call.failed()
+            if attempt == call.attempts:
+                raise
+        else:
+            response = call.answered(response, started, attempt)
+            if response is not None:
+                return response
+        await asyncio.sleep(call.backoff(attempt))
+
+
+async def get(url, **kwargs):
+    return await request("GET", url, **kwargs)
+
+
+async def put(url, **kwargs):
+    return await request("PUT", url, **kwargs)
+
+
+async def post(url, **kwargs):
+    return await request("POST", url, **kwargs)
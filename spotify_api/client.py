@@ -0,0 +1,207 @@
+"""
+Shared HTTP client for the Spotify Web API and the Spotify accounts service.
+
+Every Spotify call of the api and spotify_api apps goes through request(),
+so connections to api.spotify.com and accounts.spotify.com are kept alive
+and reused instead of paying a TLS handshake per call. Timeouts come from
+SPOTIFY_CONNECT_TIMEOUT / SPOTIFY_READ_TIMEOUT, idempotent calls are retried
+SPOTIFY_RETRIES times on connection errors and 5xx answers, and latencies are
+counted under spotify.http.* at /api/metrics/. Calls are paced by the
+limiter, which also waits out Spotify's Retry-After, player commands
+drop the token's cached player state (player_cache) and the GETs listed
+in etags are revalidated with If-None-Match.
+"""
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from api import metrics
+from . import etags, limiter, player_cache
+
+API_URL = "https://api.spotify.com/v1"
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+
+# POST is not repeatable (skip to next, token exchange), Spotify's PUT player calls set a state and are
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE"}
+RETRY_STATUSES = {500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+#Helper, process-wide requests.Session with a keep-alive pool per Spotify host
+def http_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=_setting("SPOTIFY_POOL_SIZE", 10))
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def close():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+# metric name per host: spotify.http.api / spotify.http.accounts
+def _metric(url):
+    host = urlsplit(url).hostname or ""
+    return "spotify.http." + (host.split(".")[0] or "unknown")
+
+
+# answer for a call the limiter held back, shaped like Spotify's own 429
+def _throttled_response(url, retry_after):
+    response = requests.Response()
+    response.status_code = 429
+    response.reason = "Too Many Requests"
+    response.url = url
+    response.headers["Retry-After"] = str(retry_after)
+    response._content = json.dumps({"error": {"status": 429, "message": "API rate limit exceeded"}}).encode()
+    return response
+
+
+class Call:
+    """
+    Bookkeeping of one Spotify request, shared by request() and async_client.request().
+
+    Resolves the URL, timeouts and retries, drops the token's cached player
+    state for player commands, adds If-None-Match for ETag'd GETs and
+    counts the answers.
+    """
+
+    def __init__(self, method, url, timeout=None, retries=None, priority=None, **kwargs):
+        self.method = method.upper()
+        self.url = API_URL + url if url.startswith("/") else url
+        if timeout is None:
+            timeout = (_setting("SPOTIFY_CONNECT_TIMEOUT", 5), _setting("SPOTIFY_READ_TIMEOUT", 15))
+        self.timeout = timeout
+        if retries is None:
+            retries = _setting("SPOTIFY_RETRIES", 2)
+        self.attempts = 1 + retries if self.method in IDEMPOTENT_METHODS else 1
+        self.metric = _metric(self.url)
+        self.authorization = (kwargs.get("headers") or {}).get("Authorization")
+        player_command = self.method != "GET" and self.url.startswith(API_URL + "/me/player")
+        if priority is None:
+            priority = limiter.PLAYBACK if player_command else limiter.INTERACTIVE
+        self.priority = priority
+        if player_command and self.authorization:
+            # play, pause, next, ...: the cached player state of this token is out of date
+            player_cache.invalidate(self.authorization)
+
+        self.stored = None
+        self.conditional = self.method == "GET" and self.authorization and etags.cacheable(self.url)
+        self.kwargs = kwargs
+        self.limited = self.url.startswith(API_URL)  # the token endpoint is not part of the Web API limit
+
+    # before the first attempt: send the stored ETag as If-None-Match
+    def lookup(self):
+        if self.conditional:
+            self._revalidate(etags.lookup(self.authorization, self.url))
+
+    async def lookup_async(self):
+        if self.conditional:
+            self._revalidate(await etags.lookup_async(self.authorization, self.url))
+
+    def _revalidate(self, stored):
+        self.stored = stored
+        if stored:
+            self.kwargs["headers"] = {**self.kwargs["headers"], "If-None-Match": stored["etag"]}
+
+    # the final response: a 304 replayed from the stored answer, a fresh ETag'd answer stored
+    def revalidated(self, response):
+        if not self.conditional:
+            return response
+        return etags.revalidated(self.authorization, self.url, response, self.stored)
+
+    async def revalidated_async(self, response):
+        if not self.conditional:
+            return response
+        return await etags.revalidated_async(self.authorization, self.url, response, self.stored)
+
+    def throttled(self, retry_after):
+        return _throttled_response(self.url, retry_after)
+
+    def failed(self):
+        metrics.increment(f"{self.metric}.errors")
+
+    # the final response, or None when the attempt should be retried
+    def answered(self, response, started, attempt):
+        metrics.timing(self.metric, (time.monotonic() - started) * 1000)
+        metrics.increment(f"{self.metric}.status.{response.status_code}")
+        if response.status_code == 429 and self.limited:
+            limiter.throttled(_retry_after(response))
+        if response.status_code in RETRY_STATUSES and attempt < self.attempts:
+            return None
+        return response
+
+    # seconds to wait before the next attempt
+    def backoff(self, attempt):
+        metrics.increment(f"{self.metric}.retries")
+        return _setting("SPOTIFY_RETRY_BACKOFF", 0.25) * 2 ** (attempt - 1)
+
+
+def request(method, url, *, timeout=None, retries=None, priority=None, **kwargs):
+    """
+    Send a Spotify request through the shared pool and return the response.
+
+    url may be a path below API_URL ("/me/player"). Connection errors are
+    raised as requests exceptions once the retries are used up, HTTP errors
+    are returned like any other response. priority is a limiter priority,
+    player commands default to limiter.PLAYBACK, everything else to
+    limiter.INTERACTIVE. A call the limiter holds back gets a 429 answer.
+    """
+    call = Call(method, url, timeout, retries, priority, **kwargs)
+    call.lookup()
+    for attempt in range(1, call.attempts + 1):
+        if call.limited:
+            try:
+                limiter.acquire(call.authorization, call.priority)
+            except limiter.Throttled as e:
+                return call.throttled(e.retry_after)
+        started = time.monotonic()
+        try:
+            response = http_session().request(call.method, call.url, timeout=call.timeout, **call.kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            call.failed()
+            if attempt == call.attempts:
+                raise
+        else:
+            response = call.answered(response, started, attempt)
+            if response is not None:
+                return call.revalidated(response)
+        time.sleep(call.backoff(attempt))
+
+
+def _retry_after(response):
+    try:
+        return max(int(response.headers.get("Retry-After") or 1), 1)
+    except ValueError:
+        return 1
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request("PUT", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
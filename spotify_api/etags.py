@@ -0,0 +1,89 @@
+"""
+ETag store for the Spotify GETs that rarely change (profile, devices, recent tracks).
+
+client.request() sends the stored ETag as If-None-Match. On 304 the stored
+body is replayed as a 200, so callers never see the difference, and Spotify
+has sent no body. Entries are kept per access token and URL in the shared
+Django cache for SPOTIFY_ETAG_TTL seconds, access tokens expire within the
+hour anyway.
+"""
+import hashlib
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+from api import metrics
+
+# Web API paths (below /v1) whose answers are revalidated
+DEFAULT_PATHS = ("/me", "/me/player/devices", "/me/player/recently-played")
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def cacheable(url):
+    path = urlsplit(url).path
+    return path.startswith("/v1/") and path[3:] in _setting("SPOTIFY_ETAG_PATHS", DEFAULT_PATHS)
+
+
+def _key(authorization, url):
+    return "fnt:spotify-etag:" + hashlib.sha1(f"{authorization} {url}".encode()).hexdigest()
+
+
+#Helper, stored {"etag", "content", "content_type"} of a token's GET, None if there is none
+def lookup(authorization, url):
+    return cache.get(_key(authorization, url))
+
+
+async def lookup_async(authorization, url):
+    return await cache.aget(_key(authorization, url))
+
+
+def revalidated(authorization, url, response, stored):
+    """Store a fresh ETag'd answer, or turn a 304 into the stored 200"""
+    if response.status_code == 304 and stored:
+        return _replay(url, response, stored)
+    entry = _entry(response)
+    if entry:
+        cache.set(_key(authorization, url), entry, _setting("SPOTIFY_ETAG_TTL", 3600))
+    return response
+
+
+# the async views' revalidated(), the cache is not touched from inside their event loop
+async def revalidated_async(authorization, url, response, stored):
+    if response.status_code == 304 and stored:
+        return _replay(url, response, stored)
+    entry = _entry(response)
+    if entry:
+        await cache.aset(_key(authorization, url), entry, _setting("SPOTIFY_ETAG_TTL", 3600))
+    return response
+
+
+#Helper, the stored 200 answering a 304
+def _replay(url, response, stored):
+    metrics.increment("spotify.etag.not_modified")
+    replay = requests.Response()
+    replay.status_code = 200
+    replay.reason = "OK"
+    replay.url = url
+    replay.headers.update(response.headers)
+    replay.headers["Content-Type"] = stored["content_type"]
+    replay.headers["ETag"] = stored["etag"]
+    replay._content = stored["content"]
+    replay.encoding = response.encoding
+    return replay
+
+
+#Helper, the entry to store for a fresh ETag'd answer, None if there is nothing to store
+def _entry(response):
+    if response.status_code != 200 or not response.headers.get("ETag"):
+        return None
+    metrics.increment("spotify.etag.stored")
+    return {
+        "etag": response.headers["ETag"],
+        "content": response.content,
+        "content_type": response.headers.get("Content-Type", "application/json"),
+    }
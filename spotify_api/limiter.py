@@ -0,0 +1,178 @@
+"""
+Rate limiter in front of every Spotify Web API call (see client.request()).
+
+Two token buckets pace the calls before Spotify has to: one for the app
+(SPOTIFY_APP_RATE calls per second, bursts of SPOTIFY_APP_BURST) and one
+per access token (SPOTIFY_TOKEN_RATE / SPOTIFY_TOKEN_BURST), so a single
+busy session cannot use up the app's share. When Spotify answers 429 the
+whole app waits out its Retry-After, Spotify counts the limit per app.
+
+Calls wait for a slot according to their priority:
+  PLAYBACK     play / pause / next and the scheduler's player reads, wait up
+               to SPOTIFY_PLAYBACK_MAX_WAIT seconds
+  INTERACTIVE  everything a page asks for, waits up to SPOTIFY_RATE_MAX_WAIT
+  BACKGROUND   pre-resolution searches, never wait and leave the last
+               SPOTIFY_RATE_RESERVE slots of each bucket to the others
+A call that would wait longer is not sent, the caller gets a 429 with the
+remaining Retry-After like a throttled Spotify answer.
+
+State is per process. Waits, rejections and 429s are counted under
+spotify.ratelimit.* at /api/metrics/.
+"""
+import asyncio
+import hashlib
+import math
+import threading
+import time
+
+from django.conf import settings
+
+from api import metrics
+
+PLAYBACK, INTERACTIVE, BACKGROUND = "playback", "interactive", "background"
+
+_lock = threading.Lock()
+_buckets = {}  # "app" / token digest -> _Bucket
+_blocked_until = 0.0  # time.monotonic() until which Spotify asked the app to wait
+
+
+class Throttled(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"rate limited for {retry_after}s")
+        self.retry_after = retry_after
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class _Bucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    # seconds until a call may go, keeping `reserve` slots free
+    def wait(self, now, reserve=0):
+        if self.rate <= 0:
+            return 0
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return max(1 + reserve - self.tokens, 0) / self.rate
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+def _bucket(key):
+    bucket = _buckets.get(key)
+    if bucket is None:
+        if len(_buckets) > 1000:
+            _prune()
+        if key == "app":
+            bucket = _Bucket(_setting("SPOTIFY_APP_RATE", 10), _setting("SPOTIFY_APP_BURST", 20))
+        else:
+            bucket = _Bucket(_setting("SPOTIFY_TOKEN_RATE", 3), _setting("SPOTIFY_TOKEN_BURST", 10))
+        _buckets[key] = bucket
+    return bucket
+
+
+# drop the buckets of tokens that have been idle long enough to be full again
+def _prune():
+    now = time.monotonic()
+    for key in [key for key, bucket in _buckets.items()
+                if key != "app" and bucket.rate > 0 and now - bucket.updated > bucket.burst / bucket.rate]:
+        del _buckets[key]
+
+
+def _keys(authorization):
+    keys = ["app"]
+    if authorization and authorization.startswith("Bearer "):
+        keys.append(hashlib.sha1(authorization.encode()).hexdigest())
+    return keys
+
+
+def _max_wait(priority):
+    if priority == PLAYBACK:
+        return _setting("SPOTIFY_PLAYBACK_MAX_WAIT", 5)
+    if priority == BACKGROUND:
+        return 0
+    return _setting("SPOTIFY_RATE_MAX_WAIT", 2)
+
+
+# take a slot in every bucket of the call if one is free, else return the seconds until there is one
+def _take(keys, reserve):
+    with _lock:
+        now = time.monotonic()
+        wait = max([_blocked_until - now] + [_bucket(key).wait(now, reserve) for key in keys])
+        if wait <= 0:
+            for key in keys:
+                _bucket(key).take()
+        return now, wait
+
+
+def _rejected(priority, wait):
+    metrics.increment(f"spotify.ratelimit.rejected.{priority}")
+    return Throttled(max(math.ceil(wait), 1))
+
+
+def _waited(priority, started):
+    waited = time.monotonic() - started
+    if waited > 0.001:
+        metrics.timing(f"spotify.ratelimit.wait.{priority}", waited * 1000)
+    return waited
+
+
+def acquire(authorization, priority=INTERACTIVE):
+    """
+    Wait until a call with this Authorization header may be sent.
+
+    Returns the seconds waited, raises Throttled when the call would have to
+    wait longer than its priority allows.
+    """
+    keys = _keys(authorization)
+    reserve = _setting("SPOTIFY_RATE_RESERVE", 2) if priority == BACKGROUND else 0
+    started = time.monotonic()
+    deadline = started + _max_wait(priority)
+    while True:
+        now, wait = _take(keys, reserve)
+        if wait <= 0:
+            return _waited(priority, started)
+        if now + wait > deadline:
+            raise _rejected(priority, wait)
+        time.sleep(wait)
+
+
+async def acquire_async(authorization, priority=INTERACTIVE):
+    """acquire() for the async client, waits without holding a thread"""
+    keys = _keys(authorization)
+    reserve = _setting("SPOTIFY_RATE_RESERVE", 2) if priority == BACKGROUND else 0
+    started = time.monotonic()
+    deadline = started + _max_wait(priority)
+    while True:
+        now, wait = _take(keys, reserve)
+        if wait <= 0:
+            return _waited(priority, started)
+        if now + wait > deadline:
+            raise _rejected(priority, wait)
+        await asyncio.sleep(wait)
+
+
+#Helper, Spotify answered 429: hold every call of the app for Retry-After seconds
+def throttled(retry_after):
+    global _blocked_until
+    retry_after = min(retry_after, _setting("SPOTIFY_MAX_RETRY_AFTER", 60))
+    with _lock:
+        _blocked_until = max(_blocked_until, time.monotonic() + retry_after)
+    metrics.increment("spotify.ratelimit.throttled")
+    metrics.timing("spotify.ratelimit.retry_after", retry_after * 1000)
+
+
+def reset():
+    global _blocked_until
+    with _lock:
+        _buckets.clear()
+        _blocked_until = 0.0
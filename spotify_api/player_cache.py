@@ -0,0 +1,161 @@
+"""
+Short-lived cache for the read-only Spotify player endpoints.
+
+Every open tab of a session polls /spotify/currently-playing/,
+/spotify/playback-state/ and /spotify/devices/ with the same access token.
+Answers are kept per token and URL for SPOTIFY_PLAYER_CACHE_TTL seconds, and
+requests that arrive while the same call is on its way to Spotify wait for
+it instead of sending their own (single flight). Any player command sent
+with the token (play, pause, next, ...) drops its entries at once, see
+client.request(). Sync and async views (cached_async) share the entries and
+the calls in flight.
+
+The cache lives in process memory: another worker process may serve a
+state that is at most one TTL old after a command.
+"""
+import asyncio
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+
+from api import metrics
+
+_entries = {}  # (account, url) -> (expires_at, result)
+_flights = {}  # (account, url) -> _Flight of the request on its way to Spotify
+_lock = threading.Lock()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.stale = False  # a command was sent while it was on its way, don't keep the answer
+        self.waiters = []  # (loop, future) of the async callers waiting on it, None once it landed
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+# tokens are not kept in memory as keys
+def _account(authorization):
+    return hashlib.sha1(authorization.encode()).hexdigest()
+
+
+# (fresh result, None, False) on a hit, else (None, flight, whether this caller has to send the call)
+def _join(key):
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry[0] > now:
+            metrics.increment("spotify.player_cache.hit")
+            return entry[1], None, False
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+    metrics.increment("spotify.player_cache.miss" if leader else "spotify.player_cache.coalesced")
+    return None, flight, leader
+
+
+# the leader's answer came back: keep it if it is good and wake everyone waiting on it
+def _land(key, flight, result):
+    flight.result = result
+    with _lock:
+        if _flights.get(key) is flight:
+            del _flights[key]
+        if result is not None and result[1] == 200 and not flight.stale:
+            _entries[key] = (time.monotonic() + _setting("SPOTIFY_PLAYER_CACHE_TTL", 0.5), result)
+        _prune(time.monotonic())
+        waiters, flight.waiters = flight.waiters, None
+    flight.done.set()
+    for loop, future in waiters:
+        loop.call_soon_threadsafe(_wake, future)
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def cached(authorization, url, fetch):
+    """
+    Return fetch() for this token and URL, shared with concurrent callers.
+
+    fetch returns a (data, status) pair; only 200 answers are kept, errors
+    are handed to the callers waiting on the same flight and then dropped.
+    """
+    key = (_account(authorization), url)
+    hit, flight, leader = _join(key)
+    if flight is None:
+        return hit
+
+    if not leader:
+        if flight.done.wait(_setting("SPOTIFY_READ_TIMEOUT", 15)) and flight.result is not None:
+            return flight.result
+        return fetch()  # the leader failed or hangs, don't fail with it
+
+    result = None
+    try:
+        result = fetch()
+    finally:
+        _land(key, flight, result)
+    return result
+
+
+async def cached_async(authorization, url, fetch):
+    """cached() for async views, fetch is a coroutine function; shares flights with cached()"""
+    key = (_account(authorization), url)
+    hit, flight, leader = _join(key)
+    if flight is None:
+        return hit
+
+    if not leader:
+        if await _wait_async(flight) and flight.result is not None:
+            return flight.result
+        return await fetch()
+
+    result = None
+    try:
+        result = await fetch()
+    finally:
+        _land(key, flight, result)
+    return result
+
+
+async def _wait_async(flight):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    with _lock:
+        if flight.waiters is None:
+            return True
+        flight.waiters.append((loop, future))
+    try:
+        await asyncio.wait_for(future, _setting("SPOTIFY_READ_TIMEOUT", 15))
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+# drop expired entries, so tokens that stopped polling don't stay around
+def _prune(now):
+    for key in [key for key, entry in _entries.items() if entry[0] <= now]:
+        del _entries[key]
+
+
+#Helper, forget the cached player state of a token (after play, pause, next, ...)
+def invalidate(authorization):
+    account = _account(authorization)
+    with _lock:
+        for key in [key for key in _entries if key[0] == account]:
+            del _entries[key]
+        # requests after the command must not join a call sent before it
+        for key in [key for key in _flights if key[0] == account]:
+            _flights.pop(key).stale = True
+
+
+def clear():
+    with _lock:
+        _entries.clear()
@@ -1,3 +1,448 @@
-from django.test import TestCase
+import asyncio
+import threading
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import requests
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connections
+from django.test import AsyncClient, Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.utils.asyncio import async_unsafe
+from rest_framework.test import APIClient
+
+from api import metrics, session_cache
+from api.models import Session
+from api.routers import shard_for
+from . import account_cache, async_client, client, etags, limiter, player_cache, tokens
+
+
+# like DatabaseCache: sync calls from inside an event loop raise SynchronousOnlyOperation
+class LoopUnsafeCache(LocMemCache):
+    get = async_unsafe(LocMemCache.get)
+    set = async_unsafe(LocMemCache.set)
+
+
+def response(status_code, content=b'', headers=None):
+    result = requests.Response()
+    result.status_code = status_code
+    result._content = content
+    result.headers.update(headers or {})
+    return result
+
+
+@override_settings(SPOTIFY_RETRIES=2, SPOTIFY_RETRY_BACKOFF=0)
+class SpotifyClientTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        limiter.reset()
+        patcher = mock.patch.object(client, 'http_session')
+        self.send = patcher.start().return_value.request
+        self.addCleanup(patcher.stop)
+
+    def test_paths_go_to_the_web_api_with_default_timeouts(self):
+        self.send.return_value = response(200)
+        client.get('/me/player', headers={'Authorization': 'Bearer x'})
+        self.send.assert_called_once_with('GET', 'https://api.spotify.com/v1/me/player', timeout=(5, 15),
+                                          headers={'Authorization': 'Bearer x'})
+        self.assertEqual(metrics.snapshot()['spotify.http.api.count'], 1)
+
+    def test_idempotent_calls_are_retried(self):
+        self.send.side_effect = [response(503), requests.ConnectionError(), response(204)]
+        self.assertEqual(client.put('/me/player/pause').status_code, 204)
+        self.assertEqual(self.send.call_count, 3)
+        self.assertEqual(metrics.snapshot()['spotify.http.api.retries'], 2)
+
+    def test_post_is_sent_once(self):
+        self.send.return_value = response(503)
+        self.assertEqual(client.post(client.TOKEN_URL, data={}).status_code, 503)
+        self.send.assert_called_once()
+        self.assertEqual(metrics.snapshot()['spotify.http.accounts.status.503'], 1)
+
+    def test_connection_errors_raise_after_the_last_retry(self):
+        self.send.side_effect = requests.Timeout()
+        with self.assertRaises(requests.Timeout):
+            client.get('/me')
+        self.assertEqual(self.send.call_count, 3)
+
+
+@override_settings(SPOTIFY_RETRIES=0)
+class SpotifyRateLimitTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        limiter.reset()
+        self.addCleanup(limiter.reset)
+        patcher = mock.patch.object(client, 'http_session')
+        self.send = patcher.start().return_value.request
+        self.send.return_value = response(200)
+        self.addCleanup(patcher.stop)
+
+    def test_retry_after_holds_the_following_calls(self):
+        self.send.return_value = response(429, headers={'Retry-After': '30'})
+        client.get('/me/player')
+        throttled = client.get('/me/player')
+
+        self.send.assert_called_once()  # the second call never reached Spotify
+        self.assertEqual(throttled.status_code, 429)
+        self.assertEqual(throttled.headers['Retry-After'], '30')
+        self.assertEqual(metrics.snapshot()['spotify.ratelimit.throttled'], 1)
+        self.assertEqual(metrics.snapshot()['spotify.ratelimit.rejected.interactive'], 1)
+
+    @override_settings(SPOTIFY_TOKEN_RATE=0.01, SPOTIFY_TOKEN_BURST=3, SPOTIFY_RATE_RESERVE=2)
+    def test_background_calls_leave_room_for_playback(self):
+        headers = {'Authorization': 'Bearer a'}
+        self.assertEqual(client.get('/search?q=a', headers=headers, priority=limiter.BACKGROUND).status_code, 200)
+        self.assertEqual(client.get('/search?q=b', headers=headers, priority=limiter.BACKGROUND).status_code, 429)
+        self.assertEqual(client.put('/me/player/pause', headers=headers).status_code, 200)
+        self.assertEqual(self.send.call_count, 2)
+
+    @override_settings(SPOTIFY_TOKEN_RATE=50, SPOTIFY_TOKEN_BURST=1)
+    def test_short_waits_delay_the_call(self):
+        headers = {'Authorization': 'Bearer a'}
+        client.get('/me/player', headers=headers)
+        self.assertEqual(client.get('/me/player', headers=headers).status_code, 200)
+        self.assertEqual(metrics.snapshot()['spotify.ratelimit.wait.interactive.count'], 1)
+
+    def test_token_endpoint_is_not_held(self):
+        self.send.return_value = response(429, headers={'Retry-After': '30'})
+        client.get('/me/player')
+        self.send.return_value = response(200)
+        self.assertEqual(client.post(client.TOKEN_URL, data={}).status_code, 200)
+
+
+class SpotifyETagTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+        limiter.reset()
+        patcher = mock.patch.object(client, 'http_session')
+        self.send = patcher.start().return_value.request
+        self.addCleanup(patcher.stop)
+
+    def test_unchanged_profile_is_served_from_the_stored_body(self):
+        headers = {'Authorization': 'Bearer a'}
+        self.send.return_value = response(200, b'{"id": "listener"}', {'ETag': '"v1"'})
+        client.get('/me', headers=headers)
+
+        self.send.return_value = response(304)
+        again = client.get('/me', headers=headers)
+        self.assertEqual(self.send.call_args.kwargs['headers']['If-None-Match'], '"v1"')
+        self.assertEqual((again.status_code, again.json()), (200, {'id': 'listener'}))
+        self.assertEqual(metrics.snapshot()['spotify.etag.not_modified'], 1)
+
+        # stored per token
+        client.get('/me', headers={'Authorization': 'Bearer b'})
+        self.assertNotIn('If-None-Match', self.send.call_args.kwargs['headers'])
+
+    def test_player_state_is_not_revalidated(self):
+        self.send.return_value = response(200, b'{}', {'ETag': '"v1"'})
+        client.get('/me/player', headers={'Authorization': 'Bearer a'})
+        self.assertIsNone(etags.lookup('Bearer a', client.API_URL + '/me/player'))
+
+
+class SpotifyProxyETagTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        cache.clear()
+        Session.objects.create(session_id='920002', spotify_access_token='token',
+                               spotify_token_expires=timezone.now() + timedelta(hours=1))
+        self.api = APIClient()
+
+    @mock.patch.object(async_client, 'get', new_callable=mock.AsyncMock, return_value=response(200, b'{"id": "listener"}'))
+    def test_browser_revalidates_with_if_none_match(self, get):
+        first = self.api.get('/spotify/user-profile/', {'session_id': '920002'})
+        self.assertIn('private', first['Cache-Control'])
+        again = self.api.get('/spotify/user-profile/', {'session_id': '920002'}, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b'')
+
+
+@override_settings(SPOTIFY_RETRIES=1, SPOTIFY_RETRY_BACKOFF=0)
+@skipUnless(async_client.httpx, 'httpx is not installed')
+class AsyncSpotifyClientTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        limiter.reset()
+        self.answers = []
+
+    def handler(self, request):
+        self.seen = request
+        return self.answers.pop(0)
+
+    async def call(self, *args, **kwargs):
+        httpx = async_client.httpx
+        async with httpx.AsyncClient(transport=httpx.MockTransport(self.handler)) as http:
+            with mock.patch.object(async_client, 'http_client', return_value=http):
+                return await async_client.request(*args, **kwargs)
+
+    def test_calls_share_the_client_bookkeeping(self):
+        httpx = async_client.httpx
+        self.answers = [httpx.Response(503), httpx.Response(200, json={'is_playing': True})]
+        result = async_to_sync(self.call)('GET', '/me/player', headers={'Authorization': 'Bearer a'})
+        self.assertEqual(result.json(), {'is_playing': True})
+        self.assertEqual(str(self.seen.url), client.API_URL + '/me/player')
+        self.assertEqual(metrics.snapshot()['spotify.http.api.retries'], 1)
+
+    def test_event_loops_share_one_pool(self):
+        # WSGI runs every async view on a new event loop (async_to_sync), the pool must outlive them
+        httpx = async_client.httpx
+        self.answers = [httpx.Response(204), httpx.Response(204)]
+        loops = []
+
+        def handler(request):
+            loops.append(asyncio.get_running_loop())
+            return self.handler(request)
+
+        mock_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        opened = mock.Mock(return_value=mock_client)
+        with mock.patch.object(async_client, '_http', None), mock.patch.object(httpx, 'AsyncClient', opened):
+            for _ in range(2):
+                async_to_sync(async_client.put)('/me/player/pause', headers={'Authorization': 'Bearer a'})
+            self.assertEqual(opened.call_count, 1)
+            self.assertEqual(loops, [async_client._background_loop()] * 2)
+            self.assertFalse(async_client._http.is_closed)
+
+    def test_revalidated_answers_are_replayed(self):
+        httpx = async_client.httpx
+        headers = {'Authorization': 'Bearer a'}
+        self.answers = [httpx.Response(200, content=b'{"id": "listener"}', headers={'ETag': '"v1"'}),
+                        httpx.Response(304)]
+        async_to_sync(self.call)('GET', '/me', headers=headers)
+        again = async_to_sync(self.call)('GET', '/me', headers=headers)
+        self.assertEqual(self.seen.headers['If-None-Match'], '"v1"')
+        self.assertEqual((again.status_code, again.json()), (200, {'id': 'listener'}))
+
+    def test_etags_use_the_async_cache_api(self):
+        httpx = async_client.httpx
+        headers = {'Authorization': 'Bearer a'}
+        self.answers = [httpx.Response(200, content=b'{"devices": []}', headers={'ETag': '"v1"'}),
+                        httpx.Response(304)]
+        with mock.patch.object(etags, 'cache', LoopUnsafeCache('etags', {})):
+            async_to_sync(self.call)('GET', '/me/player/devices', headers=headers)
+            again = async_to_sync(self.call)('GET', '/me/player/devices', headers=headers)
+        self.assertEqual(self.seen.headers['If-None-Match'], '"v1"')
+        self.assertEqual((again.status_code, again.json()), (200, {'devices': []}))
+
+
+class AsyncProxyViewTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        cache.clear()
+        player_cache.clear()
+        Session.objects.create(session_id='920003', spotify_access_token='token',
+                               spotify_token_expires=timezone.now() + timedelta(hours=1))
+
+    @mock.patch.object(async_client, 'put', new_callable=mock.AsyncMock, return_value=response(204))
+    def test_player_commands_take_json_without_csrf_token(self, put):
+        api = Client(enforce_csrf_checks=True)
+        result = api.post('/spotify/play-track/?session_id=920003', {'track_uri': 'spotify:track:a'},
+                          content_type='application/json')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.json()['message'], 'Track started successfully')
+        self.assertEqual(put.call_args.kwargs['json'], {'uris': ['spotify:track:a']})
+        self.assertEqual(put.call_args.kwargs['headers'], {'Authorization': 'Bearer token'})
+
+    def test_concurrent_polls_make_one_call(self):
+        async def poll_together():
+            release = asyncio.Event()
+
+            async def spotify_call(url, **kwargs):
+                await release.wait()
+                return response(200, b'{"is_playing": true}')
+
+            api = AsyncClient()
+            with mock.patch.object(async_client, 'get', side_effect=spotify_call) as get:
+                polls = [asyncio.ensure_future(api.get('/spotify/currently-playing/', {'session_id': '920003'}))
+                         for _ in range(3)]
+                while metrics.snapshot().get('spotify.player_cache.coalesced', 0) < 2:
+                    await asyncio.sleep(0.01)  # all three wait on Spotify at once, on one thread
+                release.set()
+                return get.call_count, [(await poll).json() for poll in polls]
+
+        metrics.reset()
+        calls, answers = async_to_sync(poll_together)()
+        self.assertEqual(calls, 1)
+        self.assertEqual(answers, [{'is_playing': True}] * 3)
+
+
+class AccountCacheTests(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        cache.clear()
+        Session.objects.create(session_id='920004', spotify_access_token='token',
+                               spotify_token_expires=timezone.now() + timedelta(hours=1))
+        self.api = APIClient()
+
+    def profile(self):
+        return self.api.get('/spotify/user-profile/', {'session_id': '920004'})
+
+    @mock.patch.object(async_client, 'get', new_callable=mock.AsyncMock, return_value=response(200, b'{"id": "listener"}'))
+    def test_profile_is_kept_until_the_token_changes(self, get):
+        self.assertEqual(self.profile().json(), {'id': 'listener'})
+        self.assertEqual(self.profile().json(), {'id': 'listener'})
+        get.assert_called_once()
+
+        tokens.store_tokens('920004', {'access_token': 'new', 'expires_in': 3600})
+        self.assertIsNone(cache.get(account_cache._key(account_cache.PROFILE, 'Bearer token')))
+        self.profile()
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(get.call_args.kwargs['headers'], {'Authorization': 'Bearer new'})
+
+    @mock.patch.object(async_client, 'get', new_callable=mock.AsyncMock, return_value=response(
+        200, b'{"devices": [{"id": "speaker", "is_active": false}, {"id": "phone", "is_active": true}]}'))
+    def test_active_device_is_remembered_until_disconnect(self, get):
+        self.api.get('/spotify/devices/', {'session_id': '920004'})
+        self.api.get('/spotify/devices/', {'session_id': '920004'})
+        get.assert_called_once()
+        self.assertEqual(account_cache.remembered_device('920004'), 'phone')
+
+        self.api.post('/spotify/disconnect/', {'session_id': '920004'}, format='json')
+        self.assertIsNone(account_cache.remembered_device('920004'))
+        self.assertIsNone(Session.objects.using(shard_for('920004')).get(pk='920004').spotify_access_token)
+        self.assertIsNone(cache.get(account_cache._key(account_cache.DEVICES, 'Bearer token')))
+
+
+class SpotifyClientPoolTests(SimpleTestCase):
+    def test_one_pooled_session_per_process(self):
+        self.addCleanup(client.close)
+        self.assertIs(client.http_session(), client.http_session())
+
+
+class PlayerCacheTests(SimpleTestCase):
+    def setUp(self):
+        player_cache.clear()
+        metrics.reset()
+        self.fetch = mock.Mock(return_value=({'is_playing': True}, 200))
+
+    def read(self, authorization='Bearer a'):
+        return player_cache.cached(authorization, 'https://api.spotify.com/v1/me/player', self.fetch)
+
+    def test_reads_are_shared_per_token_until_a_command(self):
+        self.read()
+        self.read()
+        self.read('Bearer other-account')
+        self.assertEqual(self.fetch.call_count, 2)
+
+        with mock.patch.object(client, 'http_session') as http_session:
+            http_session.return_value.request.return_value = response(204)
+            client.put('/me/player/pause', headers={'Authorization': 'Bearer a'})
+        self.read()
+        self.assertEqual(self.fetch.call_count, 3)
+
+    def test_errors_are_not_kept(self):
+        self.fetch.return_value = ({'error': 'Spotify error 429'}, 429)
+        self.read()
+        self.read()
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_concurrent_reads_make_one_call(self):
+        release = threading.Event()
+        self.fetch.side_effect = lambda: release.wait(5) and ({'is_playing': True}, 200)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.read())) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for _ in range(500):  # until the other three wait on the first call
+            if metrics.snapshot().get('spotify.player_cache.coalesced', 0) == 3:
+                break
+            release.wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.fetch.assert_called_once()
+        self.assertEqual(results, [({'is_playing': True}, 200)] * 4)
+
+    def test_answer_sent_before_a_command_is_not_kept(self):
+        def fetch():
+            player_cache.invalidate('Bearer a')  # pause pressed while the read was on its way
+            return {'is_playing': True}, 200
+
+        self.fetch.side_effect = fetch
+        self.read()
+        self.fetch.side_effect = None
+        self.read()
+        self.assertEqual(self.fetch.call_count, 2)
+
+
+@override_settings(SPOTIFY_PLAYER_CACHE_TTL=0, SPOTIFY_DEVICES_TTL=0)  # every devices() call reaches Spotify
+class TokenRefreshTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        session_cache.clear()
+        cache.clear()
+        metrics.reset()
+        self.api = APIClient()
+
+    def test_refresh_locks_do_not_grow_with_sessions(self):
+        self.assertIs(tokens._session_lock('920001'), tokens._session_lock('920001'))
+        self.assertEqual(len({id(tokens._session_lock(str(n))) for n in range(10000)}), len(tokens._locks))
+
+    def create_session(self, expires_in):
+        Session.objects.create(session_id='920001', spotify_access_token='old', spotify_refresh_token='refresh',
+                               spotify_token_expires=timezone.now() + timedelta(seconds=expires_in))
+
+    def devices(self):
+        with mock.patch.object(async_client, 'get', new_callable=mock.AsyncMock,
+                               return_value=response(200, b'{"devices": []}')) as get:
+            self.assertEqual(self.api.get('/spotify/devices/', {'session_id': '920001'}).status_code, 200)
+        return get.call_args.kwargs['headers']['Authorization']
+
+    @mock.patch.object(tokens, 'request_tokens', return_value={'access_token': 'new', 'expires_in': 3600})
+    def test_token_is_refreshed_before_it_expires(self, request_tokens):
+        self.create_session(expires_in=60)
+        self.assertEqual(self.devices(), 'Bearer new')
+        self.assertEqual(self.devices(), 'Bearer new')
+
+        request_tokens.assert_called_once()
+        session = Session.objects.using(shard_for('920001')).get(pk='920001')
+        self.assertEqual(session.spotify_refresh_token, 'refresh')  # kept, Spotify sent none
+        self.assertGreater(session.spotify_token_expires, timezone.now() + timedelta(minutes=50))
+
+    @mock.patch.object(tokens, 'request_tokens')
+    def test_valid_token_is_used_as_is(self, request_tokens):
+        self.create_session(expires_in=3600)
+        self.assertEqual(self.devices(), 'Bearer old')
+        request_tokens.assert_not_called()
+
+    def test_concurrent_requests_refresh_once(self):
+        self.create_session(expires_in=60)
+        release = threading.Event()
+
+        def slow_refresh(data):
+            release.wait(5)
+            return {'access_token': 'new', 'expires_in': 3600}
+
+        results = []
+
+        def request():
+            try:
+                results.append(tokens.ensure_fresh_token(session_cache.get_session('920001')))
+            finally:
+                connections.close_all()
+
+        with mock.patch.object(tokens, 'request_tokens', side_effect=slow_refresh) as request_tokens:
+            threads = [threading.Thread(target=request) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        request_tokens.assert_called_once()
+        self.assertEqual(results, ['new'] * 4)
+
+    def test_failed_refresh_keeps_the_token(self):
+        self.create_session(expires_in=60)
+        with mock.patch.object(tokens, 'request_tokens', side_effect=tokens.TokenRefreshError('HTTP 400')):
+            self.assertEqual(self.devices(), 'Bearer old')
+        self.assertEqual(metrics.snapshot()['spotify.token.refresh_failed'], 1)
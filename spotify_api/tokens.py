@@ -0,0 +1,137 @@
+import base64
+import threading
+import time
+import zlib
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from api import metrics
+from api.models import Session
+from api.routers import for_session
+from api.session_cache import get_session, invalidate_session
+from . import account_cache, client
+
+# one refresh per session in this process: a fixed set of locks picked by a hash of the session id,
+# so the set does not grow with every session seen (sessions sharing a lock just take turns)
+_locks = [threading.Lock() for _ in range(64)]
+
+
+class TokenRefreshError(Exception):
+    pass
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _session_lock(session_id):
+    return _locks[zlib.crc32(str(session_id).encode()) % len(_locks)]
+
+
+# lock shared by all worker processes, so only one of them calls Spotify for a session
+def _refresh_key(session_id):
+    return f"fnt:spotify-refresh:{session_id}"
+
+
+#Helper, POST to the Spotify token endpoint with the app credentials, returns the token payload
+def request_tokens(data):
+    raw = f"{settings.SPOTIFY_CLIENT_ID}:{settings.SPOTIFY_CLIENT_SECRET}".encode()
+    headers = {"Authorization": "Basic " + base64.b64encode(raw).decode()}
+    try:
+        result = client.post(client.TOKEN_URL, data=data, headers=headers)
+    except requests.RequestException as e:
+        raise TokenRefreshError(f"Network error: {e}") from e
+    if result.status_code != 200:
+        raise TokenRefreshError(f"HTTP {result.status_code}")
+    try:
+        return result.json()
+    except ValueError as e:
+        raise TokenRefreshError("Invalid response from Spotify") from e
+
+
+#Helper, save a token payload on the session (the refresh token is kept when Spotify sends no new one)
+def store_tokens(session_id, tokens):
+    values = {
+        "spotify_access_token": tokens.get("access_token"),
+        "spotify_token_expires": timezone.now() + timedelta(seconds=tokens.get("expires_in", 3600)),
+    }
+    if tokens.get("refresh_token"):
+        values["spotify_refresh_token"] = tokens["refresh_token"]
+    with for_session(session_id):
+        replaced = Session.objects.filter(session_id=session_id).values_list("spotify_access_token", flat=True).first()
+        Session.objects.filter(session_id=session_id).update(**values)
+    invalidate_session(session_id)
+    if replaced and replaced != values["spotify_access_token"]:
+        account_cache.forget(f"Bearer {replaced}")  # profile / devices kept for the old token
+    return values
+
+
+def refresh_session_tokens(session_id):
+    with for_session(session_id):
+        refresh_token = Session.objects.filter(session_id=session_id).values_list(
+            "spotify_refresh_token", flat=True).first()
+    if not refresh_token:
+        raise TokenRefreshError("No refresh_token available")
+    return store_tokens(session_id, request_tokens({"grant_type": "refresh_token", "refresh_token": refresh_token}))
+
+
+def _expires_soon(expires, margin=None):
+    if expires is None:
+        return False
+    if margin is None:
+        margin = _setting("SPOTIFY_TOKEN_REFRESH_MARGIN", 300)
+    return expires - timezone.now() <= timedelta(seconds=margin)
+
+
+def _take_over(session, current):
+    session.spotify_access_token = current.spotify_access_token
+    session.spotify_token_expires = current.spotify_token_expires
+
+
+def ensure_fresh_token(session):
+    """
+    Refresh the session's Spotify access token before it expires.
+
+    Runs when the token expires within SPOTIFY_TOKEN_REFRESH_MARGIN seconds
+    and updates `session` in place. Only one request per session refreshes,
+    the others keep using the current token while it is still valid, or wait
+    up to SPOTIFY_TOKEN_WAIT seconds for the new one once it has expired. A
+    failed refresh leaves the token as it was, the Spotify call then answers
+    401 like before.
+    """
+    if not session.spotify_access_token or not _expires_soon(session.spotify_token_expires):
+        return session.spotify_access_token
+    session_id = session.session_id
+
+    with _session_lock(session_id):
+        # another thread may have refreshed while this one waited for the lock
+        current = get_session(session_id)
+        if current is not None and not _expires_soon(current.spotify_token_expires):
+            _take_over(session, current)
+            return session.spotify_access_token
+
+        if cache.add(_refresh_key(session_id), True, 30):
+            try:
+                values = refresh_session_tokens(session_id)
+                metrics.increment("spotify.token.refreshed")
+                session.spotify_access_token = values["spotify_access_token"]
+                session.spotify_token_expires = values["spotify_token_expires"]
+            except TokenRefreshError:
+                metrics.increment("spotify.token.refresh_failed")
+            finally:
+                cache.delete(_refresh_key(session_id))
+            return session.spotify_access_token
+
+    # another process is refreshing
+    metrics.increment("spotify.token.refresh_waited")
+    deadline = time.monotonic() + _setting("SPOTIFY_TOKEN_WAIT", 5)
+    while _expires_soon(session.spotify_token_expires, margin=0) and time.monotonic() < deadline:
+        time.sleep(0.1)
+        current = get_session(session_id)
+        if current is not None and not _expires_soon(current.spotify_token_expires):
+            _take_over(session, current)
+    return session.spotify_access_token
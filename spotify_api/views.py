@@ -1,8 +1,12 @@
 # HELPERS
 # headerToken(request) - get Spotify access token , create authorization header
+# SpotifyTokenView - async base view, loads the session's access token once per request
 # getDescription(code) - Descriptions for HTTP status codes
-# callSpotifyAPI(url, headers, empty204=None, method="GET", json_data=None) 
-#   Generic Spotify API caller with error handling
+# callSpotifyAPI(url, headers, empty204=None, method="GET", json_data=None, cached=False, kept=None) 
+#   Generic Spotify API caller with error handling (cached=True for the polled player reads,
+#   kept=PROFILE / DEVICES for the answers kept per token), awaitable
+# spotifyData(...) - (data, status) of callSpotifyAPI, for views that look into the answer
+# spotifyResult(...) - (data, status) of one Spotify call, awaitable
 
 # VIEWS 
 # SpotifyAPIRootView - Displays available endpoints 
@@ -21,32 +25,68 @@
 # SpotifyRefreshTokenView - Refreshes token 
 
 import base64
+import json
 from urllib.parse import urlencode
 
-import requests
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import conditional_page
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
 from api.models import Session
+from spotify_api import account_cache, async_client, client as spotify, player_cache
+from spotify_api.account_cache import DEVICES, PROFILE
+from spotify_api.tokens import store_tokens
+from api.authentication import SPOTIFY_SESSION_FIELDS, load_session, request_session
+from api.session_cache import invalidate_session
+from api.routers import bind_session
 
 
 # HELPERS 
-# header token 
+# header token (session already resolved by SessionIdAuthentication)
 def headerToken(request):
-    session_id = request.query_params.get("session_id") or request.data.get("session_id")
-    if not session_id:
-        return None
-    
-    try:
-        session = Session.objects.get(session_id=session_id)
-        token = session.spotify_access_token
-        if not token:
-            return None
-        return {"Authorization": f"Bearer {token}"}
-    except Session.DoesNotExist:
+    session = request_session(request)
+    if session is None or not session.spotify_access_token:
         return None
+    return {"Authorization": f"Bearer {session.spotify_access_token}"}
+
+
+# request body of a proxy call: JSON object or form fields
+def requestData(request):
+    if request.content_type == "application/json":
+        try:
+            data = json.loads(request.body or b"{}")
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+    return request.POST
+
+
+# base for views that call Spotify with the session's token
+# async: under ASGI (FNTproject/asgi.py) a request waiting on Spotify holds no worker thread.
+# The session is resolved like SessionIdAuthentication does it (request.auth, request.data as in DRF views).
+# GETs carry an ETag, a browser revalidating with If-None-Match gets a bodiless 304
+@method_decorator(csrf_exempt, name="dispatch")
+@method_decorator(conditional_page, name="dispatch")
+class SpotifyTokenView(View):
+    session_fields = SPOTIFY_SESSION_FIELDS
+
+    async def dispatch(self, request, *args, **kwargs):
+        request.data = requestData(request)
+        session_id = request.GET.get("session_id") or request.data.get("session_id")
+        request.auth = None
+        if session_id:
+            request.auth = await sync_to_async(load_session)(session_id, self.session_fields)
+        response = await super().dispatch(request, *args, **kwargs)
+        if request.method == "GET":
+            patch_cache_control(response, private=True, no_cache=True)  # per user, revalidate every time
+        return response
 
 # error codes from Spotify API documentation
 def getDescription(code):
@@ -80,24 +120,47 @@ def getDescription(code):
         return "Unknown status code."
 
 # call api helper 
-def callSpotifyAPI(url, headers, empty204=None, method="GET", json_data=None):
+async def callSpotifyAPI(url, headers, empty204=None, method="GET", json_data=None, cached=False, kept=None):
+    return spotifyResponse(*await spotifyData(url, headers, empty204, method, json_data, cached, kept))
+
+
+async def spotifyData(url, headers, empty204=None, method="GET", json_data=None, cached=False, kept=None):
+    fetch = lambda: spotifyResult(url, headers, empty204, method, json_data)
+    # profile and devices: kept per token for minutes (account_cache)
+    if kept:
+        return await account_cache.kept_async(kept, headers["Authorization"], fetch)
+    # read-only player endpoints: shared by the session's tabs for a moment (player_cache)
+    if cached:
+        return await player_cache.cached_async(headers["Authorization"], url, fetch)
+    return await fetch()
+
+
+def spotifyResponse(data, status):
+    response = JsonResponse(data, status=status)
+    if status == 429 and data.get("retry_after"):
+        response["Retry-After"] = data["retry_after"]  # tell the page how long to back off
+    return response
+
+
+# (data, status) of a Spotify call
+async def spotifyResult(url, headers, empty204=None, method="GET", json_data=None):
     # make request
     try:
         if method.upper() == "POST":
-            result = requests.post(url, headers=headers, json=json_data, timeout=15)
+            result = await async_client.post(url, headers=headers, json=json_data)
         elif method.upper() == "PUT":
-            result = requests.put(url, headers=headers, json=json_data, timeout=15)
+            result = await async_client.put(url, headers=headers, json=json_data)
         else:
-            result = requests.get(url, headers=headers, timeout=15)
+            result = await async_client.get(url, headers=headers)
     except Exception as e:
-        return Response({"error": "Internal error: " + str(e)}, status=500)
+        return {"error": "Internal error: " + str(e)}, 500
 
     # success
     if result.status_code == 200:
         try:
-            return Response(result.json(), status=200)
+            return result.json(), 200
         except ValueError:
-            return Response({"error": "Invalid response from Spotify"}, status=502)
+            return {"error": "Invalid response from Spotify"}, 502
 
     # null return    
     elif result.status_code == 204:
@@ -107,27 +170,29 @@ def callSpotifyAPI(url, headers, empty204=None, method="GET", json_data=None):
         }
         if empty204 is not None:
             payload["message"] = empty204
-        return Response(payload, status=200)
+        return payload, 200
+
+    # throttled by Spotify or by our limiter (client.request)
+    elif result.status_code == 429:
+        return {
+            "error": "Spotify error 429",
+            "description": getDescription(429),
+            "retry_after": result.headers.get("Retry-After"),
+        }, 429
 
     # known error codes
-    elif result.status_code in [400, 401, 403, 404, 429, 500, 502, 503]:
-        return Response(
-            {
-                "error": "Spotify error " + str(result.status_code),
-                "description": getDescription(result.status_code),
-            },
-            status=result.status_code,
-        )
+    elif result.status_code in [400, 401, 403, 404, 500, 502, 503]:
+        return {
+            "error": "Spotify error " + str(result.status_code),
+            "description": getDescription(result.status_code),
+        }, result.status_code
 
     # catch
     else:
-        return Response(
-            {
-                "status_code": result.status_code,
-                "description": getDescription(result.status_code),
-            },
-            status=result.status_code,
-        )
+        return {
+            "status_code": result.status_code,
+            "description": getDescription(result.status_code),
+        }, result.status_code
 
 # SPOTIFY API ROOT  used to view URLS
 class SpotifyAPIRootView(APIView):
@@ -156,51 +221,62 @@ class SpotifyAPIRootView(APIView):
 
 # SPOTIFY
 # get Devices
-class SpotifyDevicesView(APIView):
-    def get(self, request, *args, **kwargs):
+class SpotifyDevicesView(SpotifyTokenView):
+    async def get(self, request, *args, **kwargs):
         headers = headerToken(request)
         if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
-        return callSpotifyAPI(
+            return JsonResponse({"error": "Not authenticated"}, status=401)
+        data, status = await spotifyData(
             "https://api.spotify.com/v1/me/player/devices",
             headers=headers,
             empty204="No devices available",
+            kept=DEVICES,
         )
+        if status == 200:
+            active = [device["id"] for device in data.get("devices") or [] if device.get("is_active")]
+            if active:
+                await account_cache.remember_device_async(request.auth.session_id, active[0])
+        return spotifyResponse(data, status)
 
 
 # Currently Playing: GET /currently-playing
-class SpotifyCurrentlyPlayingView(APIView):
-    def get(self, request, *args, **kwargs):
+class SpotifyCurrentlyPlayingView(SpotifyTokenView):
+    async def get(self, request, *args, **kwargs):
         headers = headerToken(request)
         if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
-        return callSpotifyAPI(
+            return JsonResponse({"error": "Not authenticated"}, status=401)
+        return await callSpotifyAPI(
             "https://api.spotify.com/v1/me/player/currently-playing",
             headers=headers,
             empty204="Nothing currently playing",
+            cached=True,
         )
 
 
 # Playback state: GET /player/state
-class SpotifyPlaybackStateView(APIView):
-    def get(self, request, *args, **kwargs):
+class SpotifyPlaybackStateView(SpotifyTokenView):
+    async def get(self, request, *args, **kwargs):
         headers = headerToken(request)
         if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
-        return callSpotifyAPI(
+            return JsonResponse({"error": "Not authenticated"}, status=401)
+        data, status = await spotifyData(
             "https://api.spotify.com/v1/me/player",
             headers=headers,
             empty204="No active playback",
+            cached=True,
         )
+        if status == 200 and isinstance(data.get("device"), dict):
+            await account_cache.remember_device_async(request.auth.session_id, data["device"].get("id"))
+        return spotifyResponse(data, status)
 
 
 # Recent tracks   GET /recent-tracks
-class SpotifyRecentTracksView(APIView):
-    def get(self, request, *args, **kwargs):
+class SpotifyRecentTracksView(SpotifyTokenView):
+    async def get(self, request, *args, **kwargs):
         headers = headerToken(request)
         if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
-        return callSpotifyAPI(
+            return JsonResponse({"error": "Not authenticated"}, status=401)
+        return await callSpotifyAPI(
             "https://api.spotify.com/v1/me/player/recently-played?limit=10",
             headers=headers,
             empty204="No recent tracks available",
@@ -208,66 +284,67 @@ class SpotifyRecentTracksView(APIView):
 
 
 # User GET /me (user profile)
-class SpotifyUserProfileView(APIView):
-    def get(self, request, *args, **kwargs):
+class SpotifyUserProfileView(SpotifyTokenView):
+    async def get(self, request, *args, **kwargs):
         headers = headerToken(request)
         if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
-        return callSpotifyAPI(
+            return JsonResponse({"error": "Not authenticated"}, status=401)
+        return await callSpotifyAPI(
             "https://api.spotify.com/v1/me",
             headers=headers,
             empty204="No user profile data",  # unlikely
+            kept=PROFILE,  # the page's connection check, no Spotify call while the token lives
         )
 
 # Search Tracks: GET /search-tracks?q=
-class SpotifySearchTracksView(APIView):
-    def get(self, request, *args, **kwargs):
-        query = request.query_params.get("q", "")
+class SpotifySearchTracksView(SpotifyTokenView):
+    async def get(self, request, *args, **kwargs):
+        query = request.GET.get("q", "")
         if not query:
-            return Response({"error": "No search query provided"}, status=400)
+            return JsonResponse({"error": "No search query provided"}, status=400)
         
         headers = headerToken(request)
         if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
+            return JsonResponse({"error": "Not authenticated"}, status=401)
         
         url = f"https://api.spotify.com/v1/search?q={query}&type=track&limit=10"
-        return callSpotifyAPI(url, headers)
+        return await callSpotifyAPI(url, headers)
 
 
 # Play Specific Track  POST /play-track {uri}
-class SpotifyPlayTrackView(APIView):
-    def post(self, request, *args, **kwargs):
+class SpotifyPlayTrackView(SpotifyTokenView):
+    async def post(self, request, *args, **kwargs):
         headers = headerToken(request)
         if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
+            return JsonResponse({"error": "Not authenticated"}, status=401)
 
         track_uri = request.data.get("track_uri")
         if not track_uri:
-            return Response({"error": "No track URI provided"}, status=400)
+            return JsonResponse({"error": "No track URI provided"}, status=400)
 
-        device_id = request.query_params.get("device_id")
+        device_id = request.GET.get("device_id")
         url = "https://api.spotify.com/v1/me/player/play"
         if device_id:
             url += f"?device_id={device_id}"
 
         payload = {"uris": [track_uri]}
-        return callSpotifyAPI(url, headers, empty204="Track started successfully", method="PUT", json_data=payload)
+        return await callSpotifyAPI(url, headers, empty204="Track started successfully", method="PUT", json_data=payload)
 
 
 # Play/Resume: POST /play  (fallback playlist)
-class SpotifyPlayView(APIView):
-    def post(self, request, *args, **kwargs):
+class SpotifyPlayView(SpotifyTokenView):
+    async def post(self, request, *args, **kwargs):
         headers = headerToken(request)
         if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
+            return JsonResponse({"error": "Not authenticated"}, status=401)
 
-        device_id = request.query_params.get("device_id")
+        device_id = request.GET.get("device_id")
         url = "https://api.spotify.com/v1/me/player/play"
         if device_id:
             url += f"?device_id={device_id}"
 
         # Try to resume first
-        response = callSpotifyAPI(url, headers, method="PUT", json_data={})
+        response = await callSpotifyAPI(url, headers, method="PUT", json_data={})
         
         # If no active context, start a popular playlist
         if hasattr(response, 'status_code') and response.status_code == 404:
@@ -275,54 +352,54 @@ class SpotifyPlayView(APIView):
                 "context_uri": "spotify:playlist:37i9dQZF1DXcBWIGoYBM5M",  # Today's Top Hits
                 "position_ms": 0,
             }
-            return callSpotifyAPI(url, headers, method="PUT", json_data=payload)
+            return await callSpotifyAPI(url, headers, method="PUT", json_data=payload)
         
         return response
 
 
 # Pause   POST /pause
-class SpotifyPauseView(APIView):
-    def post(self, request, *args, **kwargs):
+class SpotifyPauseView(SpotifyTokenView):
+    async def post(self, request, *args, **kwargs):
         headers = headerToken(request)
         if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
+            return JsonResponse({"error": "Not authenticated"}, status=401)
 
-        device_id = request.query_params.get("device_id")
+        device_id = request.GET.get("device_id")
         url = "https://api.spotify.com/v1/me/player/pause"
         if device_id:
             url += f"?device_id={device_id}"
 
-        return callSpotifyAPI(url, headers, method="PUT")
+        return await callSpotifyAPI(url, headers, method="PUT")
 
 
 # Next Track: POST /next
-class SpotifyNextTrackView(APIView):
-    def post(self, request, *args, **kwargs):
+class SpotifyNextTrackView(SpotifyTokenView):
+    async def post(self, request, *args, **kwargs):
         headers = headerToken(request)
         if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
+            return JsonResponse({"error": "Not authenticated"}, status=401)
 
-        device_id = request.query_params.get("device_id")
+        device_id = request.GET.get("device_id")
         url = "https://api.spotify.com/v1/me/player/next"
         if device_id:
             url += f"?device_id={device_id}"
 
-        return callSpotifyAPI(url, headers, method="POST")
+        return await callSpotifyAPI(url, headers, method="POST")
 
 
 # Turn off repeat mode: PUT /repeat-off
-class SpotifyRepeatOffView(APIView):
-    def put(self, request, *args, **kwargs):
+class SpotifyRepeatOffView(SpotifyTokenView):
+    async def put(self, request, *args, **kwargs):
         headers = headerToken(request)
         if not headers:
-            return Response({"error": "Not authenticated"}, status=401)
+            return JsonResponse({"error": "Not authenticated"}, status=401)
 
-        device_id = request.query_params.get("device_id")
+        device_id = request.GET.get("device_id")
         url = "https://api.spotify.com/v1/me/player/repeat?state=off"
         if device_id:
             url += f"&device_id={device_id}"
 
-        return callSpotifyAPI(url, headers, method="PUT", empty204="Repeat mode turned off")
+        return await callSpotifyAPI(url, headers, method="PUT", empty204="Repeat mode turned off")
 
 
 # OAuth: GET /auth (returns auth URL)
@@ -390,7 +467,7 @@ class SpotifyAuthView(APIView):
         headers = {"Authorization": "Basic " + basic}
 
         try:
-            result = requests.post("https://accounts.spotify.com/api/token", data=data, headers=headers)
+            result = spotify.post(spotify.TOKEN_URL, data=data, headers=headers)
         except Exception as e:
             return Response({"error": f"Network error: {e}"}, status=500)
 
@@ -444,7 +521,7 @@ class SpotifyCallbackView(APIView):
         headers = {"Authorization": "Basic " + basic}
 
         try:
-            result = requests.post("https://accounts.spotify.com/api/token", data=data, headers=headers)
+            result = spotify.post(spotify.TOKEN_URL, data=data, headers=headers)
         except Exception:
             return HttpResponseRedirect("/?error=network")
 
@@ -463,17 +540,8 @@ class SpotifyCallbackView(APIView):
         # Get current session from Django session
         current_session_data = request.session.get("current_session")
         if current_session_data and current_session_data.get("session_id"):
-            try:
-                session_obj = Session.objects.get(session_id=current_session_data["session_id"])
-                session_obj.spotify_access_token = tokens.get("access_token")
-                session_obj.spotify_refresh_token = tokens.get("refresh_token")
-                # Calculate expiry time
-                expires_in = tokens.get("expires_in", 3600)
-                from datetime import datetime, timedelta
-                session_obj.spotify_token_expires = datetime.now() + timedelta(seconds=expires_in)
-                session_obj.save()
-            except Session.DoesNotExist:
-                pass  # Session not found, continue anyway
+            bind_session(current_session_data["session_id"])
+            store_tokens(current_session_data["session_id"], tokens)  # no-op if the session is gone
         
         return HttpResponseRedirect("/?spotify=connected")
 
@@ -522,7 +590,7 @@ class SpotifyRefreshTokenView(APIView):
         headers = {"Authorization": "Basic " + basic}
 
         try:
-            result = requests.post("https://accounts.spotify.com/api/token", data=data, headers=headers)
+            result = spotify.post(spotify.TOKEN_URL, data=data, headers=headers)
         except Exception as e:
             return Response({"error": f"Network error: {e}"}, status=500)
 
@@ -539,17 +607,9 @@ class SpotifyRefreshTokenView(APIView):
         session_data.update(new_tokens)
         request.session["spotify"] = session_data
 
-        # Update Session model if we have a session object
+        # Update Session model if we have a session object (refresh token only if a new one was provided)
         if session_obj:
-            session_obj.spotify_access_token = new_tokens.get("access_token")
-            # Only update refresh token if a new one was provided
-            if "refresh_token" in new_tokens:
-                session_obj.spotify_refresh_token = new_tokens.get("refresh_token")
-            # Calculate expiry time
-            expires_in = new_tokens.get("expires_in", 3600)
-            from datetime import datetime, timedelta
-            session_obj.spotify_token_expires = datetime.now() + timedelta(seconds=expires_in)
-            session_obj.save()
+            store_tokens(session_obj.session_id, new_tokens)
 
         return Response({
             "success": True,
@@ -568,16 +628,24 @@ class SpotifyDisconnectView(APIView):
             if not session_id:
                 return Response({"error": "session_id required"}, status=400)
                 
-            # Clear Spotify tokens from Session model
+            # Clear Spotify tokens from Session model (only these columns, the sequence counters
+            # are bumped concurrently and a full-row save would roll them back)
+            bind_session(session_id)
             try:
-                session = Session.objects.get(session_id=session_id)
-                session.spotify_access_token = None
-                session.spotify_refresh_token = None
-                session.spotify_token_expires = None
-                session.spotify_user_id = None
-                session.save()
+                access_token = Session.objects.values_list("spotify_access_token", flat=True).get(
+                    session_id=session_id)
             except Session.DoesNotExist:
                 return Response({"error": "invalid session_id"}, status=400)
+            Session.objects.filter(session_id=session_id).update(
+                spotify_access_token=None,
+                spotify_refresh_token=None,
+                spotify_token_expires=None,
+                spotify_user_id=None,
+            )
+            invalidate_session(session_id)
+            if access_token:
+                account_cache.forget(f"Bearer {access_token}")
+            account_cache.forget_device(session_id)
             
             return Response({
                 "success": True,
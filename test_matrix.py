@@ -0,0 +1,56 @@
+"""
+Run the test suite against every api database backend.
+
+SQLite always runs, once with a single api database and once sharded.
+PostgreSQL runs when a server answers on the API_DB_* settings from the
+environment / .env, otherwise it is reported as skipped.
+
+    python test_matrix.py
+"""
+import os
+import subprocess
+import sys
+
+from decouple import config
+
+
+#Helper, True if the configured Postgres server accepts connections
+def postgres_available():
+    try:
+        import psycopg
+    except ImportError:
+        return False
+    try:
+        psycopg.connect(
+            dbname='postgres',
+            user=config('API_DB_USER', default='postgres'),
+            password=config('API_DB_PASSWORD', default=''),
+            host=config('API_DB_HOST', default='localhost'),
+            port=config('API_DB_PORT', default='5432'),
+            connect_timeout=3,
+        ).close()
+    except psycopg.Error:
+        return False
+    return True
+
+
+def run(engine, shards=1):
+    env = dict(os.environ, API_DB_ENGINE=engine, API_SHARDS=str(shards))
+    print(f'--- api database: {engine}, {shards} shard(s)', flush=True)
+    return subprocess.call([sys.executable, 'manage.py', 'test', '--noinput', *sys.argv[1:]], env=env)
+
+
+def main():
+    results = {'sqlite': run('sqlite'), 'sqlite sharded': run('sqlite', shards=3)}
+    if postgres_available():
+        results['postgresql'] = run('postgresql')
+    else:
+        print('--- api database: postgresql skipped (no server on API_DB_HOST/API_DB_PORT)')
+
+    for engine, code in results.items():
+        print(f'{engine}: {"ok" if code == 0 else "FAILED"}')
+    return max(results.values())
+
+
+if __name__ == '__main__':
+    sys.exit(main())